@@ -0,0 +1,960 @@
+#!/usr/bin/env python3
+"""
+🍎 Mac File Share - Benchmarks
+Starts server.py on loopback against a generated share directory and
+measures it from the outside, so any version of server.py can be compared.
+
+Usage:
+    python3 benchmark.py listing-under-load [--engines single,threads]
+    python3 benchmark.py sendfile [--download-size BYTES] [--requests N]
+    python3 benchmark.py listing-rps [--entries N] [--server OLD/server.py]
+    python3 benchmark.py connections-memory [--connections N] [--engines threads,asyncio]
+    python3 benchmark.py search-index [--files N]
+    python3 benchmark.py metrics-overhead [--requests N]
+    python3 benchmark.py hot-files [--requests N]
+    python3 benchmark.py upload-many [--upload-files N] [--file-size BYTES] [--batch N]
+    python3 benchmark.py mixed [--clients N] [--requests N] [--mix listing=40,...]
+                               [--fixture DIR] [--json out.json]
+    python3 benchmark.py compare old.json new.json [--threshold PCT]
+
+Every scenario takes --json FILE to save its results together with the
+server's git commit, the options and the machine, so runs of different
+commits can be put side by side with ``compare``.
+"""
+
+import argparse
+import hashlib
+import http.client
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SERVER = os.path.join(HERE, 'server.py')
+
+
+def free_port():
+    """Ask the OS for an unused loopback port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def make_small_files(directory, count, size=1024):
+    """Fill a directory with small files and backdate it like a settled folder"""
+    data = b'x' * size
+    for i in range(count):
+        with open(os.path.join(directory, f'photo_{i:05d}.jpg'), 'wb') as f:
+            f.write(data)
+    past = time.time() - 3600
+    os.utime(directory, (past, past))
+
+
+def make_tree(root, count, per_dir=100, fanout=32):
+    """Spread ``count`` empty files over nested folders, like a big photo/document share"""
+    kinds = [('IMG', 'jpg'), ('Report', 'pdf'), ('notes', 'txt'), ('clip', 'mp4')]
+    for i in range(count):
+        if i % per_dir == 0:
+            folder = i // per_dir
+            directory = os.path.join(root, f'set_{folder // fanout:04d}', f'part_{folder:06d}')
+            os.makedirs(directory)
+        stem, ext = kinds[i % len(kinds)]
+        os.close(os.open(os.path.join(directory, f'{stem}_{i:07d}.{ext}'), os.O_CREAT | os.O_WRONLY))
+
+
+def make_sparse_file(path, size):
+    """Create a file of the given size without writing its blocks"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+FIXTURE_VERSION = 1
+FIXTURE_FOLDERS = (('dir_10', 10), ('dir_1k', 1000), ('dir_100k', 100000))
+FIXTURE_FILES = (('1KB.bin', 1024), ('64KB.bin', 64 * 1024), ('1MB.bin', 1024 * 1024),
+                 ('16MB.bin', 16 * 1024 * 1024))
+FIXTURE_SPARSE = (('1GB.bin', 1024 ** 3), ('4GB.bin', 4 * 1024 ** 3))
+
+
+def make_fixture(root, big_folder=100000):
+    """Build the standard share for the mixed workload, or reuse it if already built.
+
+    Folders of 10, 1k and ``big_folder`` entries, files of 1 KB to 16 MB
+    with seeded random content and sparse files of several GB; everything
+    is backdated so the server caches it like a settled share. The same
+    arguments always give the same tree.
+    """
+    marker = os.path.join(root, '.fixture')
+    spec = {'version': FIXTURE_VERSION, 'big_folder': big_folder}
+    try:
+        with open(marker) as f:
+            if json.load(f) == spec:
+                return
+    except (OSError, ValueError):
+        pass
+    started = time.perf_counter()
+    for name in os.listdir(root) if os.path.isdir(root) else ():
+        path = os.path.join(root, name)
+        shutil.rmtree(path) if os.path.isdir(path) else os.unlink(path)
+    os.makedirs(os.path.join(root, 'files'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'uploads'), exist_ok=True)
+    rng = random.Random(FIXTURE_VERSION)
+    for name, count in FIXTURE_FOLDERS:
+        count = big_folder if count == 100000 else count
+        directory = os.path.join(root, name)
+        os.makedirs(directory)
+        for i in range(count):
+            os.close(os.open(os.path.join(directory, f'IMG_{i:06d}.jpg'), os.O_CREAT | os.O_WRONLY))
+    for name, size in FIXTURE_FILES:
+        with open(os.path.join(root, 'files', name), 'wb') as f:
+            f.write(rng.randbytes(size))
+    for name, size in FIXTURE_SPARSE:
+        make_sparse_file(os.path.join(root, 'files', name), size)
+    past = time.time() - 3600
+    for directory, _, names in os.walk(root):
+        for name in names:
+            os.utime(os.path.join(directory, name), (past, past))
+        os.utime(directory, (past, past))
+    with open(marker, 'w') as f:
+        json.dump(spec, f)
+    print(f"Built fixture in {root} ({time.perf_counter() - started:.1f}s)")
+
+
+def clear_uploads(root):
+    """Remove what a run uploaded, so the fixture can be reused"""
+    for directory in (os.path.join(root, 'uploads'), root):
+        for name in os.listdir(directory):
+            if name.startswith('bench_'):
+                os.unlink(os.path.join(directory, name))
+
+
+class ServerProcess:
+    """Run server.py in a child process for the duration of a with-block"""
+
+    def __init__(self, share_dir, server=DEFAULT_SERVER, args=()):
+        self.share_dir = share_dir
+        self.server = server
+        self.args = list(args)
+        self.port = free_port()
+        self.proc = None
+        self.rusage = None
+
+    def __enter__(self):
+        cmd = [sys.executable, self.server, self.share_dir, str(self.port)] + self.args
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited early: {' '.join(cmd)}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.proc.kill()
+        raise RuntimeError("server did not start listening")
+
+    def __exit__(self, *exc):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+        try:
+            _, _, self.rusage = os.wait4(self.proc.pid, 0)
+        except ChildProcessError:
+            pass
+        self.proc.returncode = 0
+
+    @property
+    def cpu_seconds(self):
+        """User + system CPU of the server, available after the block exits"""
+        if self.rusage is None:
+            return 0.0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+    @property
+    def peak_rss_kb(self):
+        """Largest resident set size the server reached, available after the block exits"""
+        if self.rusage is None:
+            return 0
+        # ru_maxrss is in KB on Linux but in bytes on macOS
+        return self.rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else self.rusage.ru_maxrss
+
+    def connect(self, timeout=60):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+
+
+def rss_kb(pid):
+    """Resident set size of a process in KB, as reported by ps"""
+    out = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)],
+                         capture_output=True, text=True).stdout.strip()
+    return int(out or 0)
+
+
+def timed_get(server, path, timeout=60):
+    """GET a path on a fresh connection, return (seconds, status, body size)"""
+    start = time.perf_counter()
+    conn = server.connect(timeout)
+    try:
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        size = 0
+        while True:
+            chunk = resp.read(1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        return time.perf_counter() - start, resp.status, size
+    finally:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+def bench_listing_under_load(opts):
+    """p50/p99 listing latency while N large downloads run at the same time"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        make_sparse_file(os.path.join(share, 'big.bin'), opts.download_size)
+        make_small_files(share, opts.entries)
+
+        for engine in opts.engines.split(','):
+            args = ['--engine', engine] + opts.server_args.split()
+            with ServerProcess(share, opts.server, args) as server:
+                stop = threading.Event()
+                downloaded = [0]
+
+                def downloader():
+                    while not stop.is_set():
+                        try:
+                            _, _, size = timed_get(server, '/big.bin', timeout=300)
+                            downloaded[0] += size
+                        except OSError:
+                            time.sleep(0.05)
+
+                threads = [threading.Thread(target=downloader, daemon=True)
+                           for _ in range(opts.downloads)]
+                for t in threads:
+                    t.start()
+                time.sleep(0.5)
+
+                latencies = []
+                errors = 0
+                for _ in range(opts.requests):
+                    try:
+                        elapsed, status, _ = timed_get(server, '/', timeout=300)
+                        if status == 200:
+                            latencies.append(elapsed)
+                        else:
+                            errors += 1
+                    except OSError:
+                        errors += 1
+                stop.set()
+            for t in threads:
+                t.join(timeout=1)
+
+            results.append({
+                'engine': engine,
+                'downloads': opts.downloads,
+                'listing_requests': len(latencies),
+                'errors': errors,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': max(latencies) * 1000 if latencies else 0.0,
+            })
+
+    print(f"{'engine':<10}{'downloads':>10}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['engine']:<10}{r['downloads']:>10}{r['listing_requests']:>6}{r['errors']:>6}"
+              f"{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    return results
+
+
+def bench_sendfile(opts):
+    """Download throughput and server CPU seconds per GB, sendfile vs buffered copy"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        make_sparse_file(os.path.join(share, 'big.bin'), opts.download_size)
+        modes = [('sendfile', []), ('buffered', ['--no-sendfile'])]
+        for mode, extra in modes:
+            args = extra + opts.server_args.split()
+            total = 0
+            with ServerProcess(share, opts.server, args) as server:
+                start = time.perf_counter()
+                for _ in range(opts.requests):
+                    _, status, size = timed_get(server, '/big.bin', timeout=300)
+                    if status != 200:
+                        raise RuntimeError(f"download failed with {status}")
+                    total += size
+                elapsed = time.perf_counter() - start
+            gb = total / 1e9
+            results.append({
+                'mode': mode,
+                'bytes': total,
+                'seconds': elapsed,
+                'throughput_mb_s': total / elapsed / 1e6,
+                'server_cpu_s': server.cpu_seconds,
+                'cpu_s_per_gb': server.cpu_seconds / gb if gb else 0.0,
+            })
+
+    print(f"{'mode':<10}{'GB':>8}{'MB/s':>10}{'server CPU s':>14}{'CPU s/GB':>10}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['bytes'] / 1e9:>8.2f}{r['throughput_mb_s']:>10.0f}"
+              f"{r['server_cpu_s']:>14.2f}{r['cpu_s_per_gb']:>10.3f}")
+    return results
+
+
+def bench_listing_rps(opts):
+    """Sequential listing requests per second on a small directory"""
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        make_small_files(share, opts.entries)
+        with ServerProcess(share, opts.server, opts.server_args.split()) as server:
+            timed_get(server, '/')  # warm up
+            latencies = []
+            body_size = 0
+            start = time.perf_counter()
+            for _ in range(opts.requests):
+                elapsed, status, body_size = timed_get(server, '/')
+                if status != 200:
+                    raise RuntimeError(f"listing failed with {status}")
+                latencies.append(elapsed)
+            elapsed = time.perf_counter() - start
+
+    result = {
+        'entries': opts.entries,
+        'requests': opts.requests,
+        'requests_per_s': opts.requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'response_bytes': body_size,
+        'server_cpu_ms_per_request': server.cpu_seconds / opts.requests * 1000,
+    }
+    print(f"{'entries':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'bytes':>10}{'CPU ms/req':>12}")
+    print(f"{result['entries']:>8}{result['requests_per_s']:>10.1f}{result['p50_ms']:>10.2f}"
+          f"{result['p99_ms']:>10.2f}{result['response_bytes']:>10}"
+          f"{result['server_cpu_ms_per_request']:>12.2f}")
+    return [result]
+
+
+def bench_connections_memory(opts):
+    """Server RSS and listing latency while N idle connections are held open"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        make_small_files(share, opts.entries)
+        for engine in opts.engines.split(','):
+            args = ['--engine', engine, '--max-connections', str(opts.connections + 16),
+                    '--idle-timeout', '300'] + opts.server_args.split()
+            if engine == 'threads':
+                # Threads hold one worker per connection, so give them enough
+                args += ['--workers', str(opts.connections + 16)]
+            with ServerProcess(share, opts.server, args) as server:
+                timed_get(server, '/')
+                base_rss = rss_kb(server.proc.pid)
+                held = []
+                try:
+                    for _ in range(opts.connections):
+                        held.append(socket.create_connection(('127.0.0.1', server.port)))
+                    time.sleep(1)
+                    held_rss = rss_kb(server.proc.pid)
+                    latencies = []
+                    errors = 0
+                    for _ in range(opts.requests):
+                        try:
+                            elapsed, status, _ = timed_get(server, '/', timeout=30)
+                            if status == 200:
+                                latencies.append(elapsed)
+                            else:
+                                errors += 1
+                        except OSError:
+                            errors += 1
+                finally:
+                    for s in held:
+                        s.close()
+
+            results.append({
+                'engine': engine,
+                'connections': opts.connections,
+                'base_rss_kb': base_rss,
+                'held_rss_kb': held_rss,
+                'kb_per_connection': (held_rss - base_rss) / max(1, opts.connections),
+                'errors': errors,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+            })
+
+    print(f"{'engine':<10}{'conns':>7}{'RSS MB':>9}{'KB/conn':>9}{'err':>6}{'p50 ms':>9}{'p99 ms':>9}")
+    for r in results:
+        print(f"{r['engine']:<10}{r['connections']:>7}{r['held_rss_kb'] / 1024:>9.1f}"
+              f"{r['kb_per_connection']:>9.1f}{r['errors']:>6}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}")
+    return results
+
+
+def bench_search_index(opts):
+    """Search index build time and memory, then query latency, on a tree of --files names"""
+    queries = [
+        ('substring, 1 hit', f'q=_{opts.files // 2:07d}.'),
+        ('substring, none', 'q=nothing-here'),
+        ('substring, many', 'q=report'),
+        ('glob', 'glob=img_%3F%3F%3F0000.*'),
+        ('glob, no literal', 'glob=%3F%3F%3F%3F_%3F%3F%3F%3F%3F%3F1.*'),
+        ('extension', 'ext=mp4'),
+        ('below folder', 'q=notes&path=/set_0000'),
+    ]
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        started = time.perf_counter()
+        make_tree(share, opts.files)
+        print(f"Created {opts.files} files in {time.perf_counter() - started:.1f}s")
+        with ServerProcess(share, opts.server, opts.server_args.split()) as server:
+            timed_get(server, '/')
+            base_rss = rss_kb(server.proc.pid)
+            # The first search starts the walk; ask until it is done
+            started = time.perf_counter()
+            while True:
+                conn = server.connect()
+                conn.request('GET', '/.fileshare/search?q=x')
+                resp = conn.getresponse()
+                body = resp.read()
+                conn.close()
+                if resp.status != 503:
+                    break
+            wall = time.perf_counter() - started
+            if resp.status != 200:
+                raise RuntimeError(f"search failed with {resp.status}")
+            index = json.loads(body)['index']
+            built_rss = rss_kb(server.proc.pid)
+
+            results = []
+            for label, query in queries:
+                latencies = []
+                server_ms = []
+                for _ in range(opts.requests):
+                    conn = server.connect()
+                    start = time.perf_counter()
+                    conn.request('GET', f'/.fileshare/search?{query}&limit=100')
+                    data = json.loads(conn.getresponse().read())
+                    latencies.append(time.perf_counter() - start)
+                    conn.close()
+                    server_ms.append(data['took_ms'])
+                results.append({
+                    'query': label,
+                    'results': len(data['results']),
+                    'search_p50_ms': percentile(server_ms, 50),
+                    'search_p99_ms': percentile(server_ms, 99),
+                    'request_p50_ms': percentile(latencies, 50) * 1000,
+                })
+
+    summary = {
+        'files': opts.files,
+        'folders': index['folders'],
+        'build_s': index['build_seconds'],
+        'first_search_s': wall,
+        'index_kb': index['bytes'] / 1024,
+        'rss_growth_kb': built_rss - base_rss,
+        'queries': results,
+    }
+    print(f"{'files':>9}{'folders':>9}{'build s':>9}{'index MB':>10}{'RSS +MB':>9}")
+    print(f"{summary['files']:>9}{summary['folders']:>9}{summary['build_s']:>9.2f}"
+          f"{summary['index_kb'] / 1024:>10.1f}{summary['rss_growth_kb'] / 1024:>9.1f}")
+    print()
+    print(f"{'query':<18}{'hits':>6}{'p50 ms':>9}{'p99 ms':>9}{'req p50':>9}")
+    for r in results:
+        print(f"{r['query']:<18}{r['results']:>6}{r['search_p50_ms']:>9.2f}"
+              f"{r['search_p99_ms']:>9.2f}{r['request_p50_ms']:>9.2f}")
+    return [summary]
+
+
+def bench_metrics_overhead(opts):
+    """Cost of request metrics: per-request bookkeeping in-process, and latency with and without"""
+    # In-process: the exact code that runs after every request
+    spec = importlib.util.spec_from_file_location('fileshare_server', opts.server)
+    server_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server_module)
+    handler = server_module.FileShareHandler.__new__(server_module.FileShareHandler)
+    handler.wfile = server_module.MeteredWriter(io.BytesIO())
+    handler.headers = None
+    loops = 100000
+    start = time.perf_counter()
+    for _ in range(loops):
+        handler.started = time.perf_counter()
+        handler.route = 'listing'
+        handler.status = 200
+        handler.phases = {}
+        handler.sendfile_bytes = 0
+        handler.add_phase('scan', handler.started)
+        handler.add_phase('render', handler.started)
+        handler.wfile.write(b'x' * 512)
+        handler.record_metrics()
+    record_us = (time.perf_counter() - start) / loops * 1e6
+
+    # End to end: both servers run side by side and take turns, so drift
+    # in machine load hits them alike; keep-alive keeps the client cheap
+    rounds = 5
+    per_round = max(opts.requests, 1000) // rounds
+    paths = ('/', '/photo_00000.jpg')
+    latencies = {}
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        make_small_files(share, opts.entries)
+        args = opts.server_args.split()
+        with ServerProcess(share, opts.server, args) as on, \
+                ServerProcess(share, opts.server, ['--no-metrics'] + args) as off:
+            servers = {'metrics': on, 'no-metrics': off}
+            conns = {mode: server.connect() for mode, server in servers.items()}
+            for round_number in range(rounds + 1):
+                for path in paths:
+                    for mode, conn in conns.items():
+                        times = latencies.setdefault((mode, path), [])
+                        for _ in range(per_round):
+                            start = time.perf_counter()
+                            conn.request('GET', path)
+                            resp = conn.getresponse()
+                            resp.read()
+                            if resp.status != 200:
+                                raise RuntimeError(f"{path} failed with {resp.status}")
+                            if round_number:  # round 0 warms the caches
+                                times.append(time.perf_counter() - start)
+            for conn in conns.values():
+                conn.close()
+
+    results = []
+    for (mode, path), times in latencies.items():
+        results.append({
+            'mode': mode,
+            'path': path,
+            'requests': len(times),
+            'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+        })
+    print(f"metrics bookkeeping per request: {record_us:.2f} µs (in-process)")
+    print()
+    print(f"{'mode':<12}{'path':<18}{'p50 ms':>9}{'p99 ms':>9}")
+    for r in results:
+        print(f"{r['mode']:<12}{r['path']:<18}{r['p50_ms']:>9.3f}{r['p99_ms']:>9.3f}")
+    for path in paths:
+        on_ms = percentile(latencies[('metrics', path)], 50) * 1000
+        off_ms = percentile(latencies[('no-metrics', path)], 50) * 1000
+        print(f"p50 overhead {path}: {(on_ms - off_ms) * 1000:+.0f} µs ({(on_ms / off_ms - 1) * 100:+.1f}%)")
+    return [{'record_us': record_us, 'runs': results}]
+
+
+def bench_hot_files(opts):
+    """Repeated small-file GETs per second with the in-memory file cache on and off"""
+    sizes = (('note.pdf', 4 * 1024), ('screenshot.png', 64 * 1024), ('scan.pdf', 256 * 1024))
+    rounds = 5
+    per_round = max(opts.requests, 1000) // rounds
+    latencies = {}
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+        past = time.time() - 3600
+        for name, size in sizes:
+            path = os.path.join(share, name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            os.utime(path, (past, past))
+        args = opts.server_args.split()
+        with ServerProcess(share, opts.server, args) as on, \
+                ServerProcess(share, opts.server, ['--hot-cache-mb', '0'] + args) as off:
+            servers = {'cached': on, 'uncached': off}
+            conns = {mode: server.connect() for mode, server in servers.items()}
+            for round_number in range(rounds + 1):
+                for name, size in sizes:
+                    for mode, conn in conns.items():
+                        times = latencies.setdefault((mode, name), [])
+                        for _ in range(per_round):
+                            start = time.perf_counter()
+                            conn.request('GET', '/' + name)
+                            resp = conn.getresponse()
+                            body = resp.read()
+                            if resp.status != 200 or len(body) != size:
+                                raise RuntimeError(f"{name} failed with {resp.status}")
+                            if round_number:  # round 0 loads the cache
+                                times.append(time.perf_counter() - start)
+            for conn in conns.values():
+                conn.close()
+
+    results = []
+    for (mode, name), times in latencies.items():
+        results.append({
+            'mode': mode,
+            'file': name,
+            'size': dict(sizes)[name],
+            'requests_per_s': len(times) / sum(times),
+            'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'server_cpu_s': servers[mode].cpu_seconds,
+        })
+    print(f"{'mode':<10}{'file':<16}{'KB':>6}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['file']:<16}{r['size'] // 1024:>6}{r['requests_per_s']:>9.0f}"
+              f"{r['p50_ms']:>9.3f}{r['p99_ms']:>9.3f}")
+    print(f"server CPU s: cached {on.cpu_seconds:.2f}, uncached {off.cpu_seconds:.2f}")
+    return results
+
+
+def multipart_body(files):
+    """multipart/form-data body for (name, data) pairs, each preceded by its size"""
+    boundary = os.urandom(12).hex()
+    out = io.BytesIO()
+    for name, data in files:
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="size"\r\n\r\n'
+                  f'{len(data)}\r\n'.encode())
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                  f'filename="{name}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        out.write(data)
+        out.write(b'\r\n')
+    out.write(f'--{boundary}--\r\n'.encode())
+    return out.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def bench_upload_many(opts):
+    """Upload many small files: one request per file, in batches, and all at once"""
+    files = [(f'batch/IMG_{i:05d}.jpg', os.urandom(opts.file_size)) for i in range(opts.upload_files)]
+    total = sum(len(data) for _, data in files)
+    modes = [('one per request', 1), (f'batches of {opts.batch}', opts.batch),
+             ('one request', len(files))]
+    results = []
+    for mode, per_request in modes:
+        with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as share:
+            with ServerProcess(share, opts.server, opts.server_args.split()) as server:
+                conn = server.connect(timeout=300)
+                start = time.perf_counter()
+                for i in range(0, len(files), per_request):
+                    body, ctype = multipart_body(files[i:i + per_request])
+                    conn.request('POST', '/?format=json', body, {'Content-Type': ctype})
+                    resp = conn.getresponse()
+                    resp.read()
+                    if resp.status not in (200, 303):
+                        raise RuntimeError(f"upload failed with {resp.status}")
+                elapsed = time.perf_counter() - start
+                conn.close()
+            # Older servers save every file at the top level
+            saved = sum(len([n for n in names if n.startswith('IMG_')])
+                        for _, _, names in os.walk(share))
+        if saved != len(files):
+            raise RuntimeError(f"{mode}: {saved} of {len(files)} files saved")
+        results.append({
+            'mode': mode,
+            'files': len(files),
+            'bytes': total,
+            'seconds': elapsed,
+            'files_per_s': len(files) / elapsed,
+            'mb_per_s': total / elapsed / 1e6,
+            'server_cpu_s': server.cpu_seconds,
+        })
+    print(f"{'mode':<20}{'files':>7}{'seconds':>9}{'files/s':>9}{'MB/s':>8}{'server CPU s':>14}")
+    for r in results:
+        print(f"{r['mode']:<20}{r['files']:>7}{r['seconds']:>9.2f}{r['files_per_s']:>9.0f}"
+              f"{r['mb_per_s']:>8.1f}{r['server_cpu_s']:>14.2f}")
+    return results
+
+
+MIX_PATHS = {
+    'listing': ['/dir_10/', '/dir_1k/', '/dir_100k/'],
+    'download': ['/files/' + name for name, _ in FIXTURE_FILES],
+    'range': ['/files/' + name for name, _ in FIXTURE_SPARSE],
+}
+
+
+def parse_mix(text):
+    """'listing=40,download=30' -> [('listing', 40), ('download', 30)]"""
+    mix = []
+    for item in text.split(','):
+        op, _, weight = item.partition('=')
+        if op not in ('listing', 'download', 'range', 'upload') or not weight.isdigit():
+            raise SystemExit(f"bad --mix entry: {item}")
+        mix.append((op, int(weight)))
+    return mix
+
+
+def mixed_client(server, number, count, mix, samples, payload):
+    """One client: ``count`` seeded random operations over a keep-alive connection"""
+    rng = random.Random(number)
+    ops = [op for op, _ in mix]
+    weights = [weight for _, weight in mix]
+    conn = server.connect(timeout=120)
+    for i in range(count):
+        op = rng.choices(ops, weights)[0]
+        headers = {}
+        body = None
+        method = 'GET'
+        if op == 'upload':
+            files = [(f'bench_{number}_{i}_{j}.bin', payload[:rng.randint(1, 256) * 1024])
+                     for j in range(rng.randint(1, 5))]
+            body, ctype = multipart_body(files)
+            method, path = 'POST', '/uploads/?format=json'
+            headers['Content-Type'] = ctype
+        else:
+            path = rng.choice(MIX_PATHS[op])
+            if op == 'range':
+                start = rng.randrange(0, 1024 ** 3 - 1024 * 1024)
+                headers['Range'] = f'bytes={start}-{start + 1024 * 1024 - 1}'
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            size = 0
+            while True:
+                chunk = resp.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+            ok = resp.status < 400
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = server.connect(timeout=120)
+            ok, size = False, 0
+        size += len(body) if body else 0
+        samples.append((op, time.perf_counter() - start, size, ok))
+    conn.close()
+
+
+def bench_mixed(opts):
+    """Concurrent clients mixing listings, full and ranged downloads and multipart uploads"""
+    mix = parse_mix(opts.mix)
+    payload = random.Random(0).randbytes(256 * 1024)
+    samples = []
+    with tempfile.TemporaryDirectory(prefix='fileshare-bench-') as temp:
+        share = opts.fixture or os.path.join(temp, 'share')
+        os.makedirs(share, exist_ok=True)
+        make_fixture(share, opts.big_folder)
+        clear_uploads(share)
+        with ServerProcess(share, opts.server, opts.server_args.split()) as server:
+            # Warm up: every path once, so first-time scans are not measured
+            for paths in MIX_PATHS.values():
+                for path in paths:
+                    timed_get(server, path, timeout=120)
+            clients = [threading.Thread(target=mixed_client, daemon=True,
+                                        args=(server, n, opts.requests, mix, samples, payload))
+                       for n in range(opts.clients)]
+            start = time.perf_counter()
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+            wall = time.perf_counter() - start
+        clear_uploads(share)
+
+    results = []
+    for op in [op for op, _ in mix] + ['all']:
+        picked = [s for s in samples if op in ('all', s[0])]
+        if not picked:
+            continue
+        times = [elapsed for _, elapsed, _, ok in picked if ok]
+        results.append({
+            'op': op,
+            'requests': len(picked),
+            'errors': sum(1 for *_, ok in picked if not ok),
+            'requests_per_s': len(picked) / wall,
+            'mb_per_s': sum(size for _, _, size, _ in picked) / wall / 1e6,
+            'p50_ms': percentile(times, 50) * 1000,
+            'p90_ms': percentile(times, 90) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'max_ms': max(times, default=0.0) * 1000,
+        })
+    results[-1].update({
+        'clients': opts.clients,
+        'wall_s': wall,
+        'server_cpu_s': server.cpu_seconds,
+        'server_cpu_ms_per_request': server.cpu_seconds / max(1, len(samples)) * 1000,
+        'peak_rss_kb': server.peak_rss_kb,
+    })
+
+    print(f"{'op':<10}{'reqs':>7}{'err':>5}{'req/s':>9}{'MB/s':>8}{'p50 ms':>9}{'p90 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}")
+    for r in results:
+        print(f"{r['op']:<10}{r['requests']:>7}{r['errors']:>5}{r['requests_per_s']:>9.1f}"
+              f"{r['mb_per_s']:>8.1f}{r['p50_ms']:>9.2f}{r['p90_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{r['max_ms']:>9.1f}")
+    total = results[-1]
+    print(f"server CPU {total['server_cpu_s']:.2f}s ({total['server_cpu_ms_per_request']:.2f} ms/request), "
+          f"peak RSS {total['peak_rss_kb'] / 1024:.1f} MB, {opts.clients} clients, {wall:.1f}s")
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Saving and comparing runs
+# ---------------------------------------------------------------------------
+
+def server_version(path):
+    """Git commit (with a -dirty mark) and content hash of the server under test"""
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    commit = None
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+        if commit:
+            dirty = subprocess.run(['git', 'status', '--porcelain', '--', os.path.basename(path)],
+                                   cwd=directory, capture_output=True, text=True, timeout=10).stdout
+            if dirty.strip():
+                commit += '-dirty'
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return {'path': os.path.abspath(path), 'sha256': digest, 'commit': commit}
+
+
+def save_report(path, opts, results):
+    """Write a run to ``path`` as JSON ('-' for stdout)"""
+    report = {
+        'scenario': opts.scenario,
+        'started': opts.started,
+        'server': server_version(opts.server),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'options': {k: v for k, v in vars(opts).items()
+                    if k not in ('json', 'started', 'inputs', 'threshold', 'server')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+
+
+# Metric names that are better when higher; everything else numeric is better lower
+HIGHER_IS_BETTER = ('_per_s', 'throughput', 'mb_s')
+# Numbers that describe the run rather than measure it
+NOT_MEASURED = {'entries', 'requests', 'files', 'folders', 'bytes', 'size', 'connections',
+                'downloads', 'clients', 'results', 'listing_requests'}
+
+
+def result_rows(results, prefix=''):
+    """(label, metric, value) for every measured number in a saved run's results"""
+    for item in results:
+        label = ' '.join([prefix] * bool(prefix) +
+                         [str(v) for v in item.values() if isinstance(v, str)])
+        for key, value in item.items():
+            if isinstance(value, list) and all(isinstance(v, dict) for v in value):
+                yield from result_rows(value, label)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and key not in NOT_MEASURED:
+                yield label, key, value
+
+
+def compare_reports(opts):
+    """Print the change of every metric between two saved runs, flagging regressions"""
+    if len(opts.inputs) != 2:
+        raise SystemExit("usage: benchmark.py compare OLD.json NEW.json")
+    reports = []
+    for path in opts.inputs:
+        with open(path) as f:
+            reports.append(json.load(f))
+    old, new = reports
+    if old['scenario'] != new['scenario']:
+        raise SystemExit(f"different scenarios: {old['scenario']} vs {new['scenario']}")
+    for name, report in (('old', old), ('new', new)):
+        print(f"{name}: {report['server']['commit'] or report['server']['sha256'][:12]} "
+              f"({report['started']})")
+    for part in ('options', 'machine'):
+        if old[part] != new[part]:
+            changed = sorted(k for k in old[part].keys() | new[part].keys()
+                             if old[part].get(k) != new[part].get(k))
+            print(f"warning: runs differ in {part}: {', '.join(changed)}")
+    old_rows = {(label, key): value for label, key, value in result_rows(old['results'])}
+    regressions = 0
+    print(f"{'result':<24}{'metric':<28}{'old':>12}{'new':>12}{'change':>9}")
+    for label, key, value in result_rows(new['results']):
+        before = old_rows.get((label, key))
+        if before is None:
+            continue
+        change = (value - before) / before * 100 if before else 0.0
+        worse = -change if any(mark in key for mark in HIGHER_IS_BETTER) else change
+        flag = ''
+        if key == 'errors':
+            flag = '  <<' if value > before else ''
+        elif worse > opts.threshold:
+            flag = '  <<'
+        regressions += bool(flag)
+        print(f"{label[:23]:<24}{key:<28}{before:>12.4g}{value:>12.4g}{change:>+8.1f}%{flag}")
+    print(f"{regressions} metric(s) worse by more than {opts.threshold:g}%")
+    return regressions
+
+
+SCENARIOS = {
+    'listing-under-load': bench_listing_under_load,
+    'sendfile': bench_sendfile,
+    'listing-rps': bench_listing_rps,
+    'connections-memory': bench_connections_memory,
+    'search-index': bench_search_index,
+    'metrics-overhead': bench_metrics_overhead,
+    'hot-files': bench_hot_files,
+    'upload-many': bench_upload_many,
+    'mixed': bench_mixed,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mac File Share benchmarks")
+    parser.add_argument('scenario', choices=sorted(SCENARIOS) + ['compare'])
+    parser.add_argument('inputs', nargs='*', help="two saved runs (compare)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also save the results as JSON ('-' for stdout)")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="percent change counted as a regression (compare)")
+    parser.add_argument('--server', default=DEFAULT_SERVER,
+                        help="server.py to benchmark (default: the one next to this file)")
+    parser.add_argument('--server-args', default='',
+                        help="extra command line arguments for every server run")
+    parser.add_argument('--engines', default='single,threads',
+                        help="comma separated engines to compare")
+    parser.add_argument('--downloads', type=int, default=4,
+                        help="concurrent large downloads")
+    parser.add_argument('--download-size', type=int, default=256 * 1024 * 1024,
+                        help="size of the large file in bytes")
+    parser.add_argument('--entries', type=int, default=200,
+                        help="small files in the shared directory")
+    parser.add_argument('--requests', type=int, default=100,
+                        help="measured requests")
+    parser.add_argument('--connections', type=int, default=1000,
+                        help="idle connections held open (connections-memory)")
+    parser.add_argument('--files', type=int, default=200000,
+                        help="files in the generated tree (search-index)")
+    parser.add_argument('--upload-files', type=int, default=1000,
+                        help="files sent (upload-many)")
+    parser.add_argument('--file-size', type=int, default=16 * 1024,
+                        help="size of each uploaded file in bytes (upload-many)")
+    parser.add_argument('--batch', type=int, default=100,
+                        help="files per request in the batched run (upload-many)")
+    parser.add_argument('--clients', type=int, default=8,
+                        help="concurrent clients, each making --requests requests (mixed)")
+    parser.add_argument('--mix', default='listing=40,download=30,range=15,upload=15',
+                        help="relative weights of the operations (mixed)")
+    parser.add_argument('--fixture', metavar='DIR',
+                        help="build the share here and reuse it on later runs (mixed)")
+    parser.add_argument('--big-folder', type=int, default=100000,
+                        help="entries in the largest fixture folder (mixed)")
+    opts = parser.parse_args()
+    if opts.scenario == 'compare':
+        sys.exit(1 if compare_reports(opts) else 0)
+    opts.started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    results = SCENARIOS[opts.scenario](opts)
+    if opts.json:
+        save_report(opts.json, opts, results)
+
+
+if __name__ == '__main__':
+    main()
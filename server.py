@@ -14,7 +14,54 @@ import urllib.parse
 import html
 import io
 import base64
-from datetime import datetime
+import argparse
+import asyncio
+import threading
+import time
+import signal
+import select
+import errno
+import secrets
+import tempfile
+import email.message
+import email.utils
+import collections
+import bisect
+import struct
+import ctypes
+import ctypes.util
+import stat
+import json
+import queue
+import random
+import re
+import fnmatch
+import string
+import hashlib
+import traceback
+import zlib
+import zipfile
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Optional compressors: zstd is in the stdlib from Python 3.14, brotli is a pip package
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Optional thumbnails: Pillow is a pip package; without it rows keep their emoji icon
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 # Port mặc định
 PORT = 8888
@@ -22,6 +69,162 @@ PORT = 8888
 # Thư mục chia sẻ (mặc định là thư mục Downloads)
 SHARE_DIR = os.path.expanduser("~/Downloads")
 
+# Serving engine: "threads" = bounded thread pool, "asyncio" = event loop for
+# connections + thread pool for requests, "single" = one request at a time
+ENGINES = ('threads', 'asyncio', 'single')
+ENGINE = 'threads'
+
+# Thread pool limits
+WORKERS = 16
+MAX_CONNECTIONS = 64
+ASYNC_MAX_CONNECTIONS = 4096  # idle connections are nearly free with asyncio
+IDLE_TIMEOUT = 30      # seconds a connection may sit idle before it is dropped
+KEEPALIVE_TIMEOUT = 5  # seconds a kept-alive connection may wait for its next request
+KEEPALIVE_POLL = 0.5   # how often a waiting worker checks whether others need it
+DRAIN_TIMEOUT = 10     # seconds to wait for in-flight requests on Ctrl+C
+
+# Seconds between background refreshes of the advertised IP (0 = never)
+IP_REFRESH_INTERVAL = 60
+
+# Entries per listing page (?limit= can ask for up to MAX_PAGE_SIZE)
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+# Sort orders and filters accepted by the JSON listing (?format=json|ndjson)
+LISTING_SORT_KEYS = {
+    'name': None,  # index order: thư mục trước, rồi đến file
+    'size': lambda e: (e.size, e.name.lower()),
+    'mtime': lambda e: (e.mtime_ns, e.name.lower()),
+}
+LISTING_TYPES = ('dir', 'file')
+JSON_BATCH = 500  # entries serialised per write
+
+# URL prefix for the server's own endpoints; dot-names never show up in listings
+INTERNAL_PREFIX = '/.fileshare/'
+
+# Memory cap for cached directory listings
+DIR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Directories modified less than this many seconds ago are not cached,
+# since another change within the same mtime tick would go unnoticed
+DIR_CACHE_SETTLE = 2
+
+# Uploads are read from the socket in chunks of this size
+UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_PART_HEADER_SIZE = 16 * 1024
+
+# Resumable uploads (/.fileshare/uploads): chunk sizes and how long an
+# unfinished upload is kept after its last chunk
+UPLOAD_PART_SIZE = 8 * 1024 * 1024        # chunk size suggested to clients
+MAX_UPLOAD_PART_SIZE = 64 * 1024 * 1024   # bigger PUTs are refused
+UPLOAD_EXPIRY = 24 * 3600
+UPLOAD_CHECKSUMS = ('crc32', 'sha256', 'blake2b')
+# Uploaded bytes are written to disk by background threads; reading from
+# the socket pauses once this many chunks are waiting for them. Files of
+# a multi-file upload are fsync'ed in batches before being renamed in.
+UPLOAD_WRITERS = 4
+UPLOAD_WRITE_QUEUE = 64
+UPLOAD_SYNC_BATCH = 64
+# What an upload does when its name is taken by a different file
+UPLOAD_CONFLICTS = ('rename', 'skip', 'overwrite')
+UPLOAD_CONFLICT = 'rename'
+
+# Downloads are copied in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 32
+# Zero-copy downloads with sendfile(2) when the platform has it
+USE_SENDFILE = hasattr(os, 'sendfile')
+# Small files asked for more than once are kept in memory (0 = off)
+HOT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+HOT_FILE_MAX_SIZE = 256 * 1024
+
+# Response compression (Content-Encoding) for listings and text files
+COMPRESSION = True
+MIN_COMPRESS_SIZE = 1024                 # smaller bodies are sent as is
+MAX_COMPRESS_FILE_SIZE = 64 * 1024 * 1024  # bigger files are never compressed
+COMPRESS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/xml',
+    'application/x-ndjson', 'application/x-sh', 'application/rtf',
+    'image/svg+xml', 'image/x-icon',
+}
+# Formats that are already compressed, whatever mimetypes says
+INCOMPRESSIBLE_EXTENSIONS = {
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar', 'dmg', 'pkg', 'apk', 'ipa',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'heif', 'avif',
+    'mp4', 'mov', 'm4v', 'mkv', 'avi', 'webm', 'mp3', 'm4a', 'aac', 'flac', 'ogg', 'opus',
+    'pdf', 'docx', 'xlsx', 'pptx', 'epub', 'jar', 'woff', 'woff2',
+}
+
+# On-disk caches (compressed files, ...) live outside the shared folder
+if sys.platform == 'darwin':
+    CACHE_DIR = os.path.expanduser('~/Library/Caches/MacFileShare')
+else:
+    CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                             'macfileshare')
+
+# Content digests of shared files: upload preflight, Repr-Digest on downloads
+DIGEST_ALGORITHMS = ('sha256', 'blake2b')
+DIGEST_CACHE_ENTRIES = 50000
+DIGEST_INLINE_MAX = 16 * 1024 * 1024  # bigger files asked for a digest are hashed in the background
+DIGEST_QUEUE_MAX = 64
+DIGEST_MAX_CANDIDATES = 16            # same-size files hashed to answer one preflight
+
+# Image thumbnails in the listing (/.fileshare/thumbs/<path>, needs Pillow)
+THUMBNAILS_ENABLED = Image is not None
+THUMB_SIZE = 160                 # longest side in pixels
+THUMB_QUALITY = 80
+THUMB_WORKERS = min(4, os.cpu_count() or 1)
+THUMB_QUEUE_MAX = 256            # thumbnails waiting to be made; more get 503
+THUMB_WAIT = 2                   # seconds a request waits before answering 503
+THUMB_MAX_SOURCE = 200 * 1024 * 1024
+THUMB_CACHE_MAX_BYTES = 256 * 1024 * 1024
+THUMB_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+
+# Recursive filename search (/.fileshare/search), from an in-memory index
+SEARCH_ENABLED = True
+SEARCH_WORKERS = 8           # threads walking the tree while the index is built
+SEARCH_RESCAN_INTERVAL = 30  # seconds between checks for changed directories
+SEARCH_WAIT = 2              # seconds a search waits for the first build before 503
+SEARCH_LIMIT = 100
+
+# Live listing updates (/.fileshare/events/<path>, Server-Sent Events)
+EVENTS_ENABLED = True
+EVENT_STREAMS_MAX = WORKERS // 2  # each open stream holds a worker thread
+EVENT_STREAM_MAX_AGE = 300        # seconds before a stream ends and the browser reconnects
+EVENT_HEARTBEAT = 15
+EVENT_HISTORY = 256               # recent events kept per folder for reconnecting streams
+EVENT_QUEUE_MAX = 1000            # events a slow stream may fall behind before a reset
+WATCH_POLL = 1                    # seconds between checks of watched folders without inotify
+WATCH_RESCAN = 10                 # full rescans without inotify, for edits that keep the mtime
+WATCH_SETTLE = 0.2                # seconds to gather a burst of inotify events into one diff
+WATCH_LINGER = 60                 # seconds a folder stays watched after its last stream
+
+# Bandwidth shaping of bulk transfers, off unless a rate is given (bytes/s, 0 = unlimited)
+DOWNLOAD_RATE = 0
+UPLOAD_RATE = 0
+CLIENT_DOWNLOAD_RATE = 0
+CLIENT_UPLOAD_RATE = 0
+SHAPING_QUANTUM = 128 * 1024      # bytes a transfer may move per turn
+SHAPING_BURST = 0.25              # seconds of traffic a token bucket holds
+SHAPING_MIN_SIZE = 1024 * 1024    # smaller bodies (listings, small files) are never queued
+
+# Request metrics (/.fileshare/metrics, Prometheus text format)
+METRICS_ENABLED = True
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Access log: one entry per finished request, written by a background thread
+ACCESS_LOG_FORMATS = ('text', 'json')
+ACCESS_LOG_SAMPLE = 1.0                   # share of successful requests logged; errors always are
+ACCESS_LOG_MAX_BYTES = 64 * 1024 * 1024   # a log file is rotated at this size
+ACCESS_LOG_BACKUPS = 5
+LOG_QUEUE_MAX = 10000                     # lines waiting for the writer; more are dropped and counted
+LOG_BATCH = 512                           # lines written at once
+
+# Permissions for new files (mkstemp creates them 0600)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 def get_local_ip():
     """Lấy địa chỉ IP local của máy Mac (ưu tiên IP WiFi 192.168.x.x)"""
     import subprocess
@@ -61,6 +264,54 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
+class ServerAddress:
+    """The URL shown to users, discovered once and refreshed in the background.
+
+    Interface discovery runs ``ifconfig``, which is far too slow for every
+    page view, so requests only read the cached string. A timer thread or
+    a SIGHUP triggers a new lookup. A pinned address is never looked up.
+    """
+
+    def __init__(self, pinned=None, interval=IP_REFRESH_INTERVAL):
+        self.pinned = pinned
+        self.interval = interval
+        self.ip = pinned or '127.0.0.1'
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.ip}:{PORT}"
+
+    def refresh(self):
+        """Look up the local IP now (no-op when pinned)"""
+        if not self.pinned:
+            self.ip = get_local_ip()
+        return self.ip
+
+    def request_refresh(self, *_):
+        """Ask the background thread to refresh; safe to use as a signal handler"""
+        self._wakeup.set()
+
+    def start(self):
+        """Discover the address and keep it fresh from a daemon thread"""
+        self.refresh()
+        if self.pinned or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='ip-refresh', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval or None)
+            self._wakeup.clear()
+            old_ip = self.ip
+            if self.refresh() != old_ip:
+                print(f"🌐 Access URL changed: {self.url}")
+
+
+SERVER_ADDRESS = ServerAddress()
+
 def format_size(size):
     """Format kích thước file cho dễ đọc"""
     for unit in ['B', 'KB', 'MB', 'GB']:
@@ -69,665 +320,5208 @@ def format_size(size):
         size /= 1024
     return f"{size:.1f} TB"
 
+# Emoji icon theo đuôi file
+FILE_ICONS = {
+    # Images
+    'jpg': '🖼️', 'jpeg': '🖼️', 'png': '🖼️', 'gif': '🖼️', 'webp': '🖼️', 'svg': '🖼️', 'ico': '🖼️',
+    # Videos
+    'mp4': '🎬', 'mov': '🎬', 'avi': '🎬', 'mkv': '🎬', 'wmv': '🎬', 'flv': '🎬',
+    # Audio
+    'mp3': '🎵', 'wav': '🎵', 'flac': '🎵', 'aac': '🎵', 'm4a': '🎵', 'ogg': '🎵',
+    # Documents
+    'pdf': '📕', 'doc': '📘', 'docx': '📘', 'xls': '📗', 'xlsx': '📗', 'ppt': '📙', 'pptx': '📙',
+    'txt': '📄', 'rtf': '📄', 'md': '📝',
+    # Code
+    'py': '🐍', 'js': '💛', 'html': '🌐', 'css': '🎨', 'json': '📋', 'xml': '📋',
+    'java': '☕', 'cpp': '⚡', 'c': '⚡', 'swift': '🍎', 'go': '🔵',
+    # Archives
+    'zip': '📦', 'rar': '📦', 'tar': '📦', 'gz': '📦', '7z': '📦', 'dmg': '💿',
+    # Others
+    'exe': '⚙️', 'app': '📱', 'apk': '🤖',
+}
+
 def get_file_icon(filename):
     """Trả về emoji icon dựa trên loại file"""
     ext = filename.lower().split('.')[-1] if '.' in filename else ''
-    icons = {
-        # Images
-        'jpg': '🖼️', 'jpeg': '🖼️', 'png': '🖼️', 'gif': '🖼️', 'webp': '🖼️', 'svg': '🖼️', 'ico': '🖼️',
-        # Videos
-        'mp4': '🎬', 'mov': '🎬', 'avi': '🎬', 'mkv': '🎬', 'wmv': '🎬', 'flv': '🎬',
-        # Audio
-        'mp3': '🎵', 'wav': '🎵', 'flac': '🎵', 'aac': '🎵', 'm4a': '🎵', 'ogg': '🎵',
-        # Documents
-        'pdf': '📕', 'doc': '📘', 'docx': '📘', 'xls': '📗', 'xlsx': '📗', 'ppt': '📙', 'pptx': '📙',
-        'txt': '📄', 'rtf': '📄', 'md': '📝',
-        # Code
-        'py': '🐍', 'js': '💛', 'html': '🌐', 'css': '🎨', 'json': '📋', 'xml': '📋',
-        'java': '☕', 'cpp': '⚡', 'c': '⚡', 'swift': '🍎', 'go': '🔵',
-        # Archives
-        'zip': '📦', 'rar': '📦', 'tar': '📦', 'gz': '📦', '7z': '📦', 'dmg': '💿',
-        # Others
-        'exe': '⚙️', 'app': '📱', 'apk': '🤖',
-    }
-    return icons.get(ext, '📄')
+    return FILE_ICONS.get(ext, '📄')
 
-class FileShareHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=SHARE_DIR, **kwargs)
-    
-    def do_GET(self):
-        """Xử lý GET request"""
-        # Parse URL
-        parsed = urllib.parse.urlparse(self.path)
-        path = urllib.parse.unquote(parsed.path)
-        
-        # Trang chủ hoặc browse thư mục
-        if path == '/' or path == '':
-            self.send_directory_listing('/')
-            return
-        
-        # Kiểm tra đường dẫn file/folder
-        full_path = os.path.join(SHARE_DIR, path.lstrip('/'))
+def make_etag(ino, size, mtime_ns):
+    """Strong ETag built from inode, size and mtime"""
+    return f'"{ino:x}-{size:x}-{mtime_ns:x}"'
+
+def etag_in_list(etag, header, weak=False):
+    """Match an ETag against an If-Match / If-None-Match header value"""
+    header = header.strip()
+    if header == '*':
+        return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if weak and candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def parse_range_header(value, size):
+    """Parse a ``bytes=`` Range header into sorted, merged (start, end) pairs.
+
+    Returns None when the header should be ignored (bad syntax, other
+    units, too many ranges) and [] when no range can be satisfied.
+    """
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, sep, last = item.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or last.isdigit()):
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    if size == 0:
+        return []
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+EntryInfo = collections.namedtuple('EntryInfo', 'name is_dir size mtime_ns ino')
+
+def entry_sort_key(entry):
+    """Thư mục trước, rồi đến file, theo tên không phân biệt hoa thường"""
+    return (not entry.is_dir, entry.name.lower(), entry.name)
+
+def scan_directory(full_path):
+    """Read a directory in one os.scandir pass, skipping dotfiles"""
+    entries = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                continue  # broken symlink or entry removed meanwhile
+            entries.append(EntryInfo(entry.name, is_dir, 0 if is_dir else st.st_size,
+                                     st.st_mtime_ns, st.st_ino))
+    entries.sort(key=entry_sort_key)
+    return entries
+
+
+def entry_to_json(base, entry):
+    """JSON-ready dict for one directory entry (``base`` is its URL directory)"""
+    return {
+        'name': entry.name,
+        'type': 'dir' if entry.is_dir else 'file',
+        'size': entry.size,
+        'mtime': entry.mtime_ns / 1e9,
+        'etag': make_etag(entry.ino, entry.size, entry.mtime_ns),
+        'url': urllib.parse.quote(base + entry.name),
+    }
+
+def encode_cursor(entry):
+    """Opaque, URL-safe cursor pointing just after ``entry``"""
+    token = base64.urlsafe_b64encode(os.fsencode(entry.name)).decode('ascii').rstrip('=')
+    return ('d' if entry.is_dir else 'f') + token
+
+def decode_cursor(cursor):
+    """Sort key of the entry a cursor points after, or None if it is invalid"""
+    if not cursor or cursor[0] not in 'df':
+        return None
+    token = cursor[1:]
+    try:
+        name = os.fsdecode(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return (cursor[0] == 'f', name.lower(), name)
+
+
+class DirectoryIndex:
+    """Sorted entries of one directory, with their sort keys for cursor lookups"""
+
+    __slots__ = ('entries', 'keys')
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.keys = [entry_sort_key(e) for e in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def page(self, cursor=None, limit=PAGE_SIZE):
+        """Return (entries, next cursor) for the page that follows ``cursor``"""
+        start = 0
+        key = decode_cursor(cursor)
+        if key is not None:
+            start = bisect.bisect_right(self.keys, key)
+        items = self.entries[start:start + limit]
+        next_cursor = None
+        if items and start + limit < len(self.entries):
+            next_cursor = encode_cursor(items[-1])
+        return items, next_cursor
+
+
+class DirectoryCache:
+    """LRU cache of scanned directories with a memory cap.
+
+    Entries are keyed on the directory path and validated against the
+    directory's inode and mtime, so a repeat view of an unchanged folder
+    costs one stat() instead of one per entry. Changes to a file's content
+    that leave the directory itself untouched are not noticed.
+    """
+
+    ENTRY_OVERHEAD = 250  # rough bytes per cached entry besides its name
+
+    def __init__(self, max_bytes=DIR_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, full_path, st=None):
+        """Return the DirectoryIndex of a directory, scanning it only if it changed"""
+        if st is None:
+            st = os.stat(full_path)
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            item = self._items.get(full_path)
+            if item is not None and item[0] == key:
+                self._items.move_to_end(full_path)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
         
-        if os.path.isdir(full_path):
-            self.send_directory_listing(path)
-        elif os.path.isfile(full_path):
-            # Download file
-            super().do_GET()
+        index = DirectoryIndex(scan_directory(full_path))
+        if time.time_ns() - st.st_mtime_ns < DIR_CACHE_SETTLE * 1_000_000_000:
+            return index
+        cost = sum(2 * len(e.name) + self.ENTRY_OVERHEAD for e in index.entries)
+        cost += self.ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return index
+        with self._lock:
+            old = self._items.pop(full_path, None)
+            if old is not None:
+                self.size -= old[2]
+            self._items[full_path] = (key, index, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+        return index
+
+
+DIR_CACHE = DirectoryCache()
+
+
+class HotFileCache:
+    """LRU cache of small file bodies with a memory cap.
+
+    Entries are keyed on the path and validated against the file's device,
+    inode, size and mtime, so serving a cached file costs one stat() instead
+    of open, fstat, sendfile and close; a changed file simply misses and is
+    replaced. A file is only loaded the second time it is asked for, so a
+    one-off browse through a folder of photos does not flush the cache, and
+    files modified less than DIR_CACHE_SETTLE seconds ago are never cached.
+    Bodies are handed out as memoryviews, so responses slice them without
+    copying.
+    """
+
+    MAX_SEEN = 4096  # files remembered as asked for once
+
+    def __init__(self, max_bytes=HOT_CACHE_MAX_BYTES, max_file_size=HOT_FILE_MAX_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def cacheable(self, st):
+        return st.st_size <= self.max_file_size and self.max_bytes > 0
+
+    def get(self, full_path, st):
+        """memoryview of the cached body if ``st`` still matches it, else None"""
+        if not self.cacheable(st):
+            return None
+        with self._lock:
+            item = self._items.get(full_path)
+            if item is not None:
+                if item[0] == self.stamp(st):
+                    self._items.move_to_end(full_path)
+                    self.hits += 1
+                    return memoryview(item[1])
+                del self._items[full_path]
+                self.size -= len(item[1])
+            self.misses += 1
+        return None
+
+    def load(self, full_path, st, f):
+        """Read open file ``f`` into the cache if it was asked for before; returns its memoryview or None"""
+        if not self.cacheable(st) or time.time_ns() - st.st_mtime_ns < DIR_CACHE_SETTLE * 1_000_000_000:
+            return None
+        stamp = self.stamp(st)
+        with self._lock:
+            if self._seen.pop(full_path, None) != stamp:
+                self._seen[full_path] = stamp
+                if len(self._seen) > self.MAX_SEEN:
+                    self._seen.popitem(last=False)
+                return None
+        try:
+            data = os.pread(f.fileno(), st.st_size + 1, 0)
+            if len(data) != st.st_size or self.stamp(os.fstat(f.fileno())) != stamp:
+                return None
+        except OSError:
+            return None
+        with self._lock:
+            old = self._items.pop(full_path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._items[full_path] = (stamp, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+        return memoryview(data)
+
+
+HOT_FILES = HotFileCache()
+
+
+class DiskCache:
+    """Files stored under hashed names in a cache directory, pruned LRU by size.
+
+    A hit touches the file's mtime, so pruning removes the least recently
+    used files first once the total goes over ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # counted on first store
+        self._lock = threading.Lock()
+
+    def path_for(self, key, suffix=''):
+        digest = hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + suffix)
+
+    def lookup(self, key, suffix=''):
+        """Path of the cached file for ``key``, or None"""
+        path = self.path_for(key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def store(self, key, suffix, write):
+        """Create the cached file by calling ``write(f)`` on a temp file, then rename it in"""
+        path = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.prune()
+        return path
+
+    def _scan_size(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def prune(self):
+        """Delete least recently used files until the cache is below 90% of its cap"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total
+
+
+class _BrotliCompressor:
+    """Give brotli's Compressor the zlib compressobj interface"""
+
+    def __init__(self):
+        self._c = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.finish()
+
+
+def _available_compressors():
+    """Encodings we can produce, in order of preference"""
+    compressors = {}
+    if brotli is not None:
+        compressors['br'] = _BrotliCompressor
+    if zstd is not None:
+        if hasattr(zstd.ZstdCompressor, 'compressobj'):  # zstandard package
+            compressors['zstd'] = lambda: zstd.ZstdCompressor(level=3).compressobj()
         else:
-            self.send_error(404, "File not found")
-    
-    def do_POST(self):
-        """Handle file upload from any device"""
+            compressors['zstd'] = lambda: zstd.ZstdCompressor(level=3)
+    compressors['gzip'] = lambda: zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressors
+
+
+COMPRESSORS = _available_compressors()
+
+def negotiate_encoding(accept_encoding):
+    """Pick the best encoding we support from an Accept-Encoding header"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if name == 'x-gzip':
+            name = 'gzip'
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+    best, best_q = None, 0.0
+    for name in COMPRESSORS:
+        q = weights.get(name, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def compress_bytes(data, encoding):
+    """Compress a whole body in memory"""
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+def is_compressible(path, ctype, size):
+    """True for text-like files that are worth compressing"""
+    if size < MIN_COMPRESS_SIZE or size > MAX_COMPRESS_FILE_SIZE:
+        return False
+    ext = path.rsplit('.', 1)[-1].lower() if '.' in os.path.basename(path) else ''
+    if ext in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    ctype = ctype.split(';')[0].strip()
+    return (ctype.startswith('text/') or ctype in COMPRESSIBLE_TYPES
+            or ctype.endswith('+json') or ctype.endswith('+xml'))
+
+
+def zip_compress_type(name, size):
+    """Deflate what is worth it in a folder ZIP; store media and archives as they are"""
+    if not COMPRESSION or size < MIN_COMPRESS_SIZE or size > MAX_COMPRESS_FILE_SIZE:
+        return zipfile.ZIP_STORED
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    if ext in INCOMPRESSIBLE_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def walk_share(root):
+    """Yield (full path, relative name, is_dir) for everything below ``root``.
+
+    Depth first in listing order, skipping dotfiles like the listing does.
+    Directories come with a trailing slash; a directory reached twice
+    through symlinks is only walked once.
+    """
+    seen = set()
+    stack = [(root, '')]
+    while stack:
+        path, rel = stack.pop()
         try:
-            content_type = self.headers.get('Content-Type', '')
-            
-            if 'multipart/form-data' in content_type:
-                # Parse boundary more robustly
-                if 'boundary=' not in content_type:
-                    self.send_error(400, "Invalid multipart data")
-                    return
-                
-                boundary = content_type.split('boundary=')[1]
-                if boundary.startswith('"') and boundary.endswith('"'):
-                    boundary = boundary[1:-1]
-                boundary = boundary.encode('utf-8')
-                
-                # Read content
-                content_length = int(self.headers['Content-Length'])
-                body = self.rfile.read(content_length)
-                
-                # Parse multipart data more robustly
-                parts = body.split(b'--' + boundary)
-                
-                files_uploaded = 0
-                for part in parts:
-                    if b'Content-Disposition: form-data; name="file"' in part:
-                        # Find filename
-                        filename = None
-                        lines = part.split(b'\r\n')
-                        for line in lines:
-                            line_str = line.decode('utf-8', errors='ignore')
-                            if 'filename="' in line_str:
-                                filename_start = line_str.find('filename="') + 10
-                                filename_end = line_str.find('"', filename_start)
-                                if filename_end > filename_start:
-                                    filename = line_str[filename_start:filename_end]
-                                break
-                        
-                        if filename:
-                            # Find start position of file content
-                            header_end = part.find(b'\r\n\r\n')
-                            if header_end != -1:
-                                file_content = part[header_end + 4:]
-                                # Remove trailing \r\n if present
-                                if file_content.endswith(b'\r\n'):
-                                    file_content = file_content[:-2]
-                                
-                                # Sanitize filename
-                                filename = os.path.basename(filename)  # Prevent directory traversal
-                                
-                                # Save file
-                                save_path = os.path.join(SHARE_DIR, filename)
-                                try:
-                                    with open(save_path, 'wb') as f:
-                                        f.write(file_content)
-                                    print(f"📥 Received file: {filename} ({len(file_content)} bytes)")
-                                    files_uploaded += 1
-                                except PermissionError:
-                                    print(f"❌ Cannot save file: {filename} (no permission)")
-                                    self.send_error(403, f"Cannot save file: {filename}")
-                                    return
-                                except Exception as e:
-                                    print(f"❌ Error saving file: {filename} ({e})")
-                                    self.send_error(500, f"Error saving file: {filename}")
-                                    return
-                
-                if files_uploaded > 0:
-                    print(f"✅ Upload successful: {files_uploaded} file(s)")
-                    # Redirect to home page
-                    self.send_response(303)
-                    self.send_header('Location', '/')
-                    self.end_headers()
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            entries = scan_directory(path)
+        except OSError:
+            continue
+        if rel:
+            yield path, rel, True
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir:
+                subdirs.append((os.path.join(path, entry.name), rel + entry.name + '/'))
+            else:
+                yield os.path.join(path, entry.name), rel + entry.name, False
+        stack.extend(reversed(subdirs))
+
+
+IndexedDir = collections.namedtuple('IndexedDir', 'mtime_ns names lower subdirs')
+
+def join_rel(rel, name):
+    """Join share-relative paths, '' being the share itself"""
+    return f"{rel}/{name}" if rel else name
+
+
+class SearchIndex:
+    """Every file and folder name below the share, for recursive search.
+
+    Each directory is held as one newline-joined string of its names,
+    folders marked with a trailing slash, plus a lowercased copy when that
+    differs. A query looks for a literal part of the pattern with
+    str.find and only checks the lines it hits, so a million names cost a
+    few large strings rather than a million objects and are searched at C
+    speed.
+
+    The first search starts a parallel walk of the tree. After that a
+    daemon thread stats the indexed directories every ``interval`` seconds
+    and rescans those whose mtime moved; the server's own uploads update
+    their directory at once. Symlinked folders are listed but not walked.
+    Sizes and times are not indexed: they are read when results are sent.
+    """
+
+    DIR_OVERHEAD = 200  # rough bytes per directory besides its strings
+    SAMPLE_DIRS = 64    # folders looked at to pick the rarest part of a glob
+
+    def __init__(self, root, workers=SEARCH_WORKERS, interval=SEARCH_RESCAN_INTERVAL):
+        self.root = root
+        self.workers = workers
+        self.interval = interval
+        self.ready = threading.Event()
+        self.build_seconds = None
+        self.entries = 0
+        self.size = 0
+        self._dirs = {}  # path relative to root ('' for root) -> IndexedDir
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Build the index from a daemon thread, once"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        started = time.monotonic()
+        self._walk([''])
+        self.build_seconds = time.monotonic() - started
+        self.ready.set()
+        print(f"🔎 Indexed {self.entries} names in {len(self._dirs)} folders "
+              f"({self.build_seconds:.1f}s, ~{format_size(self.size)})")
+        while self.interval:
+            time.sleep(self.interval)
+            self.refresh()
+
+    def stats(self):
+        return {'folders': len(self._dirs), 'entries': self.entries, 'bytes': self.size,
+                'build_seconds': self.build_seconds}
+
+    def _scan(self, rel):
+        """IndexedDir for one directory, or None if it can't be read"""
+        names = []
+        subdirs = []
+        path = os.path.join(self.root, rel)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith('.') or '\n' in name:
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        subdirs.append(name)
+                        name += '/'
+                    names.append(name)
+        except OSError:
+            return None
+        if time.time_ns() - mtime_ns < DIR_CACHE_SETTLE * 1_000_000_000:
+            mtime_ns = -1  # rescan next time: a change in the same mtime tick would be missed
+        names.sort(key=str.lower)  # results come in listing order within a folder
+        blob = '\n'.join(names) + '\n' if names else ''
+        lower = blob.lower()
+        return IndexedDir(mtime_ns, blob, blob if lower == blob else lower, tuple(subdirs))
+
+    def _cost(self, rel, record):
+        size = sys.getsizeof(rel) + sys.getsizeof(record.names) + self.DIR_OVERHEAD
+        if record.lower is not record.names:
+            size += sys.getsizeof(record.lower)
+        return size + sum(sys.getsizeof(name) for name in record.subdirs)
+
+    def _put(self, rel, record):
+        """Store ``record``; caller holds the lock"""
+        self._remove(rel)
+        self._dirs[rel] = record
+        self.entries += record.names.count('\n')
+        self.size += self._cost(rel, record)
+
+    def _remove(self, rel):
+        record = self._dirs.pop(rel, None)
+        if record is not None:
+            self.entries -= record.names.count('\n')
+            self.size -= self._cost(rel, record)
+
+    def _drop(self, rel):
+        """Forget ``rel`` and everything below it; caller holds the lock"""
+        prefix = rel + '/'
+        for key in [k for k in self._dirs if k == rel or not rel or k.startswith(prefix)]:
+            self._remove(key)
+
+    def _walk(self, rels):
+        """Scan ``rels`` and every folder below them, several at a time"""
+        results = queue.SimpleQueue()
+
+        def scan(rel):
+            record = None
+            try:
+                record = self._scan(rel)
+            finally:
+                results.put((rel, record))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='search-walk') as pool:
+            pending = 0
+            for rel in rels:
+                pool.submit(scan, rel)
+                pending += 1
+            while pending:
+                rel, record = results.get()
+                pending -= 1
+                if record is None:
+                    continue
+                with self._lock:
+                    self._put(rel, record)
+                for name in record.subdirs:
+                    pool.submit(scan, join_rel(rel, name))
+                    pending += 1
+
+    def _rescan(self, rel):
+        record = self._scan(rel)
+        with self._lock:
+            old = self._dirs.get(rel)
+            if old is None:
+                return  # dropped along with its parent meanwhile
+            if record is None:
+                self._drop(rel)
+                return
+            self._put(rel, record)
+            for name in set(old.subdirs).difference(record.subdirs):
+                self._drop(join_rel(rel, name))
+        added = set(record.subdirs).difference(old.subdirs)
+        if added:
+            self._walk([join_rel(rel, name) for name in added])
+
+    def refresh(self):
+        """Rescan every indexed directory whose mtime changed"""
+        with self._lock:
+            items = list(self._dirs.items())
+        for rel, record in items:
+            try:
+                mtime_ns = os.stat(os.path.join(self.root, rel)).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != record.mtime_ns:
+                self._rescan(rel)
+
+    def changed(self, directory):
+        """Pick up a change the server itself made in ``directory``"""
+        if not self.ready.is_set():
+            return  # the walk still to come will see it
+        rel = os.path.relpath(directory, self.root)
+        self._rescan('' if rel == '.' else rel.replace(os.sep, '/'))
+
+    @staticmethod
+    def _lines(blob, anchors):
+        """(line number, line) of the lines of ``blob`` holding one of ``anchors``"""
+        if anchors is None:
+            return list(enumerate(blob.split('\n')[:-1]))
+        starts = set()
+        for anchor in anchors:
+            pos = blob.find(anchor)
+            while pos != -1:
+                starts.add(blob.rfind('\n', 0, pos) + 1)
+                pos = blob.find(anchor, blob.find('\n', pos) + 1)
+        lines = []
+        number = last = 0
+        for start in sorted(starts):
+            number += blob.count('\n', last, start)
+            last = start
+            lines.append((number, blob[start:blob.find('\n', start)]))
+        return lines
+
+    def search(self, query='', glob='', exts=(), kind=None, under='', limit=SEARCH_LIMIT):
+        """Up to ``limit`` matches as (folder, name, is_dir), and whether there were more.
+
+        ``query`` is a substring and ``glob`` a shell pattern for the whole
+        name, both case-insensitive; ``exts`` are file extensions and
+        ``kind`` is 'dir' or 'file'. Every filter given must hold. Only
+        folders at or below ``under`` are searched.
+        """
+        query = query.lower()
+        pattern = re.compile(fnmatch.translate(glob.lower())) if glob else None
+        suffixes = tuple('.' + ext.lower().lstrip('.') for ext in exts)
+        with self._lock:
+            items = list(self._dirs.items())
+        # What str.find looks for; the filters then check each line it hits
+        if query:
+            anchors = (query,)
+        elif suffixes:
+            anchors = tuple(suffix + '\n' for suffix in suffixes)
+        else:
+            # The glob piece that is rarest in a sample of the index
+            pieces = [p for p in re.split(r'\[[^\]]*\]|[*?]', glob.lower()) if p]
+            step = max(1, len(items) // self.SAMPLE_DIRS)
+            sample = ''.join(record.lower for _, record in items[::step])
+            anchors = (min(pieces, key=sample.count),) if pieces else None
+        prefix = under + '/'
+        matches = []
+        for rel, record in items:
+            if under and rel != under and not rel.startswith(prefix):
+                continue
+            lines = self._lines(record.lower, anchors)
+            if not lines:
+                continue
+            original = record.names.split('\n') if record.lower is not record.names else None
+            for number, name in lines:
+                is_dir = name.endswith('/')
+                if is_dir:
+                    name = name[:-1]
+                if kind and kind != ('dir' if is_dir else 'file'):
+                    continue
+                if query and query not in name:
+                    continue
+                if pattern and not pattern.match(name):
+                    continue
+                if suffixes and (is_dir or not name.endswith(suffixes)):
+                    continue
+                if original:
+                    name = original[number][:-1] if is_dir else original[number]
+                matches.append((rel, name, is_dir))
+                if len(matches) > limit:
+                    return matches[:limit], True
+        return matches, False
+
+
+class Inotify:
+    """Just enough of inotify(7), through ctypes, to hear about changes in folders"""
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_ONLYDIR = 0x1000000
+    IN_CLOEXEC = 0o2000000
+    FOLDER_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                   | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length; the name follows
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add(self, path):
+        """Watch a folder; returns its watch descriptor"""
+        wd = self._add_watch(self.fd, os.fsencode(path), self.FOLDER_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def remove(self, wd):
+        self._rm_watch(self.fd, wd)  # fails harmlessly when the folder is already gone
+
+    def read(self):
+        """(wd, mask) of the events queued so far"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, pos)
+            events.append((wd, mask))
+            pos += self.EVENT.size + length
+        return events
+
+
+class WatchedFolder:
+    """Snapshot and recent events of one folder, shared by all its streams"""
+
+    def __init__(self, path):
+        self.path = path
+        self.token = secrets.token_hex(4)  # tells a reconnecting stream whose event ids it holds
+        self.seq = 0
+        self.history = collections.deque(maxlen=EVENT_HISTORY)
+        self.entries = {}
+        self.mtime_ns = None
+        self.settled = False
+        self.subscribers = set()
+        self.idle_since = time.monotonic()
+        self.wd = None
+        self.dirty = False
+        self.checked = 0.0
+
+    def scan(self):
+        """Read the folder; returns its entries by name, or None if it is gone"""
+        try:
+            st = os.stat(self.path)
+            entries = {e.name: e for e in scan_directory(self.path)}
+        except OSError:
+            return None
+        self.mtime_ns = st.st_mtime_ns
+        # A change in the same mtime tick would be missed by polling
+        self.settled = time.time_ns() - st.st_mtime_ns >= DIR_CACHE_SETTLE * 1_000_000_000
+        self.checked = time.monotonic()
+        return entries
+
+
+class EventSubscription:
+    """The events of one folder waiting to be sent on one stream"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.overflowed = False
+        self._queue = queue.Queue(EVENT_QUEUE_MAX)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True  # the stream ends with a reset
+
+    def get(self, timeout=None):
+        """Next (id, kind, entry) event, or None after ``timeout`` seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeFeed:
+    """Add/remove/modify events for folders open in a browser.
+
+    Streams on the same folder share one WatchedFolder, so many tabs cost
+    no more filesystem work than one. A single thread finds changes: with
+    inotify (Linux) it rescans the folders the kernel reports, otherwise it
+    stats every folder each WATCH_POLL seconds, rescans on an mtime change
+    and every WATCH_RESCAN seconds for edits that leave the mtime alone.
+    Either way the new listing is diffed against the snapshot, so both
+    produce the same events. Folders stay watched WATCH_LINGER seconds
+    after their last stream, and their recent events let a reconnecting
+    stream catch up instead of reloading.
+    """
+
+    def __init__(self, max_streams=EVENT_STREAMS_MAX):
+        self.max_streams = max_streams
+        self.streams = 0
+        self.closed = False
+        self.backend = None
+        self._folders = {}  # real path -> WatchedFolder
+        self._by_wd = {}
+        self._inotify = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        """Pick a backend and start the watcher thread; caller holds the lock"""
+        if self._thread is not None:
+            return
+        if sys.platform.startswith('linux'):
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError, TypeError) as e:
+                print(f"⚠️  inotify unavailable, polling folders instead ({e})")
+        self.backend = 'inotify' if self._inotify else 'polling'
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def subscribe(self, full_path, last_id=None, since=None):
+        """EventSubscription for a folder, or None when too many streams are open.
+
+        ``last_id`` is the last event a reconnecting stream saw and
+        ``since`` the folder mtime the page was rendered from. When neither
+        shows what the client has missed, the stream starts with a reset.
+        """
+        path = os.path.realpath(full_path)
+        with self._lock:
+            if self.closed or self.streams >= self.max_streams:
+                return None
+            self._start()
+            folder = self._folders.get(path)
+        if folder is None:
+            folder = WatchedFolder(path)
+            folder.entries = folder.scan() or {}
+        with self._lock:
+            if self.streams >= self.max_streams:
+                return None
+            if self._folders.get(path) is not folder:
+                folder = self._folders.setdefault(path, folder)
+                if folder.wd is None and self._inotify:
+                    self._watch(folder)
+            subscription = EventSubscription(folder)
+            if not self._catch_up(folder, subscription, last_id, since):
+                subscription.put((f"{folder.token}-{folder.seq}", 'reset', None))
+            folder.subscribers.add(subscription)
+            self.streams += 1
+        return subscription
+
+    def _watch(self, folder):
+        """Ask inotify about ``folder``; caller holds the lock"""
+        try:
+            folder.wd = self._inotify.add(folder.path)
+            self._by_wd[folder.wd] = folder
+        except OSError as e:
+            print(f"⚠️  Cannot watch {folder.path} ({e}), polling it instead")
+
+    def _catch_up(self, folder, subscription, last_id, since):
+        """Replay what a stream missed; False when that is unknown"""
+        if last_id:
+            token, _, seq = last_id.partition('-')
+            if token != folder.token or not seq.isdigit():
+                return False
+            seq = int(seq)
+            if seq < folder.seq - len(folder.history) or seq > folder.seq:
+                return False
+            for event_seq, event in folder.history:
+                if event_seq > seq:
+                    subscription.put(event)
+            return True
+        return since is not None and since == str(folder.mtime_ns)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            folder = subscription.folder
+            if subscription in folder.subscribers:
+                folder.subscribers.discard(subscription)
+                self.streams -= 1
+                if not folder.subscribers:
+                    folder.idle_since = time.monotonic()
+
+    def changed(self, directory):
+        """Check a folder the server itself changed without waiting for the next poll"""
+        folder = self._folders.get(os.path.realpath(directory))
+        if folder is not None:
+            folder.dirty = True
+            self._wakeup.set()
+
+    def close(self):
+        """End every stream (their request threads notice within a second)"""
+        self.closed = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self.closed:
+            if self._inotify:
+                ready, _, _ = select.select([self._inotify.fd], [], [], WATCH_POLL)
+                if ready:
+                    time.sleep(WATCH_SETTLE)  # one diff for a burst of changes
+                    self._read_inotify()
+            else:
+                self._wakeup.wait(WATCH_POLL)
+                self._wakeup.clear()
+            try:
+                self._check()
+            except Exception as e:  # keep watching the other folders
+                print(f"⚠️  Change feed error: {e}")
+
+    def _read_inotify(self):
+        for wd, mask in self._inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                for folder in list(self._folders.values()):
+                    folder.dirty = True
+            folder = self._by_wd.get(wd)
+            if folder is not None:
+                folder.dirty = True
+
+    def _check(self):
+        now = time.monotonic()
+        with self._lock:
+            for path, folder in list(self._folders.items()):
+                if not folder.subscribers and now - folder.idle_since > WATCH_LINGER:
+                    del self._folders[path]
+                    if folder.wd is not None:
+                        del self._by_wd[folder.wd]
+                        self._inotify.remove(folder.wd)
+                        folder.wd = None
+            folders = list(self._folders.values())
+        for folder in folders:
+            if folder.wd is None and not folder.dirty:
+                try:
+                    mtime_ns = os.stat(folder.path).st_mtime_ns
+                except OSError:
+                    mtime_ns = None
+                folder.dirty = (mtime_ns != folder.mtime_ns or not folder.settled
+                                or now - folder.checked >= WATCH_RESCAN)
+            if folder.dirty:
+                folder.dirty = False
+                self._rescan(folder)
+
+    def _rescan(self, folder):
+        entries = folder.scan()
+        changes = []
+        if entries is None:
+            # Folder deleted or unreadable: let the page find out what happened
+            if folder.entries:
+                changes.append(('reset', None))
+            entries = {}
+        else:
+            for name, entry in entries.items():
+                before = folder.entries.get(name)
+                if before is None:
+                    changes.append(('add', entry))
+                elif before != entry and not (before.is_dir and entry.is_dir):
+                    changes.append(('modify', entry))  # a folder's own mtime is not shown
+            for name, entry in folder.entries.items():
+                if name not in entries:
+                    changes.append(('remove', entry))
+        with self._lock:
+            folder.entries = entries
+            for kind, entry in changes:
+                folder.seq += 1
+                event = (f"{folder.token}-{folder.seq}", kind, entry)
+                folder.history.append((folder.seq, event))
+                for subscription in folder.subscribers:
+                    subscription.put(event)
+
+
+class ResponseWriter:
+    """File-like writer for a response body of unknown length.
+
+    Small writes are gathered into blocks; each block goes out as one
+    HTTP/1.1 chunk, or as is for HTTP/1.0 clients, whose body ends when
+    the connection is closed. ``close()`` ends the body. With a
+    ``transfer``, each block waits for its turn with the scheduler.
+    """
+
+    def __init__(self, wfile, chunked, block_size=DOWNLOAD_CHUNK_SIZE, transfer=None):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.block_size = block_size
+        self.transfer = transfer
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        if len(data) >= self.block_size:
+            self.flush()
+            self._send(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) >= self.block_size:
+                self.flush()
+        return len(data)
+
+    def _send(self, data):
+        if self.transfer is not None:
+            self.transfer.consume(len(data))
+        if self.chunked:
+            # One write per chunk: small separate writes stall on Nagle + delayed ACK
+            self.wfile.write(b'%x\r\n%b\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if self.buffer:
+            self._send(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+class TokenBucket:
+    """``rate`` bytes per second, holding at most ``capacity``; may go into debt"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until the bucket has tokens again (0 if it has some now)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens > 0 else -self.tokens / self.rate
+
+
+class Transfer:
+    """One upload or download body taking turns with its scheduler.
+
+    Bodies too small to be worth shaping pass straight through: acquire()
+    grants whatever is asked.
+    """
+
+    def __init__(self, scheduler, client, shaped):
+        self.scheduler = scheduler
+        self.client = client
+        self.shaped = shaped
+        self.waited = 0.0  # seconds spent waiting for a turn
+
+    def acquire(self, want):
+        """Wait for a turn; returns how many of ``want`` bytes may move now"""
+        return self.scheduler.acquire(self, want) if self.shaped else want
+
+    def consume(self, size):
+        """Wait until ``size`` bytes may move"""
+        while size > 0:
+            size -= self.acquire(size)
+
+
+class ShapedReader:
+    """Read side of a connection that takes its turn before each read"""
+
+    def __init__(self, rfile, transfer):
+        self.rfile = rfile
+        self.transfer = transfer
+
+    def read(self, n):
+        return self.rfile.read(self.transfer.acquire(n))
+
+
+class TransferScheduler:
+    """Shares one direction's bandwidth (uploads or downloads) between bulk transfers.
+
+    A global token bucket and one per client cap the rate. Waiting
+    transfers take turns, deficit round-robin with a fixed quantum: the
+    first one in line whose client still has tokens may move up to
+    ``quantum`` bytes, then goes to the back of the line when it asks
+    again. Every transfer gets an equal share and no client gets more
+    than its own rate, however many transfers it opens. A grant may
+    take a bucket into debt, which the following turns wait off.
+    """
+
+    def __init__(self, rate=0, client_rate=0, quantum=SHAPING_QUANTUM):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.quantum = quantum
+        self._bucket = TokenBucket(rate, max(rate * SHAPING_BURST, quantum)) if rate else None
+        self._clients = {}   # address -> TokenBucket, dropped once full again
+        self._waiting = []   # transfers in line for a turn, oldest first
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.client_rate)
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def transfer(self, client, size):
+        """A Transfer for a body of ``size`` bytes from or to ``client``.
+
+        Bodies under SHAPING_MIN_SIZE (listings, small files) skip the
+        line entirely, so they stay fast while bulk transfers are queued.
+        """
+        return Transfer(self, client, self.enabled and size >= SHAPING_MIN_SIZE)
+
+    def _client_delay(self, transfer, now):
+        if not self.client_rate:
+            return 0.0
+        bucket = self._clients.get(transfer.client)
+        if bucket is None:
+            capacity = max(self.client_rate * SHAPING_BURST, self.quantum)
+            bucket = self._clients[transfer.client] = TokenBucket(self.client_rate, capacity)
+        return bucket.delay(now)
+
+    def acquire(self, transfer, want):
+        """Block until ``transfer`` has its turn; returns the bytes it may move"""
+        want = min(want, self.quantum)
+        started = time.monotonic()
+        with self._cond:
+            self._waiting.append(transfer)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._bucket.delay(now) if self._bucket is not None else 0.0
+                    first = next((t for t in self._waiting if not self._client_delay(t, now)), None)
+                    if first is transfer and not delay:
+                        break
+                    if first is None or first is transfer:
+                        delay = max(delay, self._client_delay(transfer, now))
+                    elif not delay:
+                        delay = 0.05  # the one ahead goes now and wakes us
+                    self._cond.wait(min(max(delay, 0.001), 1.0))
+                if self._bucket is not None:
+                    self._bucket.tokens -= want
+                if self.client_rate:
+                    self._clients[transfer.client].tokens -= want
+                    # A full bucket is the same as a new one
+                    for client, bucket in list(self._clients.items()):
+                        if not bucket.delay(now) and bucket.tokens >= bucket.capacity:
+                            del self._clients[client]
+            finally:
+                self._waiting.remove(transfer)
+                self._cond.notify_all()
+        transfer.waited += time.monotonic() - started
+        return want
+
+
+DOWNLOAD_SCHEDULER = TransferScheduler()
+UPLOAD_SCHEDULER = TransferScheduler()
+
+
+class Metrics:
+    """Counters and histograms served at INTERNAL_PREFIX + 'metrics'.
+
+    Each thread records into a dict of its own, so the request path takes
+    no lock; a scrape adds those dicts up. Samples are keyed by metric
+    name and a tuple of (label, value) pairs; a histogram is a list of
+    per-bucket counts (the last bucket is +Inf) followed by the sum.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    def render(self, gauges=()):
+        """Prometheus text format of everything recorded, plus (name, labels, value) ``gauges``"""
+        totals = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in shard.copy().items():  # copy() is atomic under the GIL
+                if isinstance(value, list):
+                    merged = totals.get(key)
+                    totals[key] = list(value) if merged is None else [a + b for a, b in zip(merged, value)]
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        for name, labels, value in gauges:
+            totals[(name, labels)] = value
+        
+        by_name = collections.defaultdict(list)
+        for (name, labels), value in totals.items():
+            by_name[name].append((labels, value))
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name.get(name, ()), key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                count = 0
+                for bound, n in zip(self.buckets + ('+Inf',), value):
+                    count += n
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-1]:.6f}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+METRIC_HELP = {
+    'fileshare_requests_total':
+        ('counter', 'Requests answered, by route and status code'),
+    'fileshare_request_duration_seconds':
+        ('histogram', 'Time from request line to last byte written, by route; status >= 400 is route="error"'),
+    'fileshare_phase_seconds':
+        ('histogram', 'Time a request spent stating and scanning folders (scan), rendering HTML '
+                      '(render), compressing (compress), reading files (read), writing to the '
+                      'socket (write), in sendfile (disk and socket together) and waiting '
+                      'for its turn under bandwidth limits (throttle)'),
+    'fileshare_sent_bytes_total':
+        ('counter', 'Response bytes written including headers, by route'),
+    'fileshare_received_bytes_total':
+        ('counter', 'Request body bytes announced by Content-Length, by route'),
+    'fileshare_upload_bytes_total':
+        ('counter', 'Uploaded bytes written to disk'),
+    'fileshare_upload_seconds_total':
+        ('counter', 'Time spent receiving upload bodies; upload bytes over this is the throughput'),
+    'fileshare_uploads_total':
+        ('counter', 'Files uploaded, by result (saved, or duplicate of the file already there)'),
+    'fileshare_rejected_connections_total':
+        ('counter', 'Connections turned away with 503 because the server was full'),
+    'fileshare_connections':
+        ('gauge', 'Client connections open or waiting for a worker'),
+    'fileshare_shaped_transfers_waiting':
+        ('gauge', 'Bulk transfers waiting for their turn under bandwidth limits, by direction'),
+    'fileshare_event_streams':
+        ('gauge', 'Open live-update streams'),
+    'fileshare_cache_hits_total':
+        ('counter', 'Lookups answered from a cache, by cache'),
+    'fileshare_cache_misses_total':
+        ('counter', 'Lookups a cache could not answer, by cache'),
+    'fileshare_listing_cache_bytes':
+        ('gauge', 'Estimated memory held by cached folder listings'),
+    'fileshare_hot_file_cache_bytes':
+        ('gauge', 'Memory held by small files served from RAM'),
+    'fileshare_search_index_entries':
+        ('gauge', 'Names in the search index'),
+    'fileshare_log_queued_lines':
+        ('gauge', 'Log lines waiting for the background writer, by log'),
+    'fileshare_log_dropped_lines_total':
+        ('counter', 'Log lines dropped because the writer fell behind, by log'),
+}
+
+# Route label of requests under INTERNAL_PREFIX, by first path segment
+METRIC_ROUTES = {
+    'static': 'static', 'thumbs': 'thumbnail', 'search': 'search', 'events': 'events',
+    'digests': 'digests', 'uploads': 'upload', 'metrics': 'metrics',
+}
+
+METRICS = Metrics()
+
+
+class MeteredWriter:
+    """Write side of a connection that counts the bytes and time spent writing"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        started = time.perf_counter()
+        written = self.raw.write(data)
+        self.seconds += time.perf_counter() - started
+        self.bytes += len(data)
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class LogWriter:
+    """Log lines written to the console or a file by a background thread.
+
+    ``write`` only puts the entry on a bounded queue, so a slow terminal,
+    pipe or disk never holds up a request: when the queue is full the
+    entry is dropped and counted, and the log says how many went missing.
+    The thread writes whatever has queued up in one go and formats
+    entries there, as text or JSON lines. A file is rotated to
+    ``path.1`` ... ``path.<backups>`` once it grows past ``max_bytes``.
+    """
+
+    def __init__(self, path='-', format='text', max_bytes=ACCESS_LOG_MAX_BYTES,
+                 backups=ACCESS_LOG_BACKUPS, queue_size=LOG_QUEUE_MAX):
+        self.path = path
+        self.format = format
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._size = 0
+        self._reported = 0
+        self._failed = False
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def write(self, entry):
+        """Queue a message (str) or access entry (dict) without ever blocking"""
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), entry))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self, timeout=2):
+        """Write out what is queued and stop the thread"""
+        thread = self._thread
+        if thread is None:
+            return
+        try:
+            self._queue.put((None, None), timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < LOG_BATCH:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [self._format(ts, entry) for ts, entry in items if entry is not None]
+            dropped = self.dropped
+            if dropped != self._reported:
+                lines.append(self._format(time.time(), f"⚠️  Log writer fell behind, "
+                                                       f"{dropped - self._reported} line(s) dropped"))
+                self._reported = dropped
+            if lines:
+                self._emit(('\n'.join(lines) + '\n').encode('utf-8', 'replace'))
+            if items[-1][1] is None:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread = None
+                return
+
+    def _format(self, ts, entry):
+        if self.format == 'json':
+            if isinstance(entry, str):
+                entry = {'message': entry}
+            stamp = datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='milliseconds')
+            return json.dumps({'ts': stamp, **entry}, ensure_ascii=False, separators=(',', ':'))
+        if isinstance(entry, str):
+            return entry
+        return (f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] {entry['client']} "
+                f"\"{entry['method']} {entry['path']}\" {entry['status']} {entry['bytes']} "
+                f"{entry['duration_ms']:.1f}ms")
+
+    def _emit(self, data):
+        if self.path == '-':
+            try:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            except (OSError, ValueError, AttributeError):
+                pass
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+                self._size = self._file.tell()
+            if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._failed = False
+        except OSError as e:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not self._failed:
+                print(f"⚠️  Cannot write log {self.path}: {e}", file=sys.stderr)
+                self._failed = True
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups:
+            for n in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{n}'):
+                    os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self._file = open(self.path, 'wb')
+        self._size = 0
+
+
+# Messages from request threads (uploads, ZIPs) and, by default, the access log
+CONSOLE = LogWriter()
+ACCESS_LOG = CONSOLE
+
+
+def log_request_error(client_address):
+    """Report the exception being handled for a request, through CONSOLE"""
+    CONSOLE.write(f"{'-' * 40}\nException occurred during processing of request from "
+                  f"{client_address}\n{traceback.format_exc().rstrip()}\n{'-' * 40}")
+
+
+class CompressionCache:
+    """Compressed copies of shared files, keyed by path, size, mtime and encoding.
+
+    Each variant is compressed once and kept in a DiskCache; concurrent
+    requests for a variant being built wait for it instead of compressing
+    it again. Files that don't shrink by at least 10% are remembered and
+    served uncompressed.
+    """
+
+    MAX_SKIPPED = 10000
+
+    def __init__(self, directory, max_bytes=COMPRESS_CACHE_MAX_BYTES):
+        self.disk = DiskCache(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._skipped = set()
+
+    def get(self, full_path, st, encoding, src):
+        """Path of the compressed variant of open file ``src``, or None to send it as is"""
+        key = f"{os.path.abspath(full_path)}\0{st.st_size}\0{st.st_mtime_ns}\0{encoding}"
+        if key in self._skipped:
+            return None
+        path = self.disk.lookup(key, '.' + encoding)
+        if path is not None:
+            self.hits += 1
+            return path
+        
+        with self._lock:
+            self.misses += 1
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            return None if key in self._skipped else self.disk.lookup(key, '.' + encoding)
+        
+        try:
+            def write(f):
+                compressor = COMPRESSORS[encoding]()
+                src.seek(0)
+                while True:
+                    chunk = src.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            path = self.disk.store(key, '.' + encoding, write)
+            if os.path.getsize(path) > st.st_size * 0.9:
+                os.unlink(path)
+                with self._lock:
+                    if len(self._skipped) >= self.MAX_SKIPPED:
+                        self._skipped.clear()
+                    self._skipped.add(key)
+                return None
+            return path
+        except OSError as e:
+            print(f"⚠️  Cannot cache compressed file: {full_path} ({e})")
+            return None
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+
+COMPRESS_CACHE = CompressionCache(os.path.join(CACHE_DIR, 'compressed'))
+
+
+class _Crc32:
+    """hashlib-style wrapper around zlib.crc32"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+def new_hashers(algorithms):
+    """Fresh hash objects by name (crc32 or any hashlib algorithm)"""
+    return {name: _Crc32() if name == 'crc32' else hashlib.new(name) for name in algorithms}
+
+
+class DigestCache:
+    """SHA-256 and BLAKE2b digests of shared files, keyed by device, inode, size and mtime.
+
+    Uploads are hashed as they stream in; other files only when an upload
+    preflight or a Want-Repr-Digest asks. The most recent ``max_entries``
+    digests are kept in memory and appended to a log, which is read back
+    (and compacted) on first use after a restart, so a version of a file
+    is read for hashing at most once. Each digest remembers its path,
+    which lets the preflight find copies among files of the same size.
+    """
+
+    def __init__(self, path, max_entries=DIGEST_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = None  # key -> (path, digests), loaded on first use
+        self._by_size = {}    # size -> paths hashed at that size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = set()
+
+    @staticmethod
+    def key(st):
+        return f'{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+    def _ensure_loaded(self):
+        """Read the log once; caller holds the lock"""
+        if self._entries is not None:
+            return
+        self._entries = collections.OrderedDict()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            lines = []
+        for line in lines:
+            try:
+                key, path, digests = json.loads(line)
+                self._add(key, path, int(key.split('-')[2], 16), digests)
+            except (ValueError, TypeError, IndexError):
+                continue  # torn last line after a crash
+        if len(lines) > 2 * len(self._entries) + 100:
+            self._rewrite()
+
+    def _add(self, key, path, size, digests):
+        self._entries[key] = (path, digests)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._by_size.setdefault(size, set()).add(path)
+        if len(self._by_size) > self.max_entries:
+            self._by_size = {}
+            for key, (path, _) in self._entries.items():
+                self._by_size.setdefault(int(key.split('-')[2], 16), set()).add(path)
+
+    def _rewrite(self):
+        """Replace the log with just the entries still remembered"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for key, (path, digests) in self._entries.items():
+                    f.write(json.dumps([key, path, digests]) + '\n')
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"⚠️  Cannot compact digest cache ({e})")
+
+    def lookup(self, st):
+        """Cached digests of a file in the state ``st`` describes, or None"""
+        key = self.key(st)
+        with self._lock:
+            self._ensure_loaded()
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def remember(self, path, st, digests):
+        """Record the digests of ``path`` as it is in ``st``"""
+        digests = {name: digests[name] for name in DIGEST_ALGORITHMS}
+        key = self.key(st)
+        with self._lock:
+            self._ensure_loaded()
+            self._add(key, path, st.st_size, digests)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps([key, path, digests]) + '\n')
+            except OSError:
+                pass  # still cached in memory
+        return digests
+
+    def compute(self, path):
+        """Digests of a file, from the cache or by reading it; None if unreadable"""
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    return None
+                digests = self.lookup(st)
+                if digests is not None:
+                    return digests
+                hashers = new_hashers(DIGEST_ALGORITHMS)
+                while True:
+                    chunk = f.read(DOWNLOAD_CHUNK_SIZE * 4)
+                    if not chunk:
+                        break
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                after = os.fstat(f.fileno())
+        except OSError:
+            return None
+        digests = {name: hasher.hexdigest() for name, hasher in hashers.items()}
+        if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            self.remember(path, st, digests)  # not when it changed while being read
+        return digests
+
+    def compute_later(self, path):
+        """Hash a file in the background so the next request finds its digest"""
+        with self._lock:
+            if path in self._pending or len(self._pending) >= DIGEST_QUEUE_MAX:
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='digest')
+            self._pending.add(path)
+        future = self._pool.submit(self.compute, path)
+        future.add_done_callback(lambda _: self._pending.discard(path))
+
+    def find(self, directory, size, algorithm, digest):
+        """(same-size files looked at, path of one with this digest or None, pending).
+
+        Looks in ``directory`` and at every shared file hashed before with
+        that size; without a digest only the candidates are counted. Like
+        digest_headers, only files up to DIGEST_INLINE_MAX are hashed
+        while the request waits: bigger unhashed candidates are queued
+        for the background and ``pending`` tells the client to ask again.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            paths = [p for p in self._by_size.get(size, ()) if p.startswith(SHARE_DIR + os.sep)]
+        try:
+            for entry in DIR_CACHE.get(directory).entries:
+                if not entry.is_dir and entry.size == size:
+                    paths.append(os.path.join(directory, entry.name))
+        except OSError:
+            pass
+        candidates = []
+        for path in dict.fromkeys(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size == size:
+                candidates.append((path, st))
+        candidates = candidates[:DIGEST_MAX_CANDIDATES]
+        pending = False
+        if digest:
+            for path, st in candidates:
+                if size <= DIGEST_INLINE_MAX:
+                    digests = self.compute(path)
+                else:
+                    digests = self.lookup(st)
+                    if digests is None:
+                        self.compute_later(path)
+                        pending = True
+                        continue
+                if digests is not None and digests.get(algorithm) == digest:
+                    return len(candidates), path, False
+        return len(candidates), None, pending
+
+    def is_copy(self, path, size, sha256):
+        """Whether ``path`` already holds exactly this content.
+
+        Files over DIGEST_INLINE_MAX are only compared by a cached digest,
+        never read while the upload waits; without one they count as
+        different and the conflict policy decides.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or st.st_size != size:
+            return False
+        digests = self.compute(path) if size <= DIGEST_INLINE_MAX else self.lookup(st)
+        return digests is not None and digests['sha256'] == sha256
+
+
+DIGESTS = DigestCache(os.path.join(CACHE_DIR, 'digests.log'))
+
+
+def has_thumbnail(name, size):
+    """Whether the listing should ask for a thumbnail of this file"""
+    if not THUMBNAILS_ENABLED or size > THUMB_MAX_SOURCE:
+        return False
+    return '.' in name and name.rsplit('.', 1)[-1].lower() in THUMB_EXTENSIONS
+
+
+class ThumbnailService:
+    """JPEG thumbnails of shared images, made by a small background pool.
+
+    Thumbnails are kept in a DiskCache keyed by path, size and mtime, so
+    an edited photo gets a new one and stale ones age out of the LRU.
+    Decoding never runs on a request thread: requests queue the work and
+    wait a bounded time for it. Images Pillow cannot read are remembered
+    and not tried again.
+    """
+
+    MAX_FAILED = 10000
+
+    def __init__(self, directory, max_bytes=THUMB_CACHE_MAX_BYTES, workers=THUMB_WORKERS):
+        self.disk = DiskCache(directory, max_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._failed = set()
+
+    def get(self, full_path, st, timeout=THUMB_WAIT):
+        """Path of the thumbnail of ``full_path``, or None if it can't have one.
+
+        Raises concurrent.futures.TimeoutError when the thumbnail is not
+        ready within ``timeout`` seconds or the queue is full; it keeps
+        being made in the background either way.
+        """
+        key = f"{os.path.abspath(full_path)}\0{st.st_size}\0{st.st_mtime_ns}\0{THUMB_SIZE}"
+        if key in self._failed:
+            return None
+        path = self.disk.lookup(key, '.jpg')
+        if path is not None:
+            self.hits += 1
+            return path
+        with self._lock:
+            self.misses += 1
+            future = self._pending.get(key)
+            if future is None:
+                if len(self._pending) >= THUMB_QUEUE_MAX:
+                    raise concurrent.futures.TimeoutError("Thumbnail queue is full")
+                future = self._pending[key] = self.pool.submit(self._make, key, full_path)
+        return future.result(timeout)
+
+    def _make(self, key, full_path):
+        try:
+            with Image.open(full_path) as img:
+                # JPEG can decode straight at a fraction of full size
+                img.draft('RGB', (THUMB_SIZE * 2, THUMB_SIZE * 2))
+                thumb = ImageOps.exif_transpose(img)
+                thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                if thumb.mode != 'RGB':
+                    thumb = thumb.convert('RGB')
+            return self.disk.store(key, '.jpg',
+                                   lambda f: thumb.save(f, 'JPEG', quality=THUMB_QUALITY))
+        except Exception as e:  # Pillow raises many kinds for bad or unsupported files
+            print(f"⚠️  No thumbnail for {full_path} ({e})")
+            with self._lock:
+                if len(self._failed) >= self.MAX_FAILED:
+                    self._failed.clear()
+                self._failed.add(key)
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+THUMBNAILS = ThumbnailService(os.path.join(CACHE_DIR, 'thumbnails')) if THUMBNAILS_ENABLED else None
+
+SEARCH_INDEX = SearchIndex(SHARE_DIR)
+
+CHANGE_FEED = ChangeFeed()
+
+
+class MultipartError(ValueError):
+    """Raised when an upload body is not valid multipart/form-data"""
+
+
+class MultipartReader:
+    """Incremental multipart/form-data parser.
+
+    Reads at most ``length`` bytes from ``rfile`` in fixed-size chunks and
+    never holds more than about two chunks in memory, however big the
+    upload. The delimiter is searched across chunk edges by keeping the
+    last ``len(delimiter) - 1`` bytes of each chunk for the next scan.
+    """
+
+    def __init__(self, rfile, boundary, length, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.rfile = rfile
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.delimiter = b'\r\n--' + boundary
+        # A leading CRLF lets the first boundary match like all the others
+        self.buffer = bytearray(b'\r\n')
+
+    def _fill(self):
+        """Append the next chunk of the body to the buffer"""
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Connection closed before the upload finished")
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _read_until_delimiter(self):
+        """Yield bytes up to the next delimiter and consume the delimiter"""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index != -1:
+                if index:
+                    yield self.buffer[:index]
+                del self.buffer[:index + len(self.delimiter)]
+                return
+            safe = len(self.buffer) - keep
+            if safe > 0:
+                yield self.buffer[:safe]
+                del self.buffer[:safe]
+            if not self._fill():
+                raise MultipartError("Missing closing boundary")
+
+    def _read_headers(self):
+        """Parse the header block that follows a boundary line"""
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end != -1:
+                break
+            if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                raise MultipartError("Part headers too large")
+            if not self._fill():
+                raise MultipartError("Truncated part headers")
+        # First line is whatever followed the boundary (usually nothing)
+        lines = bytes(self.buffer[:end]).split(b'\r\n')[1:]
+        del self.buffer[:end + 4]
+        headers = {}
+        for line in lines:
+            key, sep, value = line.decode('utf-8', errors='replace').partition(':')
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+        return headers
+
+    def parts(self):
+        """Yield ``(headers, chunks)`` for every part of the body.
+
+        ``chunks`` is an iterator over the part's content; whatever is left
+        unread is skipped before the next part is parsed.
+        """
+        for _ in self._read_until_delimiter():
+            pass  # preamble
+        while True:
+            while len(self.buffer) < 2:
+                if not self._fill():
+                    raise MultipartError("Truncated multipart body")
+            if self.buffer[:2] == b'--':
+                # Closing boundary: drain the epilogue so the connection stays usable
+                while self._fill():
+                    del self.buffer[:]
+                return
+            headers = self._read_headers()
+            chunks = self._read_until_delimiter()
+            yield headers, chunks
+            for _ in chunks:
+                pass
+
+
+def parse_content_disposition(value):
+    """Return (name, filename) from a form-data Content-Disposition header"""
+    msg = email.message.Message()
+    msg['Content-Disposition'] = value
+    name = msg.get_param('name', header='content-disposition')
+    filename = msg.get_filename()
+    if isinstance(name, tuple):
+        name = email.utils.collapse_rfc2231_value(name)
+    return name, filename
+
+
+def clean_upload_path(filename):
+    """Relative path to save an uploaded file under, or None if it is unusable.
+
+    Folder uploads name their files like "Trip/day 1/IMG_0001.jpg". Empty,
+    "." and ".." components are dropped so nothing lands outside the
+    target folder, and backslashes from Windows browsers separate too.
+    """
+    parts = [part for part in (filename or '').replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    if not parts:
+        return None
+    return os.path.join(*parts)
+
+
+def upload_target(directory, rel):
+    """Full path for upload ``rel`` in ``directory``, creating the folders it names.
+
+    Returns ``(target, grown)``; ``grown`` is the folder that got a new
+    subfolder, or None when every folder already existed.
+    """
+    target = os.path.join(directory, rel)
+    grown = None
+    folder = os.path.dirname(target)
+    while folder != directory and not os.path.isdir(folder):
+        grown = folder = os.path.dirname(folder)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return target, grown
+
+
+def free_upload_name(path):
+    """``path`` if it is unused, else the first free "name (n).ext" next to it"""
+    if not os.path.lexists(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    n = 1
+    while os.path.lexists(f'{stem} ({n}){ext}'):
+        n += 1
+    return f'{stem} ({n}){ext}'
+
+
+_PLACE_LOCK = threading.Lock()
+
+
+def place_upload(temp_path, target, size, digests, conflict):
+    """Move a finished, synced upload into place; returns ``(path, result)``.
+
+    ``result`` is "saved", "duplicate" when ``target`` already holds the
+    same bytes, or "skipped" when it holds other ones and ``conflict`` is
+    "skip"; then the temp file is dropped and ``path`` is the existing file.
+    With "rename" the upload takes the first free "name (n).ext" instead.
+    """
+    if DIGESTS.is_copy(target, size, digests['sha256']):
+        result = 'duplicate'
+    else:
+        with _PLACE_LOCK:
+            if conflict == 'skip' and os.path.lexists(target):
+                result = 'skipped'
+            else:
+                if conflict == 'rename':
+                    target = free_upload_name(target)
+                os.chmod(temp_path, 0o666 & ~_UMASK)
+                os.replace(temp_path, target)
+                result = 'saved'
+    if result == 'saved':
+        DIGESTS.remember(target, os.stat(target), digests)
+    else:
+        os.unlink(temp_path)
+    METRICS.inc('fileshare_uploads_total', (('result', result),))
+    return target, result
+
+
+def preallocate(fd, size):
+    """Reserve ``size`` bytes for a file, sparsely where the OS can't allocate"""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # Filesystems without fallocate support (EOPNOTSUPP, EINVAL, ...)
+    os.ftruncate(fd, size)
+
+
+def fsync_path(path):
+    """fsync a file, or a folder so that renames into it are durable"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # folders can't be fsync'ed everywhere
+    finally:
+        os.close(fd)
+
+
+class UploadFile:
+    """A file that UploadWriter writes to; ``write`` queues, ``settle`` waits.
+
+    Small writes are gathered until there is a chunk's worth, so a small
+    file costs the writer threads one job, made when its batch is synced.
+    ``offset`` is the end of everything written so far. When a queued
+    write fails its error is kept in ``error`` and raised by the next
+    ``write``.
+    """
+
+    def __init__(self, writer, fd, path, offset=0, allocated=0):
+        self.writer = writer
+        self.fd = fd
+        self.path = path
+        self.offset = offset
+        self.allocated = allocated
+        self.error = None
+        self.failed_at = None
+        self.pending = 0
+        self.idle = threading.Condition()
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.offset += len(data)
+        if self._buffered >= UPLOAD_CHUNK_SIZE:
+            self.writer.submit(self, *self.take_buffer())
+
+    def take_buffer(self):
+        """The gathered bytes and their offset, handed over by the caller"""
+        data = self._buffer[0] if len(self._buffer) == 1 else b''.join(self._buffer)
+        position = self.offset - self._buffered
+        self._buffer = []
+        self._buffered = 0
+        return data, position
+
+    def settle(self, flush=True):
+        """Wait for the queued writes; returns the offset all bytes before which are on disk"""
+        if flush and self._buffered:
+            self.writer.submit(self, *self.take_buffer())
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        if self.failed_at is not None:
+            return self.failed_at
+        return self.offset - self._buffered
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def discard(self):
+        """Close and delete a file that will not be kept"""
+        self.settle(flush=False)
+        self.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class UploadWriter:
+    """Threads that put uploaded bytes on disk for the request threads.
+
+    A request thread reads and hashes an upload and hands the data to
+    ``UploadFile.write``, which returns at once unless ``queue_size`` writes
+    are already waiting: a slow disk then slows the upload down instead of
+    filling memory, but socket reads never wait on a single write. Data
+    goes out with pwrite at its own offset, so any thread can take any
+    write. ``sync`` finishes a batch of files and fsyncs them in parallel.
+    """
+
+    def __init__(self, workers=UPLOAD_WRITERS, queue_size=UPLOAD_WRITE_QUEUE):
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-writer')
+
+    def create(self, directory, size=None):
+        """New temp file in ``directory``, preallocated when its size is known"""
+        fd, path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=directory)
+        try:
+            if size:
+                preallocate(fd, size)
+        except BaseException:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        return UploadFile(self, fd, path, allocated=size or 0)
+
+    def open(self, path, offset):
+        """Write into an existing file, starting at ``offset``"""
+        return UploadFile(self, os.open(path, os.O_WRONLY), path, offset)
+
+    def submit(self, upload_file, data, offset):
+        self._slots.acquire()
+        with upload_file.idle:
+            upload_file.pending += 1
+        self._pool.submit(self._write, upload_file, data, offset)
+
+    @staticmethod
+    def _pwrite(fd, data, position):
+        """Write all of ``data`` at ``position``; returns the end, or raises with it in ``e.position``"""
+        view = memoryview(data)
+        try:
+            while view:
+                written = os.pwrite(fd, view, position)
+                view = view[written:]
+                position += written
+        except OSError as e:
+            e.position = position
+            raise
+        return position
+
+    def _write(self, upload_file, data, offset):
+        try:
+            self._pwrite(upload_file.fd, data, offset)
+        except OSError as e:
+            with upload_file.idle:
+                upload_file.error = upload_file.error or e
+                if upload_file.failed_at is None or e.position < upload_file.failed_at:
+                    upload_file.failed_at = e.position
+        finally:
+            self._slots.release()
+            with upload_file.idle:
+                upload_file.pending -= 1
+                if not upload_file.pending:
+                    upload_file.idle.notify_all()
+
+    def _finish(self, upload_file):
+        data, position = upload_file.take_buffer()
+        if data:
+            self._pwrite(upload_file.fd, data, position)
+        if upload_file.allocated > upload_file.offset:
+            os.ftruncate(upload_file.fd, upload_file.offset)
+        os.fsync(upload_file.fd)
+
+    def sync(self, files):
+        """Finish a batch of files: write what they still hold, trim
+        preallocated space they did not use, fsync them all at once and
+        close them"""
+        for upload_file in files:
+            upload_file.settle(flush=False)
+            if upload_file.error is not None:
+                raise upload_file.error
+        for _ in self._pool.map(self._finish, files):
+            pass
+        for upload_file in files:
+            upload_file.close()
+
+
+class UploadError(Exception):
+    """A resumable upload request that cannot be honoured, with its HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResumableUpload:
+    """One upload in progress: a preallocated ``.upload-<id>.part`` file next
+    to its target and the byte ranges received so far.
+
+    Chunks may arrive in any order and several at once; each is written
+    with pwrite at its own offset, so no chunk waits for another.
+    """
+
+    def __init__(self, upload_id, directory, name, size, ranges=(), updated=None,
+                 conflict=None):
+        self.id = upload_id
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self.conflict = conflict or UPLOAD_CONFLICT
+        self.ranges = [list(r) for r in ranges]  # sorted, merged [start, end)
+        self.updated = updated or time.time()
+        self.finishing = False
+        self.lock = threading.Lock()
+        # Digests of the gap-free prefix; not saved, so a restart hashes again from 0
+        self.hashers = new_hashers(UPLOAD_CHECKSUMS)
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+
+    @property
+    def part_path(self):
+        return os.path.join(self.directory, f'.upload-{self.id}.part')
+
+    @property
+    def offset(self):
+        """End of the data received without gaps from the start of the file"""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def add_range(self, start, end):
+        """Record bytes [start, end) as received, merging touching ranges"""
+        if start >= end:
+            return
+        merged = []
+        for lo, hi in self.ranges:
+            if hi < start or lo > end:
+                merged.append([lo, hi])
+            else:
+                start, end = min(lo, start), max(hi, end)
+        merged.append([start, end])
+        merged.sort()
+        self.ranges = merged
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.size,
+            'offset': self.offset,
+            'ranges': self.ranges,
+            'part_size': UPLOAD_PART_SIZE,
+            'url': f'{INTERNAL_PREFIX}uploads/{self.id}',
+        }
+
+
+class UploadManager:
+    """Registry of resumable uploads.
+
+    The state of each upload is also written to ``state_dir`` after every
+    chunk, so an upload can still be resumed after the server restarts.
+    Uploads idle for longer than UPLOAD_EXPIRY are deleted.
+    """
+
+    def __init__(self, state_dir, expiry=UPLOAD_EXPIRY):
+        self.state_dir = state_dir
+        self.expiry = expiry
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.state_dir, upload_id + '.json')
+
+    def _save(self, upload):
+        state = {
+            'directory': upload.directory,
+            'name': upload.name,
+            'size': upload.size,
+            'ranges': upload.ranges,
+            'updated': upload.updated,
+            'conflict': upload.conflict,
+        }
+        os.makedirs(self.state_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.state_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self._state_path(upload.id))
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def _load(self, upload_id):
+        try:
+            with open(self._state_path(upload_id)) as f:
+                state = json.load(f)
+            upload = ResumableUpload(upload_id, state['directory'], state['name'],
+                                     state['size'], state['ranges'], state['updated'],
+                                     state.get('conflict', UPLOAD_CONFLICT))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not os.path.isfile(upload.part_path):
+            return None
+        return upload
+
+    def _forget(self, upload):
+        with self._lock:
+            self._uploads.pop(upload.id, None)
+        for path in (upload.part_path, self._state_path(upload.id)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def create(self, directory, name, size, conflict=None):
+        """Start an upload of ``size`` bytes that will become ``directory/name``"""
+        self.expire()
+        conflict = conflict or UPLOAD_CONFLICT
+        if conflict == 'skip' and os.path.lexists(os.path.join(directory, name)):
+            raise UploadError(409, f"File already exists: {name}")
+        upload = ResumableUpload(secrets.token_hex(16), directory, name, size, conflict=conflict)
+        try:
+            fd = os.open(upload.part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except PermissionError:
+            raise UploadError(403, f"Cannot save file: {name}")
+        try:
+            preallocate(fd, size)
+        except OSError as e:
+            os.close(fd)
+            os.unlink(upload.part_path)
+            if e.errno == errno.ENOSPC:
+                raise UploadError(507, "Not enough disk space")
+            raise
+        os.close(fd)
+        self._save(upload)
+        with self._lock:
+            self._uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """The upload with this id, or None"""
+        if len(upload_id) != 32 or not all(c in string.hexdigits for c in upload_id):
+            return None
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                upload = self._load(upload_id)
+                if upload is not None:
+                    self._uploads[upload_id] = upload
+            return upload
+
+    def write(self, upload, offset, length, read):
+        """Write ``length`` bytes at ``offset``, taking them from ``read(n)``"""
+        if upload.finishing:
+            raise UploadError(409, "Upload is being finalized")
+        if offset < 0 or offset + length > upload.size:
+            raise UploadError(416, "Chunk outside of the file")
+        if length > MAX_UPLOAD_PART_SIZE:
+            raise UploadError(413, "Chunk too large")
+        out = UPLOAD_WRITER.open(upload.part_path, offset)
+        try:
+            while out.offset < offset + length:
+                data = read(min(UPLOAD_CHUNK_SIZE, offset + length - out.offset))
+                if not data:
+                    raise ConnectionResetError("Connection closed before the chunk finished")
+                out.write(data)
+        finally:
+            position = out.settle()
+            out.close()
+            # Whatever made it to disk counts, so a retry can skip it
+            with upload.lock:
+                upload.add_range(offset, position)
+                upload.updated = time.time()
+                self._save(upload)
+        if out.error is not None:
+            raise out.error
+        self._hash_prefix(upload)
+
+    def _hash_prefix(self, upload):
+        """Feed the bytes now received without gaps to the upload's hashers.
+
+        Chunks arrive out of order, so hashing follows the gap-free prefix
+        and reads back what was just written, still in the page cache. A
+        thread that finds another one hashing leaves its bytes to it.
+        """
+        while upload.hashed < upload.offset:
+            if not upload.hash_lock.acquire(blocking=False):
+                return
+            try:
+                with open(upload.part_path, 'rb') as f:
+                    f.seek(upload.hashed)
+                    while upload.hashed < upload.offset:
+                        chunk = f.read(min(DOWNLOAD_CHUNK_SIZE * 4, upload.offset - upload.hashed))
+                        if not chunk:
+                            return
+                        for hasher in upload.hashers.values():
+                            hasher.update(chunk)
+                        upload.hashed += len(chunk)
+            except OSError:
+                return  # finish() reads the whole file instead
+            finally:
+                upload.hash_lock.release()
+
+    def finish(self, upload, checksums):
+        """Verify the assembled file and move it into place; returns place_upload's ``(path, result)``"""
+        with upload.lock:
+            if upload.finishing:
+                raise UploadError(409, "Upload is being finalized")
+            if not upload.complete:
+                raise UploadError(409, f"Upload incomplete: {upload.offset} of {upload.size} bytes")
+            upload.finishing = True
+        try:
+            with upload.hash_lock:
+                if upload.hashed == upload.size:
+                    actual = {name: h.hexdigest() for name, h in upload.hashers.items()}
+                else:
+                    actual = file_checksums(upload.part_path, UPLOAD_CHECKSUMS)
+            for algorithm, expected in checksums.items():
+                if actual[algorithm] != expected.lower():
+                    self._forget(upload)
+                    raise UploadError(422, f"{algorithm} mismatch, upload discarded")
+            fsync_path(upload.part_path)
+            target, result = place_upload(upload.part_path, os.path.join(upload.directory, upload.name),
+                                          upload.size, actual, upload.conflict)
+            if result == 'saved':
+                fsync_path(upload.directory)
+            elif result == 'duplicate':
+                CONSOLE.write(f"⏭️  {upload.name} is already shared, kept the existing copy")
+            else:
+                CONSOLE.write(f"⏭️  {upload.name} already exists, upload skipped")
+        except BaseException:
+            upload.finishing = False
+            raise
+        self._forget(upload)
+        return target, result
+
+    def abort(self, upload):
+        self._forget(upload)
+
+    def expire(self):
+        """Delete uploads nobody has touched for ``expiry`` seconds"""
+        cutoff = time.time() - self.expiry
+        try:
+            names = os.listdir(self.state_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            upload = self.get(name[:-len('.json')])
+            if upload is not None and upload.updated < cutoff and not upload.finishing:
+                self._forget(upload)
+
+
+def file_checksums(path, algorithms):
+    """Hex digests of a file for each of ``algorithms`` (see UPLOAD_CHECKSUMS)"""
+    hashers = new_hashers(algorithms)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE * 4)
+            if not chunk:
+                break
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+UPLOADS = UploadManager(os.path.join(CACHE_DIR, 'uploads'))
+
+UPLOAD_WRITER = UploadWriter()
+
+
+# ---------------------------------------------------------------------------
+# Giao diện: templates are parsed once at import, static files are served
+# from versioned URLs so browsers cache them for good
+# ---------------------------------------------------------------------------
+
+PAGE_CSS = '''\
+* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+
+:root {
+    --bg-gradient-1: #1a1a2e;
+    --bg-gradient-2: #16213e;
+    --bg-gradient-3: #0f3460;
+    --card-bg: rgba(255, 255, 255, 0.08);
+    --card-border: rgba(255, 255, 255, 0.12);
+    --text-primary: #ffffff;
+    --text-secondary: rgba(255, 255, 255, 0.7);
+    --accent: #e94560;
+    --accent-glow: rgba(233, 69, 96, 0.4);
+    --success: #00d9a5;
+    --folder-color: #ffd93d;
+}
+
+body {
+    font-family: 'SF Pro Display', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+    background: linear-gradient(135deg, var(--bg-gradient-1) 0%, var(--bg-gradient-2) 50%, var(--bg-gradient-3) 100%);
+    min-height: 100vh;
+    color: var(--text-primary);
+    padding: 20px;
+    padding-bottom: 100px;
+}
+
+/* Animated background */
+body::before {
+    content: '';
+    position: fixed;
+    top: 0;
+    left: 0;
+    right: 0;
+    bottom: 0;
+    background: 
+        radial-gradient(circle at 20% 80%, rgba(233, 69, 96, 0.15) 0%, transparent 50%),
+        radial-gradient(circle at 80% 20%, rgba(0, 217, 165, 0.1) 0%, transparent 50%),
+        radial-gradient(circle at 40% 40%, rgba(255, 217, 61, 0.08) 0%, transparent 40%);
+    pointer-events: none;
+    z-index: -1;
+}
+
+.container {
+    max-width: 800px;
+    margin: 0 auto;
+}
+
+/* Header */
+.header {
+    text-align: center;
+    padding: 30px 20px;
+    margin-bottom: 30px;
+    background: var(--card-bg);
+    border-radius: 24px;
+    border: 1px solid var(--card-border);
+    backdrop-filter: blur(20px);
+    -webkit-backdrop-filter: blur(20px);
+}
+
+.header h1 {
+    font-size: 2.2em;
+    font-weight: 700;
+    margin-bottom: 10px;
+    background: linear-gradient(135deg, #fff 0%, #e94560 100%);
+    -webkit-background-clip: text;
+    -webkit-text-fill-color: transparent;
+    background-clip: text;
+}
+
+.header p {
+    color: var(--text-secondary);
+    font-size: 1em;
+}
+
+.server-info {
+    margin-top: 20px;
+    padding: 15px;
+    background: rgba(0, 217, 165, 0.1);
+    border-radius: 12px;
+    border: 1px solid rgba(0, 217, 165, 0.3);
+}
+
+.server-info code {
+    font-family: 'SF Mono', Monaco, monospace;
+    font-size: 1.1em;
+    color: var(--success);
+    font-weight: 600;
+}
+
+/* Breadcrumb */
+.breadcrumb {
+    display: flex;
+    align-items: center;
+    flex-wrap: wrap;
+    gap: 8px;
+    padding: 15px 20px;
+    background: var(--card-bg);
+    border-radius: 16px;
+    margin-bottom: 20px;
+    border: 1px solid var(--card-border);
+}
+
+.breadcrumb a {
+    color: var(--accent);
+    text-decoration: none;
+    font-weight: 500;
+    transition: all 0.2s;
+}
+
+.breadcrumb a:hover {
+    text-shadow: 0 0 10px var(--accent-glow);
+}
+
+.breadcrumb .current-path {
+    color: var(--text-primary);
+    font-weight: 600;
+    text-decoration: none;
+}
+
+.breadcrumb span {
+    color: var(--text-secondary);
+}
+
+.breadcrumb .zip-link {
+    margin-left: auto;
+    font-size: 0.9em;
+}
+
+/* Search */
+.search-form {
+    margin-bottom: 20px;
+}
+
+.search-form input {
+    width: 100%;
+    padding: 14px 20px;
+    background: var(--card-bg);
+    border: 1px solid var(--card-border);
+    border-radius: 16px;
+    color: var(--text-primary);
+    font-size: 1em;
+}
+
+.search-form input:focus {
+    outline: none;
+    border-color: var(--accent);
+}
+
+.search-note {
+    padding: 15px 20px;
+    text-align: center;
+    color: var(--text-secondary);
+    font-size: 0.9em;
+}
+
+/* File List */
+.file-list {
+    background: var(--card-bg);
+    border-radius: 20px;
+    border: 1px solid var(--card-border);
+    overflow: hidden;
+    backdrop-filter: blur(20px);
+    -webkit-backdrop-filter: blur(20px);
+}
+
+.file-item {
+    display: flex;
+    align-items: center;
+    padding: 16px 20px;
+    border-bottom: 1px solid var(--card-border);
+    transition: all 0.3s ease;
+    text-decoration: none;
+    color: inherit;
+}
+
+.file-item:last-child {
+    border-bottom: none;
+}
+
+.file-item:hover {
+    background: rgba(255, 255, 255, 0.1);
+    transform: translateX(5px);
+}
+
+.file-item:active {
+    transform: scale(0.98);
+}
+
+.file-icon {
+    font-size: 2em;
+    margin-right: 15px;
+    min-width: 45px;
+    text-align: center;
+}
+
+.file-icon img.thumb {
+    display: block;
+    width: 45px;
+    height: 45px;
+    object-fit: cover;
+    border-radius: 8px;
+}
+
+.file-info {
+    flex: 1;
+    min-width: 0;
+}
+
+.file-name {
+    font-weight: 600;
+    font-size: 1.05em;
+    white-space: nowrap;
+    overflow: hidden;
+    text-overflow: ellipsis;
+    margin-bottom: 4px;
+}
+
+.file-meta {
+    font-size: 0.85em;
+    color: var(--text-secondary);
+}
+
+.file-action {
+    padding: 10px 18px;
+    background: linear-gradient(135deg, var(--accent), #ff6b6b);
+    color: white;
+    border-radius: 25px;
+    font-size: 0.85em;
+    font-weight: 600;
+    box-shadow: 0 4px 15px var(--accent-glow);
+    transition: all 0.3s;
+}
+
+.file-item:hover .file-action {
+    transform: scale(1.05);
+    box-shadow: 0 6px 20px var(--accent-glow);
+}
+
+.folder-icon {
+    color: var(--folder-color);
+}
+
+.load-more {
+    justify-content: center;
+    color: var(--text-secondary);
+}
+
+/* Upload Section */
+.upload-section {
+    margin-top: 30px;
+    padding: 30px;
+    background: var(--card-bg);
+    border-radius: 20px;
+    border: 2px dashed var(--card-border);
+    text-align: center;
+    transition: all 0.3s;
+}
+
+.upload-section:hover {
+    border-color: var(--accent);
+    background: rgba(233, 69, 96, 0.05);
+}
+
+.upload-section h3 {
+    margin-bottom: 15px;
+    font-size: 1.3em;
+}
+
+.upload-form {
+    display: flex;
+    flex-direction: column;
+    align-items: center;
+    gap: 15px;
+}
+
+.file-pickers {
+    display: flex;
+    flex-wrap: wrap;
+    justify-content: center;
+    gap: 12px;
+}
+
+.file-input-wrapper {
+    position: relative;
+    overflow: hidden;
+    display: inline-block;
+}
+
+.file-input-wrapper input[type=file] {
+    font-size: 100px;
+    position: absolute;
+    left: 0;
+    top: 0;
+    opacity: 0;
+    cursor: pointer;
+}
+
+.file-input-btn {
+    padding: 15px 30px;
+    background: linear-gradient(135deg, #667eea, #764ba2);
+    color: white;
+    border-radius: 30px;
+    font-size: 1em;
+    font-weight: 600;
+    cursor: pointer;
+    box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
+    transition: all 0.3s;
+}
+
+.file-input-btn:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 6px 20px rgba(102, 126, 234, 0.5);
+}
+
+.upload-btn {
+    padding: 15px 40px;
+    background: linear-gradient(135deg, var(--success), #00b894);
+    color: white;
+    border: none;
+    border-radius: 30px;
+    font-size: 1em;
+    font-weight: 600;
+    cursor: pointer;
+    box-shadow: 0 4px 15px rgba(0, 217, 165, 0.4);
+    transition: all 0.3s;
+}
+
+.upload-btn:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 6px 20px rgba(0, 217, 165, 0.5);
+}
+
+#file-name-display {
+    color: var(--text-secondary);
+    font-size: 0.9em;
+}
+
+/* Empty State */
+.empty-state {
+    text-align: center;
+    padding: 60px 20px;
+    color: var(--text-secondary);
+}
+
+.empty-state .icon {
+    font-size: 4em;
+    margin-bottom: 20px;
+    opacity: 0.5;
+}
+
+/* Footer */
+.footer {
+    text-align: center;
+    margin-top: 40px;
+    padding: 20px;
+    color: var(--text-secondary);
+    font-size: 0.9em;
+}
+
+/* Animations */
+@keyframes fadeIn {
+    from { opacity: 0; transform: translateY(20px); }
+    to { opacity: 1; transform: translateY(0); }
+}
+
+.file-item {
+    animation: fadeIn 0.4s ease forwards;
+}
+
+.file-item:nth-child(1) { animation-delay: 0.05s; }
+.file-item:nth-child(2) { animation-delay: 0.1s; }
+.file-item:nth-child(3) { animation-delay: 0.15s; }
+.file-item:nth-child(4) { animation-delay: 0.2s; }
+.file-item:nth-child(5) { animation-delay: 0.25s; }
+
+/* Responsive */
+@media (max-width: 600px) {
+    body {
+        padding: 15px;
+    }
+
+    .header h1 {
+        font-size: 1.8em;
+    }
+
+    .file-action {
+        padding: 8px 14px;
+        font-size: 0.8em;
+    }
+}
+'''
+
+PAGE_JS = '''\
+function selectedFiles() {
+    const files = [];
+    document.querySelectorAll('.upload-form input[type=file]').forEach(function(input) {
+        Array.prototype.push.apply(files, input.files);
+    });
+    return files;
+}
+
+function updateFileName(input) {
+    const display = document.getElementById('file-name-display');
+    const files = selectedFiles();
+    if (files.length > 0) {
+        display.textContent = files.length === 1 ? '📄 ' + files[0].name : '📄 ' + files.length + ' file';
+        display.style.color = '#00d9a5';
+    } else {
+        display.textContent = 'Chưa chọn file nào';
+        display.style.color = 'rgba(255, 255, 255, 0.7)';
+    }
+}
+
+// Ảnh thu nhỏ: chỉ tải cho các dòng sắp hiện trên màn hình
+const loadThumbnails = (function() {
+    if (!('IntersectionObserver' in window) || !window.fetch || !window.URL) {
+        return function() {};
+    }
+    const RETRIES = 5;
+
+    function load(icon, url, tries) {
+        fetch(url).then(function(resp) {
+            if (resp.status === 503 && tries > 0) {
+                // Server is still making it
+                setTimeout(function() {
+                    load(icon, url, tries - 1);
+                }, 1000);
+                return;
+            }
+            if (!resp.ok) {
+                return;  // giữ icon emoji
+            }
+            return resp.blob().then(function(blob) {
+                const img = document.createElement('img');
+                img.className = 'thumb';
+                img.alt = '';
+                img.onload = function() {
+                    URL.revokeObjectURL(img.src);
+                };
+                img.src = URL.createObjectURL(blob);
+                icon.textContent = '';
+                icon.appendChild(img);
+            });
+        }).catch(function() {});
+    }
+
+    const observer = new IntersectionObserver(function(items) {
+        items.forEach(function(item) {
+            if (item.isIntersecting) {
+                observer.unobserve(item.target);
+                load(item.target, item.target.getAttribute('data-thumb-url'), RETRIES);
+            }
+        });
+    }, { rootMargin: '200px' });
+
+    return function(root) {
+        root.querySelectorAll('.file-icon[data-thumb]').forEach(function(icon) {
+            // Rename the attribute so rows are only observed once
+            icon.setAttribute('data-thumb-url', icon.getAttribute('data-thumb'));
+            icon.removeAttribute('data-thumb');
+            observer.observe(icon);
+        });
+    };
+})();
+loadThumbnails(document);
+
+// Tải trang tiếp theo khi cuộn gần tới cuối danh sách
+(function() {
+    const more = document.getElementById('load-more');
+    if (!more || !('IntersectionObserver' in window) || !window.fetch) {
+        return;
+    }
+    let loading = false;
+    const observer = new IntersectionObserver(function(items) {
+        if (!items[0].isIntersecting || loading) {
+            return;
+        }
+        loading = true;
+        fetch(more.getAttribute('href') + '&partial=1').then(function(resp) {
+            if (!resp.ok) {
+                throw new Error(resp.status);
+            }
+            const next = resp.headers.get('X-Next-Page');
+            return resp.text().then(function(rows) {
+                more.insertAdjacentHTML('beforebegin', rows);
+                loadThumbnails(more.parentNode);
+                loading = false;
+                if (next) {
+                    more.setAttribute('href', next);
+                    // Re-check: the link may still be on screen
+                    observer.unobserve(more);
+                    observer.observe(more);
+                } else {
+                    observer.disconnect();
+                    more.remove();
+                }
+            });
+        }).catch(function() {
+            loading = false;
+        });
+    }, { rootMargin: '800px' });
+    observer.observe(more);
+})();
+
+// Tìm theo tên trong thư mục này và mọi thư mục con
+(function() {
+    const form = document.querySelector('.search-form');
+    const list = document.querySelector('.file-list');
+    if (!form || !list || !window.fetch) {
+        return;
+    }
+    const input = form.querySelector('input');
+    const results = document.createElement('div');
+    results.className = 'file-list';
+    results.hidden = true;
+    list.parentNode.insertBefore(results, list);
+    form.hidden = false;
+    const folder = decodeURIComponent(location.pathname);
+    let timer = null;
+    let current = 0;
+
+    function run(text, id) {
+        // Có * hoặc ? thì tìm theo mẫu, không thì theo một phần của tên
+        const key = /[*?[]/.test(text) ? 'glob' : 'q';
+        fetch('/.fileshare/search?format=html&path=' + encodeURIComponent(folder) +
+              '&' + key + '=' + encodeURIComponent(text)).then(function(resp) {
+            if (id !== current) {
+                return;
+            }
+            if (resp.status === 503) {
+                // Server is still indexing the share
+                results.innerHTML = '<div class="search-note">⏳ Đang lập chỉ mục...</div>';
+                setTimeout(function() {
+                    run(text, id);
+                }, 1000);
+                return;
+            }
+            if (!resp.ok) {
+                throw new Error(resp.status);
+            }
+            return resp.text().then(function(rows) {
+                if (id === current) {
+                    results.innerHTML = rows;
+                    loadThumbnails(results);
+                }
+            });
+        }).catch(function() {
+            if (id === current) {
+                results.innerHTML = '<div class="search-note">❌ Không tìm được, thử lại sau</div>';
+            }
+        });
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const id = ++current;
+        const text = input.value.trim();
+        results.hidden = !text;
+        list.hidden = !!text;
+        if (text) {
+            timer = setTimeout(function() {
+                run(text, id);
+            }, 200);
+        }
+    });
+    form.addEventListener('submit', function(e) {
+        e.preventDefault();
+    });
+})();
+
+// Cập nhật danh sách ngay khi thư mục thay đổi, ví dụ file vừa upload từ máy khác
+(function() {
+    const list = document.querySelector('.file-list[data-events]');
+    if (!list || !window.EventSource || !window.JSON) {
+        return;
+    }
+    const url = list.getAttribute('data-events');
+    let source = null;
+    let lastId = '';
+
+    function sortKey(row) {
+        // Như server: thư mục trước, rồi theo tên không phân biệt hoa thường
+        const name = row.querySelector('.file-name').textContent;
+        return [row.hasAttribute('download') ? 1 : 0, name.toLowerCase(), name];
+    }
+
+    function isBefore(a, b) {
+        for (let i = 0; i < a.length; i++) {
+            if (a[i] !== b[i]) {
+                return a[i] < b[i];
+            }
+        }
+        return false;
+    }
+
+    function findRow(href) {
+        const rows = list.querySelectorAll('a.file-item');
+        for (let i = 0; i < rows.length; i++) {
+            if (rows[i].getAttribute('href') === href) {
+                return rows[i];
+            }
+        }
+        return null;
+    }
+
+    function place(row) {
+        const key = sortKey(row);
+        const rows = list.querySelectorAll('a.file-item:not(.parent-item):not(.load-more)');
+        for (let i = 0; i < rows.length; i++) {
+            if (isBefore(key, sortKey(rows[i]))) {
+                list.insertBefore(row, rows[i]);
+                return;
+            }
+        }
+        if (document.getElementById('load-more')) {
+            return;  // thuộc trang sau, sẽ có khi cuộn tới
+        }
+        const empty = list.querySelector('.empty-state');
+        if (empty) {
+            empty.remove();
+        }
+        list.appendChild(row);
+    }
+
+    function apply(kind, e) {
+        lastId = e.lastEventId || lastId;
+        const data = JSON.parse(e.data);
+        const old = findRow(data.url);
+        if (kind === 'remove') {
+            if (old) {
+                old.remove();
+            }
+            return;
+        }
+        const holder = document.createElement('div');
+        holder.innerHTML = data.html;
+        const row = holder.firstElementChild;
+        if (old) {
+            list.replaceChild(row, old);
+        } else {
+            place(row);
+        }
+        loadThumbnails(list);
+    }
+
+    function connect() {
+        source = new EventSource(url + (lastId ? '&last_id=' + encodeURIComponent(lastId) : ''));
+        ['add', 'remove', 'modify'].forEach(function(kind) {
+            source.addEventListener(kind, function(e) {
+                apply(kind, e);
+            });
+        });
+        source.addEventListener('reset', function() {
+            // Không biết đã lỡ những gì: tải lại trang, nhưng không liên tục
+            const last = +sessionStorage.getItem('fileshare-reload') || 0;
+            if (Date.now() - last > 10000) {
+                sessionStorage.setItem('fileshare-reload', Date.now());
+                location.reload();
+            }
+        });
+        source.onerror = function() {
+            if (source.readyState === EventSource.CLOSED) {
+                // Server busy (503): try again later
+                source = null;
+                setTimeout(function() {
+                    if (!source && !document.hidden) {
+                        connect();
+                    }
+                }, 30000);
+            }
+        };
+    }
+
+    // Tab ẩn thì đóng kết nối để server không phải giữ một thread cho nó
+    document.addEventListener('visibilitychange', function() {
+        if (document.hidden && source) {
+            source.close();
+            source = null;
+        } else if (!document.hidden && !source) {
+            connect();
+        }
+    });
+    if (!document.hidden) {
+        connect();
+    }
+})();
+
+// Upload vào thư mục đang xem. File nhỏ được gom lại gửi nhiều file một lần;
+// file lớn gửi theo từng phần, song song, và nếu mất kết nối thì chọn lại
+// đúng file đó và bấm Upload để gửi tiếp phần còn thiếu
+(function() {
+    const form = document.querySelector('.upload-form');
+    const input = document.getElementById('file-input');
+    if (!form || !input || !window.fetch || !window.Response || !window.localStorage ||
+            !window.FormData) {
+        return;  // form gửi multipart như cũ
+    }
+    const API = '/.fileshare/uploads';
+    const PARALLEL = 4;
+    const RETRIES = 5;
+    const LARGE_FILE = 8 * 1024 * 1024;    // từ cỡ này gửi theo từng phần
+    const BATCH_FILES = 100;
+    const BATCH_BYTES = 32 * 1024 * 1024;
+    const display = document.getElementById('file-name-display');
+    const button = form.querySelector('.upload-btn');
+
+    const CRC_TABLE = new Int32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        CRC_TABLE[n] = c;
+    }
+
+    // Same result as zlib.crc32(data, crc)
+    function crc32(buffer, crc) {
+        const bytes = new Uint8Array(buffer);
+        crc = ~crc;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = CRC_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        return ~crc;
+    }
+
+    // SHA-256 in plain JS: crypto.subtle needs HTTPS and the whole file in memory
+    function words(hex) {
+        return new Uint32Array(hex.split(' ').map(function(x) { return parseInt(x, 16); }));
+    }
+    const SHA_K = words(
+        '428a2f98 71374491 b5c0fbcf e9b5dba5 3956c25b 59f111f1 923f82a4 ab1c5ed5 ' +
+        'd807aa98 12835b01 243185be 550c7dc3 72be5d74 80deb1fe 9bdc06a7 c19bf174 ' +
+        'e49b69c1 efbe4786 0fc19dc6 240ca1cc 2de92c6f 4a7484aa 5cb0a9dc 76f988da ' +
+        '983e5152 a831c66d b00327c8 bf597fc7 c6e00bf3 d5a79147 06ca6351 14292967 ' +
+        '27b70a85 2e1b2138 4d2c6dfc 53380d13 650a7354 766a0abb 81c2c92e 92722c85 ' +
+        'a2bfe8a1 a81a664b c24b8b70 c76c51a3 d192e819 d6990624 f40e3585 106aa070 ' +
+        '19a4c116 1e376c08 2748774c 34b0bcb5 391c0cb3 4ed8aa4a 5b9cca4f 682e6ff3 ' +
+        '748f82ee 78a5636f 84c87814 8cc70208 90befffa a4506ceb bef9a3f7 c67178f2');
+
+    function Sha256() {
+        this.h = words('6a09e667 bb67ae85 3c6ef372 a54ff53a 510e527f 9b05688c 1f83d9ab 5be0cd19');
+        this.w = new Uint32Array(64);
+        this.block = new Uint8Array(64);
+        this.used = 0;
+        this.length = 0;
+    }
+
+    Sha256.prototype.compress = function(bytes, at) {
+        const w = this.w;
+        const h = this.h;
+        for (let i = 0; i < 16; i++, at += 4) {
+            w[i] = (bytes[at] << 24) | (bytes[at + 1] << 16) | (bytes[at + 2] << 8) | bytes[at + 3];
+        }
+        for (let i = 16; i < 64; i++) {
+            const a = w[i - 15];
+            const b = w[i - 2];
+            const s0 = ((a >>> 7) | (a << 25)) ^ ((a >>> 18) | (a << 14)) ^ (a >>> 3);
+            const s1 = ((b >>> 17) | (b << 15)) ^ ((b >>> 19) | (b << 13)) ^ (b >>> 10);
+            w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+        }
+        let a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], k = h[7];
+        for (let i = 0; i < 64; i++) {
+            const s1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+            const t1 = (k + s1 + ((e & f) ^ (~e & g)) + SHA_K[i] + w[i]) | 0;
+            const s0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+            const t2 = (s0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+            k = g; g = f; f = e; e = (d + t1) | 0;
+            d = c; c = b; b = a; a = (t1 + t2) | 0;
+        }
+        h[0] += a; h[1] += b; h[2] += c; h[3] += d;
+        h[4] += e; h[5] += f; h[6] += g; h[7] += k;
+    };
+
+    Sha256.prototype.update = function(buffer) {
+        const bytes = new Uint8Array(buffer);
+        let i = 0;
+        this.length += bytes.length;
+        if (this.used) {
+            while (this.used < 64 && i < bytes.length) {
+                this.block[this.used++] = bytes[i++];
+            }
+            if (this.used < 64) {
+                return;
+            }
+            this.compress(this.block, 0);
+            this.used = 0;
+        }
+        for (; i + 64 <= bytes.length; i += 64) {
+            this.compress(bytes, i);
+        }
+        while (i < bytes.length) {
+            this.block[this.used++] = bytes[i++];
+        }
+    };
+
+    Sha256.prototype.hex = function() {
+        const bits = this.length * 8;
+        const padding = new Uint8Array((this.used < 56 ? 56 : 120) - this.used + 8);
+        padding[0] = 0x80;
+        const view = new DataView(padding.buffer);
+        view.setUint32(padding.length - 8, Math.floor(bits / 0x100000000));
+        view.setUint32(padding.length - 4, bits >>> 0);
+        this.update(padding);
+        return Array.prototype.map.call(this.h, function(x) {
+            return ('0000000' + x.toString(16)).slice(-8);
+        }).join('');
+    };
+
+    function sha256File(file) {
+        const hash = new Sha256();
+        const SLICE = 8 * 1024 * 1024;
+        function next(start) {
+            if (start >= file.size) {
+                return Promise.resolve(hash.hex());
+            }
+            return new Response(file.slice(start, start + SLICE)).arrayBuffer().then(function(buffer) {
+                hash.update(buffer);
+                display.textContent = '🔎 Đang kiểm tra ' + file.name + ': ' +
+                    Math.floor(start * 100 / file.size) + '%';
+                return next(start + SLICE);
+            });
+        }
+        return next(0);
+    }
+
+    // Hỏi server trước: nếu đã có file giống hệt thì khỏi upload. Chỉ băm file
+    // khi trên máy có file cùng kích thước
+    function alreadyShared(file) {
+        const ask = '/.fileshare/digests?size=' + file.size +
+                    '&path=' + encodeURIComponent(location.pathname);
+        return request('GET', ask).then(function(answer) {
+            if (!answer.candidates) {
+                return null;
+            }
+            return sha256File(file).then(function(digest) {
+                return request('GET', ask + '&sha256=' + digest);
+            }).then(function(answer) {
+                return answer.match;
+            });
+        }).catch(function() {
+            return null;  // không hỏi được thì cứ upload
+        });
+    }
+
+    function request(method, url, body, type) {
+        return fetch(url, {
+            method: method,
+            body: body,
+            headers: body ? { 'Content-Type': type || 'application/json' } : {}
+        }).then(function(resp) {
+            if (!resp.ok) {
+                const error = new Error('HTTP ' + resp.status);
+                error.status = resp.status;
+                throw error;
+            }
+            return resp.status === 204 ? null : resp.json();
+        });
+    }
+
+    function withRetry(attempt, tries) {
+        return attempt().catch(function(error) {
+            // 4xx will not get better by retrying
+            if (tries <= 1 || (error.status && error.status < 500)) {
+                throw error;
+            }
+            return new Promise(function(resolve) {
+                setTimeout(resolve, 1000);
+            }).then(function() {
+                return withRetry(attempt, tries - 1);
+            });
+        });
+    }
+
+    function startOrResume(file, key) {
+        const create = function() {
+            const body = { name: relativeName(file), size: file.size, path: location.pathname };
+            return request('POST', API, JSON.stringify(body))
+                .then(function(upload) {
+                    localStorage.setItem(key, upload.id);
+                    return upload;
+                });
+        };
+        const saved = localStorage.getItem(key);
+        if (!saved) {
+            return create();
+        }
+        return request('GET', API + '/' + saved).catch(function(error) {
+            if (error.status !== 404) {
+                throw error;
+            }
+            return create();
+        });
+    }
+
+    function uploadFile(file) {
+        const key = 'fileshare-upload:' +
+                    [location.pathname, relativeName(file), file.size, file.lastModified].join(':');
+        return startOrResume(file, key).then(function(upload) {
+            const url = API + '/' + upload.id;
+            const partSize = upload.part_size;
+            const parts = Math.ceil(file.size / partSize);
+            let next = 0;
+            let failed = false;
+            let crc = 0;
+            let reading = Promise.resolve();
+            let done = upload.ranges.reduce(function(sum, r) {
+                return sum + r[1] - r[0];
+            }, 0);
+
+            function received(start, end) {
+                return upload.ranges.some(function(r) {
+                    return r[0] <= start && end <= r[1];
+                });
+            }
+
+            function progress() {
+                const pct = file.size ? Math.min(100, Math.floor(done * 100 / file.size)) : 100;
+                display.textContent = '⏫ ' + file.name + ': ' + pct + '%';
+            }
+
+            // Parts are read one after another so the checksum sees the file in order
+            function read(start, end) {
+                const data = reading.then(function() {
+                    return new Response(file.slice(start, end)).arrayBuffer();
+                }).then(function(buffer) {
+                    crc = crc32(buffer, crc);
+                    return buffer;
+                });
+                reading = data;
+                return data;
+            }
+
+            function worker() {
+                if (next >= parts || failed) {
+                    return Promise.resolve();
+                }
+                const start = next++ * partSize;
+                const end = Math.min(file.size, start + partSize);
+                return read(start, end).then(function(buffer) {
+                    if (received(start, end)) {
+                        return;
+                    }
+                    return withRetry(function() {
+                        return request('PUT', url + '?offset=' + start, buffer,
+                                       'application/octet-stream');
+                    }, RETRIES).then(function() {
+                        done += end - start;
+                        progress();
+                    });
+                }).then(worker, function(error) {
+                    failed = true;
+                    throw error;
+                });
+            }
+
+            progress();
+            const workers = [];
+            for (let i = 0; i < PARALLEL; i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers).then(function() {
+                const checksum = ('0000000' + (crc >>> 0).toString(16)).slice(-8);
+                return request('POST', url, JSON.stringify({ crc32: checksum }));
+            }).then(function(result) {
+                localStorage.removeItem(key);
+                return result;
+            }, function(error) {
+                if (error.status === 404 || error.status === 422) {
+                    localStorage.removeItem(key);  // phải gửi lại từ đầu
+                }
+                throw error;
+            });
+        });
+    }
+
+    // Trong thư mục được chọn, file mang theo đường dẫn con, ví dụ "Ảnh/2024/a.jpg"
+    function relativeName(file) {
+        return file.webkitRelativePath || file.name;
+    }
+
+    // Nhiều file nhỏ trong một request; kích thước đi trước mỗi file để server
+    // cấp sẵn chỗ trên đĩa
+    function uploadBatch(files) {
+        const body = new FormData();
+        files.forEach(function(file) {
+            body.append('size', String(file.size));
+            body.append('file', file, relativeName(file));
+        });
+        return withRetry(function() {
+            return fetch(location.pathname + '?format=json', { method: 'POST', body: body })
+                .then(function(resp) {
+                    if (!resp.ok) {
+                        const error = new Error('HTTP ' + resp.status);
+                        error.status = resp.status;
+                        throw error;
+                    }
+                    return resp.json();
+                });
+        }, RETRIES).then(function(answer) {
+            return answer.files;
+        });
+    }
+
+    function batches(files) {
+        const groups = [];
+        let group = [];
+        let bytes = 0;
+        files.forEach(function(file) {
+            if (group.length && (group.length >= BATCH_FILES || bytes + file.size > BATCH_BYTES)) {
+                groups.push(group);
+                group = [];
+                bytes = 0;
+            }
+            group.push(file);
+            bytes += file.size;
+        });
+        if (group.length) {
+            groups.push(group);
+        }
+        return groups;
+    }
+
+    form.addEventListener('submit', function(event) {
+        const files = selectedFiles();
+        if (!files.length) {
+            return;
+        }
+        event.preventDefault();
+        button.disabled = true;
+        let sent = 0;
+        const skipped = [];
+        function progress() {
+            display.textContent = '⏫ Đã gửi ' + sent + '/' + files.length + ' file';
+        }
+
+        let chain = Promise.resolve();
+        batches(files.filter(function(file) {
+            return file.size < LARGE_FILE;
+        })).forEach(function(group) {
+            chain = chain.then(function() {
+                return uploadBatch(group);
+            }).then(function(results) {
+                results.forEach(function(result) {
+                    if (result.result !== 'saved') {
+                        skipped.push(result.path);
+                    }
+                });
+                sent += group.length;
+                progress();
+            });
+        });
+        files.filter(function(file) {
+            return file.size >= LARGE_FILE;
+        }).forEach(function(file) {
+            chain = chain.then(function() {
+                return alreadyShared(file);
+            }).then(function(match) {
+                if (match) {
+                    skipped.push(match.path);
+                    return;
+                }
+                return uploadFile(file).then(function(result) {
+                    if (result.result !== 'saved') {
+                        skipped.push(result.path);
+                    }
+                }, function(error) {
+                    if (error.status !== 409) {
+                        throw error;
+                    }
+                    skipped.push(relativeName(file));  // đã có file trùng tên
+                });
+            }).then(function() {
+                sent++;
+                progress();
+            });
+        });
+
+        progress();
+        chain.then(function() {
+            if (skipped.length === files.length) {
+                button.disabled = false;
+                display.textContent = files.length === 1 ? '⏭️ Đã có sẵn trên máy: ' + skipped[0]
+                                                         : '⏭️ Tất cả file đã có sẵn trên máy';
+                return;
+            }
+            display.textContent = '✅ Upload xong: ' + (files.length - skipped.length) + ' file' +
+                                  (skipped.length ? ', bỏ qua ' + skipped.length + ' file đã có' : '');
+            location.reload();
+        }).catch(function(error) {
+            button.disabled = false;
+            display.textContent = '❌ Upload bị gián đoạn (' + error.message + '). Bấm Upload để gửi tiếp.';
+            display.style.color = '#e94560';
+        });
+    });
+})();
+
+function copyToClipboard(text) {
+    if (navigator.clipboard && window.isSecureContext) {
+        navigator.clipboard.writeText(text).then(function() {
+            alert('✅ Đã sao chép URL vào clipboard!');
+        }, function(err) {
+            fallbackCopyTextToClipboard(text);
+        });
+    } else {
+        fallbackCopyTextToClipboard(text);
+    }
+}
+
+function fallbackCopyTextToClipboard(text) {
+    const textArea = document.createElement("textarea");
+    textArea.value = text;
+    textArea.style.position = "fixed";
+    textArea.style.left = "-999999px";
+    textArea.style.top = "-999999px";
+    document.body.appendChild(textArea);
+    textArea.focus();
+    textArea.select();
+    try {
+        document.execCommand('copy');
+        alert('✅ Đã sao chép URL vào clipboard!');
+    } catch (err) {
+        alert('❌ Không thể sao chép. Vui lòng chọn và copy thủ công: ' + text);
+    }
+    document.body.removeChild(textArea);
+}
+'''
+
+
+class PageTemplate:
+    """str.format-style template split once into literal text and field names.
+
+    ``render`` appends pieces to a list so a whole page is joined and
+    encoded exactly once. A field given a list is spliced in as is.
+    """
+
+    def __init__(self, text):
+        self.parts = [(literal, field)
+                      for literal, field, _, _ in string.Formatter().parse(text)]
+
+    def render(self, out, **values):
+        for literal, field in self.parts:
+            if literal:
+                out.append(literal)
+            if field is not None:
+                value = values[field]
+                if isinstance(value, list):
+                    out.extend(value)
+                else:
+                    out.append(str(value))
+        return out
+
+
+def build_static_assets(files):
+    """Map versioned names (style.<hash>.css) to (content, type, etag, compressed variants)"""
+    assets, urls = {}, {}
+    for name, (text, ctype) in files.items():
+        content = text.encode('utf-8')
+        version = hashlib.sha256(content).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        versioned = f"{stem}.{version}{ext}"
+        variants = {enc: compress_bytes(content, enc) for enc in COMPRESSORS}
+        assets[versioned] = (content, ctype, f'"{version}"', variants)
+        urls[name] = f"{INTERNAL_PREFIX}static/{versioned}"
+    return assets, urls
+
+
+STATIC_ASSETS, ASSET_URLS = build_static_assets({
+    'style.css': (PAGE_CSS, 'text/css; charset=utf-8'),
+    'app.js': (PAGE_JS, 'text/javascript; charset=utf-8'),
+})
+
+PAGE_TEMPLATE = PageTemplate('''<!DOCTYPE html>
+<html lang="vi">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=no">
+    <title>🍎 Mac File Share</title>
+    <link rel="stylesheet" href="{css_url}">
+</head>
+<body>
+    <div class="container">
+        <header class="header">
+            <h1>🍎 Mac File Share</h1>
+            <p>Chia sẻ file dễ dàng giữa các thiết bị qua WiFi</p>
+            
+            <div class="server-info">
+                <p>📡 Truy cập từ bất kỳ thiết bị:</p>
+                <code>{server_url}</code>
+            </div>
+        </header>
+        
+        <nav class="breadcrumb">
+            <span>📍</span>
+            {breadcrumb}
+            <a href="{zip_url}" class="zip-link" download>📦 Tải cả thư mục (.zip)</a>
+        </nav>
+        {search_box}
+        <div class="file-list"{events}>
+{rows}
+        </div>
+        
+        <div class="upload-section">
+            <h3>📤 Upload file từ thiết bị lên Mac</h3>
+            <form class="upload-form" method="POST" enctype="multipart/form-data">
+                <div class="file-pickers">
+                    <div class="file-input-wrapper">
+                        <span class="file-input-btn">📎 Chọn file</span>
+                        <input type="file" name="file" id="file-input" multiple onchange="updateFileName(this)">
+                    </div>
+                    <div class="file-input-wrapper">
+                        <span class="file-input-btn">📁 Chọn thư mục</span>
+                        <input type="file" name="file" id="folder-input" webkitdirectory multiple onchange="updateFileName(this)">
+                    </div>
+                </div>
+                <p id="file-name-display">Chưa chọn file nào</p>
+                <button type="submit" class="upload-btn">🚀 Upload</button>
+            </form>
+        </div>
+        
+        <footer class="footer">
+            <p>💡 Đảm bảo Mac và thiết bị khác cùng kết nối WiFi</p>
+            <p>Made with ❤️ by Phong Tran | <a href="mailto:mr.yutran@gmail.com" style="color: #00d9a5;">mr.yutran@gmail.com</a></p>
+        </footer>
+    </div>
+    
+    <script src="{js_url}"></script>
+</body>
+</html>
+''')
+
+PARENT_ROW = PageTemplate('''
+            <a href="{parent}" class="file-item parent-item">
+                <span class="file-icon">⬆️</span>
+                <div class="file-info">
+                    <div class="file-name">..</div>
+                    <div class="file-meta">Quay lại thư mục trước</div>
+                </div>
+            </a>
+''')
+
+DIR_ROW = PageTemplate('''
+            <a href="{url}" class="file-item">
+                <span class="file-icon folder-icon">📁</span>
+                <div class="file-info">
+                    <div class="file-name">{name}</div>
+                    <div class="file-meta">Thư mục</div>
+                </div>
+                <span class="file-action">Mở</span>
+            </a>
+''')
+
+FILE_ROW = PageTemplate('''
+            <a href="{url}" class="file-item" download>
+                <span class="file-icon"{thumb}>{icon}</span>
+                <div class="file-info">
+                    <div class="file-name">{name}</div>
+                    <div class="file-meta">{meta}</div>
+                </div>
+                <span class="file-action">Tải ⬇️</span>
+            </a>
+''')
+
+MORE_ROW = PageTemplate('''
+            <a href="{next_page}" id="load-more" class="file-item load-more">
+                <span class="file-icon">⏬</span>
+                <div class="file-info">
+                    <div class="file-name">Xem thêm</div>
+                    <div class="file-meta">{total} mục trong thư mục này</div>
+                </div>
+            </a>
+''')
+
+SEARCH_MORE_ROW = PageTemplate('''
+            <div class="search-note">Chỉ hiện {limit} kết quả đầu tiên, hãy gõ cụ thể hơn</div>
+''')
+
+SEARCH_EMPTY = '''
+            <div class="empty-state">
+                <div class="icon">🔍</div>
+                <p>Không tìm thấy file nào</p>
+            </div>
+'''
+
+SEARCH_BOX = '''
+        <form class="search-form" role="search" hidden>
+            <input type="search" placeholder="🔍 Tìm trong thư mục này (vd: báo cáo, *.jpg)" autocomplete="off">
+        </form>
+'''
+
+EMPTY_STATE = '''
+            <div class="empty-state">
+                <div class="icon">📭</div>
+                <p>Thư mục này đang trống</p>
+            </div>
+'''
+
+
+class FileShareHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive: every response carries a length or is chunked
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't let Nagle hold the body
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=SHARE_DIR, **kwargs)
+    
+    def handle(self):
+        """Serve requests on one connection until either side closes it"""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+    
+    def handle_one_request(self):
+        self.started = None  # set once a request line has arrived
+        if (METRICS_ENABLED or ACCESS_LOG is not None) and not isinstance(self.wfile, MeteredWriter):
+            self.wfile = MeteredWriter(self.wfile)
+        try:
+            super().handle_one_request()
+        finally:
+            if self.started is not None:
+                if ACCESS_LOG is not None:
+                    self.log_access()
+                if METRICS_ENABLED:
+                    self.record_metrics()
+                if isinstance(self.wfile, MeteredWriter):
+                    self.wfile.bytes = 0
+                    self.wfile.seconds = 0.0
+    
+    def log_access(self):
+        """Queue the access log entry of the request that just finished"""
+        status = self.status or 0
+        if status < 400 and ACCESS_LOG_SAMPLE < 1 and random.random() >= ACCESS_LOG_SAMPLE:
+            return
+        ACCESS_LOG.write({
+            'client': self.client_address[0],
+            'method': self.command,
+            'path': self.path,
+            'status': status,
+            'bytes': self.wfile.bytes + self.sendfile_bytes,
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'route': self.route,
+        })
+    
+    def record_metrics(self):
+        """Add the request that just finished to METRICS"""
+        elapsed = time.perf_counter() - self.started
+        route = (('route', self.route),)
+        status = self.status or 0
+        METRICS.inc('fileshare_requests_total', route + (('code', str(status)),))
+        METRICS.observe('fileshare_request_duration_seconds',
+                        route if status < 400 else (('route', 'error'),), elapsed)
+        METRICS.inc('fileshare_sent_bytes_total', route, self.wfile.bytes + self.sendfile_bytes)
+        phases = self.phases
+        if self.wfile.bytes:
+            phases['write'] = self.wfile.seconds
+        received = self.headers.get('Content-Length') if self.headers else None
+        if received and received.isdigit():
+            METRICS.inc('fileshare_received_bytes_total', route, int(received))
+        for phase, seconds in phases.items():
+            METRICS.observe('fileshare_phase_seconds', (('phase', phase),), seconds)
+    
+    def add_phase(self, phase, started):
+        """Count the time since ``started`` (a perf_counter value) towards a request phase"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - started
+    
+    def wait_for_request(self):
+        """Wait for the next request on a kept-alive connection.
+
+        Gives up quietly after KEEPALIVE_TIMEOUT, or as soon as other
+        connections are queued for a worker, so idle clients never keep
+        a thread from someone who has a request.
+        """
+        try:
+            self.connection.settimeout(0)
+            buffered = self.rfile.peek(1)  # a pipelined request may already be here
+            deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+            while not buffered:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.keep_alive_allowed():
+                    return False
+                readable, _, _ = select.select([self.connection], [], [],
+                                               min(remaining, KEEPALIVE_POLL))
+                if readable:
+                    break
+            self.connection.settimeout(self.timeout)
+            return bool(buffered or self.rfile.peek(1))  # b'' when the client closed
+        except (OSError, ValueError):
+            return False
+    
+    def end_headers(self):
+        if not self.close_connection and not self.keep_alive_allowed():
+            self.send_header('Connection', 'close')  # also sets close_connection
+        super().end_headers()
+    
+    def parse_request(self):
+        self.body_consumed = False  # set once a request body has been read to the end
+        self.started = time.perf_counter()
+        self.route = 'other'  # metrics label, set by whatever answers the request
+        self.status = None
+        self.phases = {}
+        self.sendfile_bytes = 0  # body bytes that bypassed wfile
+        self.headers = None  # not the previous request's when this one is malformed
+        return super().parse_request()
+    
+    def send_response_only(self, code, message=None):
+        self.status = code
+        super().send_response_only(code, message)
+    
+    def keep_alive_allowed(self):
+        """Whether the server can afford to keep this connection open"""
+        waiting = getattr(self.server, 'has_waiting_connections', None)
+        return waiting is not None and not waiting()
+    
+    def request_has_body(self):
+        headers = getattr(self, 'headers', None)
+        if headers is None:
+            return False
+        return bool(headers.get('Transfer-Encoding')) or headers.get('Content-Length', '0').strip() not in ('', '0')
+    
+    def do_GET(self):
+        """Xử lý GET request"""
+        # Parse URL
+        parsed = urllib.parse.urlparse(self.path)
+        path = urllib.parse.unquote(parsed.path)
+        
+        # Internal endpoints (static assets, ...)
+        if path.startswith(INTERNAL_PREFIX):
+            self.handle_internal(path[len(INTERNAL_PREFIX):])
+            return
+        
+        # Trang chủ hoặc browse thư mục
+        if path == '/' or path == '':
+            self.send_directory_listing('/')
+            return
+        
+        # Kiểm tra đường dẫn file/folder
+        full_path = self.share_path(path)
+        
+        if full_path is None:
+            self.send_error(404, "File not found")
+        elif os.path.isdir(full_path):
+            self.send_directory_listing(path)
+        elif os.path.isfile(full_path):
+            # Download file
+            self.send_file(full_path)
+        else:
+            self.send_error(404, "File not found")
+    
+    def share_path(self, path):
+        """Filesystem path of the unquoted URL path ``path``, or None if it leaves SHARE_DIR.
+
+        The URL is unquoted before this, so ``%2f`` can smuggle ``..``
+        past the client's own normalisation; resolve it here.
+        """
+        root = os.path.abspath(SHARE_DIR)
+        full_path = os.path.normpath(os.path.join(root, path.lstrip('/')))
+        if full_path != root and not full_path.startswith(os.path.join(root, '')):
+            return None
+        return full_path
+    
+    def internal_route(self):
+        """Path below INTERNAL_PREFIX for the server's own endpoints, else None"""
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        if path.startswith(INTERNAL_PREFIX):
+            return path[len(INTERNAL_PREFIX):]
+        return None
+    
+    def handle_internal(self, route):
+        """Dispatch a request under INTERNAL_PREFIX"""
+        self.route = METRIC_ROUTES.get(route.split('/', 1)[0], 'other')
+        if route.startswith('static/') and self.command in ('GET', 'HEAD'):
+            self.send_asset(route[len('static/'):])
+        elif route.startswith('thumbs/') and self.command in ('GET', 'HEAD'):
+            self.send_thumbnail()
+        elif route == 'search' and self.command in ('GET', 'HEAD') and SEARCH_ENABLED:
+            self.send_search()
+        elif route.startswith('events/') and self.command in ('GET', 'HEAD') and EVENTS_ENABLED:
+            self.send_change_events()
+        elif route == 'digests' and self.command in ('GET', 'HEAD'):
+            self.send_digest_lookup()
+        elif route == 'metrics' and self.command in ('GET', 'HEAD') and METRICS_ENABLED:
+            self.send_metrics()
+        elif route == 'uploads' or route.startswith('uploads/'):
+            self.handle_upload_api(route[len('uploads'):].strip('/'))
+        else:
+            self.send_error(404, "File not found")
+    
+    def do_HEAD(self):
+        """Xử lý HEAD request"""
+        route = self.internal_route()
+        if route is not None:
+            self.handle_internal(route)
+            return
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            self.send_file(path, head_only=True)
+        else:
+            super().do_HEAD()
+    
+    def send_file(self, full_path, head_only=False):
+        """Send a file, honouring conditional and Range headers"""
+        self.route = 'download'
+        try:
+            st = os.stat(full_path)
+            f = HOT_FILES.get(full_path, st)
+            if f is None:
+                f = open(full_path, 'rb')
+                st = os.fstat(f.fileno())
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        
+        with f:
+            size = st.st_size
+            etag = make_etag(st.st_ino, size, st.st_mtime_ns)
+            last_modified = self.date_time_string(st.st_mtime)
+            ctype = self.guess_type(full_path)
+            range_header = self.headers.get('Range')
+            
+            # Compressed copy for whole-file requests (ranges address the raw bytes)
+            compressible = COMPRESSION and is_compressible(full_path, ctype, size)
+            if compressible and not range_header:
+                encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+                variant = encoding and COMPRESS_CACHE.get(full_path, st, encoding, f)
+                if variant:
+                    self.send_encoded_file(variant, encoding, ctype, etag, last_modified,
+                                           st.st_mtime, head_only)
+                    return
+            
+            if self.is_not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                if compressible:
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.end_headers()
+                return
+            
+            ranges = None
+            if range_header and self.if_range_matches(etag, last_modified):
+                ranges = parse_range_header(range_header, size)
+            
+            if ranges == []:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            
+            if ranges is None:
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(size))
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Content-Length', str(end - start + 1))
+            else:
+                boundary = base64.b32encode(os.urandom(10)).decode('ascii')
+                part_headers = [
+                    (f'\r\n--{boundary}\r\n'
+                     f'Content-Type: {ctype}\r\n'
+                     f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('ascii')
+                    for start, end in ranges
+                ]
+                closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+                length = sum(len(h) for h in part_headers) + len(closing)
+                length += sum(end - start + 1 for start, end in ranges)
+                self.send_response(206)
+                self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+                self.send_header('Content-Length', str(length))
+            
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            for name, value in self.digest_headers(full_path, st):
+                self.send_header(name, value)
+            if compressible:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            if head_only:
+                return
+            if not compressible and not isinstance(f, memoryview):
+                body = HOT_FILES.load(full_path, st, f)
+                if body is not None:
+                    f = body
+            
+            try:
+                if ranges is None:
+                    self.copy_range(f, 0, size)
+                elif len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.copy_range(f, start, end - start + 1)
+                else:
+                    for header, (start, end) in zip(part_headers, ranges):
+                        self.wfile.write(header)
+                        self.copy_range(f, start, end - start + 1)
+                    self.wfile.write(closing)
+            except (ConnectionResetError, BrokenPipeError):
+                # Client went away mid-download (e.g. phone lost Wi-Fi)
+                self.close_connection = True
+    
+    def digest_headers(self, full_path, st):
+        """Repr-Digest (RFC 9530) and legacy Digest headers for a file.
+
+        Only digests already in DIGESTS are sent, so a download never waits
+        for hashing unless the client asked with Want-Repr-Digest/Want-Digest
+        and the file is small; bigger ones are hashed in the background.
+        """
+        digests = DIGESTS.lookup(st)
+        if digests is None:
+            wanted = (self.headers.get('Want-Repr-Digest', '') +
+                      self.headers.get('Want-Digest', '')).lower()
+            if 'sha-256' not in wanted:
+                return []
+            if st.st_size > DIGEST_INLINE_MAX:
+                DIGESTS.compute_later(full_path)
+                return []
+            digests = DIGESTS.compute(full_path)
+            if digests is None:
+                return []
+        value = base64.b64encode(bytes.fromhex(digests['sha256'])).decode('ascii')
+        return [('Repr-Digest', f'sha-256=:{value}:'), ('Digest', f'SHA-256={value}')]
+    
+    def send_encoded_file(self, variant, encoding, ctype, etag, last_modified, mtime, head_only):
+        """Send a cached compressed copy of a file"""
+        etag = f'{etag[:-1]}-{encoding}"'
+        if self.is_not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        try:
+            f = open(variant, 'rb')
+        except OSError:
+            self.send_error(500, "Compressed copy disappeared")
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(size))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            if head_only:
+                return
+            try:
+                self.copy_range(f, 0, size)
+            except (ConnectionResetError, BrokenPipeError):
+                self.close_connection = True
+    
+    def send_content(self, content, ctype, headers=(), status=200):
+        """Send an in-memory body, compressed when the client accepts it"""
+        encoding = None
+        if COMPRESSION and len(content) >= MIN_COMPRESS_SIZE:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+            if encoding:
+                started = time.perf_counter()
+                content = compress_bytes(content, encoding)
+                self.add_phase('compress', started)
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', len(content))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if COMPRESSION:
+            self.send_header('Vary', 'Accept-Encoding')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+    
+    def copy_range(self, f, offset, length):
+        """Copy ``length`` bytes starting at ``offset`` to the client, taking turns if it is bulk"""
+        transfer = DOWNLOAD_SCHEDULER.transfer(self.client_address[0], length)
+        while length > 0:
+            n = transfer.acquire(length)
+            self.send_range(f, offset, n)
+            offset += n
+            length -= n
+        if transfer.waited:
+            self.phases['throttle'] = self.phases.get('throttle', 0.0) + transfer.waited
+    
+    def send_range(self, f, offset, length):
+        """Send part of an open file, or of a cached body from HOT_FILES"""
+        if isinstance(f, memoryview):
+            self.wfile.write(f[offset:offset + length])
+            return
+        if USE_SENDFILE:
+            started = time.perf_counter()
+            sent = self.connection.sendfile(f, offset, length)
+            self.add_phase('sendfile', started)
+            self.sendfile_bytes += sent
+            if sent < length:
+                raise ConnectionResetError("File shrank while sending")
+            return
+        f.seek(offset)
+        while length > 0:
+            started = time.perf_counter()
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            self.add_phase('read', started)
+            if not chunk:
+                raise ConnectionResetError("File shrank while sending")
+            self.wfile.write(chunk)
+            length -= len(chunk)
+    
+    def is_not_modified(self, etag, mtime):
+        """Check If-None-Match / If-Modified-Since against the current validators"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag_in_list(etag, if_none_match, weak=True)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since is None:
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+    
+    def if_range_matches(self, etag, last_modified):
+        """True when there is no If-Range or it still matches the file"""
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # Ranges only combine with strong validators
+            return if_range == etag
+        return if_range == last_modified
+    
+    def do_PUT(self):
+        """Chunks of resumable uploads"""
+        route = self.internal_route()
+        if route is None:
+            self.send_error(405, "Method not allowed")
+            return
+        self.handle_internal(route)
+    
+    do_PATCH = do_DELETE = do_PUT
+    
+    def do_POST(self):
+        """Handle file upload from any device"""
+        route = self.internal_route()
+        if route is not None:
+            self.handle_internal(route)
+            return
+        self.route = 'upload'
+        try:
+            content_type = self.headers.get('Content-Type', '')
+            
+            if 'multipart/form-data' in content_type:
+                # Parse boundary more robustly
+                if 'boundary=' not in content_type:
+                    self.send_error(400, "Invalid multipart data")
+                    return
+                
+                boundary = content_type.split('boundary=')[1].split(';')[0].strip()
+                if boundary.startswith('"') and boundary.endswith('"'):
+                    boundary = boundary[1:-1]
+                boundary = boundary.encode('utf-8')
+                
+                try:
+                    content_length = int(self.headers['Content-Length'])
+                except (TypeError, ValueError):
+                    self.send_error(411, "Length Required")
+                    return
+                
+                directory = os.path.normpath(self.translate_path(self.path))
+                if not os.path.isdir(directory):
+                    self.send_error(404, "Folder not found")
+                    return
+                params = self.query_params()
+                conflict = params.get('conflict', UPLOAD_CONFLICT)
+                if conflict not in UPLOAD_CONFLICTS:
+                    self.send_error(400, f"conflict must be one of {', '.join(UPLOAD_CONFLICTS)}")
+                    return
+                
+                # Stream the body: file parts are handed to UPLOAD_WRITER as
+                # they arrive and moved into place a batch at a time
+                transfer = UPLOAD_SCHEDULER.transfer(self.client_address[0], content_length)
+                rfile = ShapedReader(self.rfile, transfer) if transfer.shaped else self.rfile
+                reader = MultipartReader(rfile, boundary, content_length)
+                results = []
+                batch = []
+                changed = {directory}
+                size_hint = None
+                try:
+                    for headers, chunks in reader.parts():
+                        name, filename = parse_content_disposition(
+                            headers.get('content-disposition', ''))
+                        if name == 'size' and not filename:
+                            # Optional size of the next file, for preallocation
+                            value = b''
+                            for chunk in chunks:
+                                value += chunk
+                                if len(value) > 20:
+                                    break
+                            size_hint = int(value) if value.isdigit() else None
+                            continue
+                        if name != 'file' or not filename:
+                            continue
+                        size, size_hint = size_hint, None
+                        
+                        # Sanitize filename; folder uploads keep their subfolders
+                        filename = clean_upload_path(filename)
+                        if not filename:
+                            continue
+                        
+                        try:
+                            target, grown = upload_target(directory, filename)
+                            if grown is not None:
+                                changed.add(grown)
+                            if conflict == 'skip' and os.path.lexists(target):
+                                CONSOLE.write(f"⏭️  {filename} already exists, upload skipped")
+                                results.append(self.upload_result(target, 0, 'skipped'))
+                                continue
+                            if size is not None and size > content_length:
+                                size = None
+                            batch.append(self.receive_file(target, chunks, size))
+                            if len(batch) >= UPLOAD_SYNC_BATCH:
+                                results += self.save_uploads(batch, conflict, changed)
+                        except PermissionError:
+                            CONSOLE.write(f"❌ Cannot save file: {filename} (no permission)")
+                            self.close_connection = True
+                            self.send_error(403, f"Cannot save file: {filename}")
+                            return
+                        except MultipartError:
+                            raise
+                        except Exception as e:
+                            CONSOLE.write(f"❌ Error saving file: {filename} ({e})")
+                            self.close_connection = True
+                            self.send_error(507 if getattr(e, 'errno', None) == errno.ENOSPC else 500,
+                                            f"Error saving file: {filename}")
+                            return
+                    results += self.save_uploads(batch, conflict, changed)
+                except MultipartError as e:
+                    CONSOLE.write(f"❌ Upload error: {e}")
+                    self.send_error(400, "Invalid multipart data")
+                    return
+                finally:
+                    for out, _, _ in batch:
+                        out.discard()
+                self.body_consumed = True
+                
+                if results:
+                    saved = sum(1 for r in results if r['result'] == 'saved')
+                    CONSOLE.write(f"✅ Upload successful: {saved} of {len(results)} file(s) saved")
+                    for folder in changed:
+                        SEARCH_INDEX.changed(folder)
+                        CHANGE_FEED.changed(folder)
+                    if params.get('format') == 'json':
+                        self.send_json({'files': results})
+                        return
+                    # Back to the folder the files were sent to
+                    self.send_response(303)
+                    self.send_header('Location', urllib.parse.urlsplit(self.path).path)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    self.send_error(400, "No files found to upload")
+            else:
+                self.send_error(400, "Invalid request")
+        except Exception as e:
+            CONSOLE.write(f"❌ Upload error: {e}")
+            self.close_connection = True
+            self.send_error(500, "Server error during upload")
+    
+    def receive_file(self, target, chunks, size=None):
+        """Stream one uploaded file into a temp file next to ``target``.
+
+        Chunks are hashed here and written out by UPLOAD_WRITER; returns
+        ``(file, target, digests)`` for save_uploads once the part is read.
+        """
+        out = UPLOAD_WRITER.create(os.path.dirname(target), size)
+        hashers = new_hashers(DIGEST_ALGORITHMS)
+        started = time.perf_counter()
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        except BaseException:
+            out.discard()
+            raise
+        METRICS.inc('fileshare_upload_bytes_total', (), out.offset)
+        METRICS.inc('fileshare_upload_seconds_total', (), time.perf_counter() - started)
+        return out, target, {name: hasher.hexdigest() for name, hasher in hashers.items()}
+    
+    def save_uploads(self, batch, conflict, changed):
+        """fsync a batch of received files together, then move each into place.
+
+        Emptying ``batch`` hands the files over; ``changed`` collects the
+        folders that got new files. Returns an upload_result per file.
+        """
+        files = [out for out, _, _ in batch]
+        UPLOAD_WRITER.sync(files)
+        pending, batch[:] = list(batch), []
+        results = []
+        folders = set()
+        try:
+            while pending:
+                out, target, digests = pending[0]
+                path, result = place_upload(out.path, target, out.offset, digests, conflict)
+                pending.pop(0)
+                rel = os.path.relpath(path, SHARE_DIR)
+                if result == 'saved':
+                    CONSOLE.write(f"📥 Received file: {rel} ({out.offset} bytes)")
+                    folders.add(os.path.dirname(path))
+                elif result == 'duplicate':
+                    CONSOLE.write(f"⏭️  {rel} is already shared, kept the existing copy")
                 else:
-                    self.send_error(400, "No files found to upload")
+                    CONSOLE.write(f"⏭️  {rel} already exists, upload skipped")
+                results.append(self.upload_result(path, out.offset, result))
+        finally:
+            for out, _, _ in pending:
+                out.discard()
+        for folder in folders:
+            fsync_path(folder)
+        changed.update(folders)
+        return results
+    
+    def upload_result(self, path, size, result):
+        """What became of an uploaded file, as sent back to the client"""
+        rel = os.path.relpath(path, SHARE_DIR).replace(os.sep, '/')
+        return {'name': os.path.basename(path), 'path': '/' + rel,
+                'url': '/' + urllib.parse.quote(rel), 'size': size, 'result': result}
+    
+    def handle_upload_api(self, upload_id):
+        """Resumable uploads under INTERNAL_PREFIX + 'uploads'.
+
+        POST   uploads                     {"name", "size"[, "path", "conflict"]}
+                                           -> 201 + upload JSON; "name" may
+                                           hold subfolders, "path" is the
+                                           target folder (default /)
+        GET    uploads/<id>                upload JSON, Upload-Offset header
+        PUT    uploads/<id>?offset=N       write the body at byte N (PATCH with
+                                           an Upload-Offset header works too)
+        POST   uploads/<id>                finish: {"crc32"|"sha256"|"blake2b": hex}
+                                           is verified, then the file is renamed
+                                           into place -> {"name", "path", "url",
+                                           "size", "result"}
+        DELETE uploads/<id>                abandon the upload
+        """
+        method = self.command
+        if not upload_id:
+            if method != 'POST':
+                self.send_error(405, "Method not allowed")
+                return
+            request = self.read_json_body()
+            if request is None:
+                return
+            name = clean_upload_path(request.get('name'))
+            size = request.get('size')
+            conflict = request.get('conflict', UPLOAD_CONFLICT)
+            if not name or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                self.send_error(400, "Expected a file name and size")
+                return
+            if conflict not in UPLOAD_CONFLICTS:
+                self.send_error(400, f"conflict must be one of {', '.join(UPLOAD_CONFLICTS)}")
+                return
+            directory = os.path.normpath(self.translate_path(str(request.get('path', '/'))))
+            if not os.path.isdir(directory):
+                self.send_error(404, "Folder not found")
+                return
+            try:
+                target, grown = upload_target(directory, name)
+                upload = UPLOADS.create(os.path.dirname(target), os.path.basename(target),
+                                        size, conflict)
+            except UploadError as e:
+                self.send_error(e.status, str(e))
+                return
+            except PermissionError:
+                self.send_error(403, f"Cannot save file: {name}")
+                return
+            except OSError:
+                self.send_error(409, f"Cannot create the folders of {name}")
+                return
+            if grown is not None:
+                SEARCH_INDEX.changed(grown)
+                CHANGE_FEED.changed(grown)
+            CONSOLE.write(f"📥 Upload started: {name} ({size} bytes)")
+            info = upload.to_json()
+            self.send_json(info, status=201, headers=[('Location', info['url'])])
+            return
+        
+        upload = UPLOADS.get(upload_id)
+        if upload is None:
+            self.send_error(404, "Upload not found")
+            return
+        try:
+            if method in ('GET', 'HEAD'):
+                self.send_json(upload.to_json(), headers=[
+                    ('Upload-Offset', str(upload.offset)),
+                    ('Upload-Length', str(upload.size)),
+                    ('Cache-Control', 'no-store'),
+                ])
+            elif method in ('PUT', 'PATCH'):
+                self.receive_upload_part(upload)
+            elif method == 'POST':
+                request = self.read_json_body(required=False)
+                if request is None:
+                    return
+                checksums = {k: str(v) for k, v in request.items() if k in UPLOAD_CHECKSUMS}
+                target, result = UPLOADS.finish(upload, checksums)
+                if result == 'saved':
+                    SEARCH_INDEX.changed(os.path.dirname(target))
+                    CHANGE_FEED.changed(os.path.dirname(target))
+                    CONSOLE.write(f"✅ Upload successful: {os.path.basename(target)} ({upload.size} bytes)")
+                info = self.upload_result(target, upload.size, result)
+                self.send_json(info, status=201 if result == 'saved' else 200,
+                               headers=[('Location', info['url'])])
+            elif method == 'DELETE':
+                UPLOADS.abort(upload)
+                self.send_response(204)
+                self.end_headers()
             else:
-                self.send_error(400, "Invalid request")
-        except Exception as e:
-            print(f"❌ Upload error: {e}")
-            self.send_error(500, "Server error during upload")
+                self.send_error(405, "Method not allowed")
+        except UploadError as e:
+            self.send_error(e.status, str(e))
+        except PermissionError:
+            CONSOLE.write(f"❌ Cannot save file: {upload.name} (no permission)")
+            self.send_error(403, f"Cannot save file: {upload.name}")
+        except OSError as e:
+            CONSOLE.write(f"❌ Error saving file: {upload.name} ({e})")
+            self.send_error(500, f"Error saving file: {upload.name}")
+    
+    def receive_upload_part(self, upload):
+        """Write one chunk of a resumable upload at the offset it names"""
+        offset = self.query_params().get('offset', self.headers.get('Upload-Offset'))
+        try:
+            offset = int(offset)
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411 if 'Content-Length' not in self.headers else 400,
+                            "Expected an offset and Content-Length")
+            return
+        transfer = UPLOAD_SCHEDULER.transfer(self.client_address[0], length)
+        read = ShapedReader(self.rfile, transfer).read if transfer.shaped else self.rfile.read
+        started = time.perf_counter()
+        try:
+            UPLOADS.write(upload, offset, length, read)
+        except ConnectionError:
+            self.close_connection = True
+            return
+        METRICS.inc('fileshare_upload_bytes_total', (), length)
+        METRICS.inc('fileshare_upload_seconds_total', (), time.perf_counter() - started)
+        self.body_consumed = True
+        if transfer.waited:
+            self.phases['throttle'] = self.phases.get('throttle', 0.0) + transfer.waited
+        self.send_response(204)
+        self.send_header('Upload-Offset', str(upload.offset))
+        self.end_headers()
+    
+    def read_json_body(self, required=True, limit=64 * 1024):
+        """Parse a small JSON object request body; sends the error and returns None if bad"""
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > limit:
+            self.send_error(413 if length > limit else 400, "Invalid request body")
+            return None
+        if not length and not required:
+            return {}
+        body = self.rfile.read(length) if length else b''
+        self.body_consumed = len(body) == length
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            self.send_error(400, "Expected a JSON object")
+            return None
+        return request
+    
+    def send_json(self, obj, status=200, headers=()):
+        self.send_content(json.dumps(obj, ensure_ascii=False).encode(), 'application/json',
+                          headers, status)
+    
+    def query_params(self):
+        """First value of each query string parameter"""
+        query = urllib.parse.urlparse(self.path).query
+        return {k: v[0] for k, v in urllib.parse.parse_qs(query).items()}
     
     def send_directory_listing(self, path):
         """Send HTML page displaying file list"""
-        full_path = os.path.join(SHARE_DIR, path.lstrip('/'))
+        self.route = 'listing'
+        full_path = self.share_path(path)
+        if full_path is None:
+            self.send_error(404, "Cannot read directory")
+            return
+        params = self.query_params()
         
+        started = time.perf_counter()
         try:
-            entries = os.listdir(full_path)
+            st = os.stat(full_path)
         except OSError:
             self.send_error(404, "Cannot read directory")
             return
+        self.add_phase('scan', started)
+        if params.get('format') == 'zip':
+            self.route = 'zip'
+            self.send_directory_zip(path, full_path)
+            return
         
-        # Sắp xếp: thư mục trước, rồi đến file
-        dirs = []
-        files = []
+        # Revalidation is answered from one stat(), before reading the folder
+        etag = self.listing_etag(path, st)
+        headers = [('Cache-Control', 'no-cache')]
+        if etag:
+            if etag_in_list(etag, self.headers.get('If-None-Match', ''), weak=True):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                if COMPRESSION:
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                return
+            headers.append(('ETag', etag))
         
-        for entry in entries:
-            if entry.startswith('.'):
-                continue
-            entry_path = os.path.join(full_path, entry)
-            if os.path.isdir(entry_path):
-                dirs.append(entry)
-            else:
-                files.append(entry)
+        started = time.perf_counter()
+        try:
+            index = DIR_CACHE.get(full_path, st)
+        except OSError:
+            self.send_error(404, "Cannot read directory")
+            return
+        self.add_phase('scan', started)
         
-        dirs.sort(key=str.lower)
-        files.sort(key=str.lower)
+        if params.get('format') in ('json', 'ndjson'):
+            self.send_directory_json(path, index, params, headers)
+            return
         
-        # Tạo HTML
-        local_ip = get_local_ip()
-        server_url = f"http://{local_ip}:{PORT}"
+        # One page of the sorted index (thư mục trước, rồi đến file)
+        try:
+            limit = max(1, min(MAX_PAGE_SIZE, int(params.get('limit', PAGE_SIZE))))
+        except ValueError:
+            limit = PAGE_SIZE
+        entries, next_cursor = index.page(params.get('cursor'), limit)
+        next_page = None
+        if next_cursor:
+            next_page = f'?cursor={next_cursor}'
+            if limit != PAGE_SIZE:
+                next_page += f'&limit={limit}'
         
-        html_content = f'''<!DOCTYPE html>
-<html lang="vi">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=no">
-    <title>🍎 Mac File Share</title>
-    <style>
-        * {{
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }}
-        
-        :root {{
-            --bg-gradient-1: #1a1a2e;
-            --bg-gradient-2: #16213e;
-            --bg-gradient-3: #0f3460;
-            --card-bg: rgba(255, 255, 255, 0.08);
-            --card-border: rgba(255, 255, 255, 0.12);
-            --text-primary: #ffffff;
-            --text-secondary: rgba(255, 255, 255, 0.7);
-            --accent: #e94560;
-            --accent-glow: rgba(233, 69, 96, 0.4);
-            --success: #00d9a5;
-            --folder-color: #ffd93d;
-        }}
-        
-        body {{
-            font-family: 'SF Pro Display', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-            background: linear-gradient(135deg, var(--bg-gradient-1) 0%, var(--bg-gradient-2) 50%, var(--bg-gradient-3) 100%);
-            min-height: 100vh;
-            color: var(--text-primary);
-            padding: 20px;
-            padding-bottom: 100px;
-        }}
-        
-        /* Animated background */
-        body::before {{
-            content: '';
-            position: fixed;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: 
-                radial-gradient(circle at 20% 80%, rgba(233, 69, 96, 0.15) 0%, transparent 50%),
-                radial-gradient(circle at 80% 20%, rgba(0, 217, 165, 0.1) 0%, transparent 50%),
-                radial-gradient(circle at 40% 40%, rgba(255, 217, 61, 0.08) 0%, transparent 40%);
-            pointer-events: none;
-            z-index: -1;
-        }}
-        
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-        }}
-        
-        /* Header */
-        .header {{
-            text-align: center;
-            padding: 30px 20px;
-            margin-bottom: 30px;
-            background: var(--card-bg);
-            border-radius: 24px;
-            border: 1px solid var(--card-border);
-            backdrop-filter: blur(20px);
-            -webkit-backdrop-filter: blur(20px);
-        }}
-        
-        .header h1 {{
-            font-size: 2.2em;
-            font-weight: 700;
-            margin-bottom: 10px;
-            background: linear-gradient(135deg, #fff 0%, #e94560 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-        }}
-        
-        .header p {{
-            color: var(--text-secondary);
-            font-size: 1em;
-        }}
-        
-        .server-info {{
-            margin-top: 20px;
-            padding: 15px;
-            background: rgba(0, 217, 165, 0.1);
-            border-radius: 12px;
-            border: 1px solid rgba(0, 217, 165, 0.3);
-        }}
-        
-        .server-info code {{
-            font-family: 'SF Mono', Monaco, monospace;
-            font-size: 1.1em;
-            color: var(--success);
-            font-weight: 600;
-        }}
-        
-        /* Breadcrumb */
-        .breadcrumb {{
-            display: flex;
-            align-items: center;
-            flex-wrap: wrap;
-            gap: 8px;
-            padding: 15px 20px;
-            background: var(--card-bg);
-            border-radius: 16px;
-            margin-bottom: 20px;
-            border: 1px solid var(--card-border);
-        }}
-        
-        .breadcrumb a {{
-            color: var(--accent);
-            text-decoration: none;
-            font-weight: 500;
-            transition: all 0.2s;
-        }}
-        
-        .breadcrumb a:hover {{
-            text-shadow: 0 0 10px var(--accent-glow);
-        }}
-        
-        .breadcrumb .current-path {{
-            color: var(--text-primary);
-            font-weight: 600;
-            text-decoration: none;
-        }}
-        
-        .breadcrumb span {{
-            color: var(--text-secondary);
-        }}
-        
-        /* File List */
-        .file-list {{
-            background: var(--card-bg);
-            border-radius: 20px;
-            border: 1px solid var(--card-border);
-            overflow: hidden;
-            backdrop-filter: blur(20px);
-            -webkit-backdrop-filter: blur(20px);
-        }}
-        
-        .file-item {{
-            display: flex;
-            align-items: center;
-            padding: 16px 20px;
-            border-bottom: 1px solid var(--card-border);
-            transition: all 0.3s ease;
-            text-decoration: none;
-            color: inherit;
-        }}
-        
-        .file-item:last-child {{
-            border-bottom: none;
-        }}
-        
-        .file-item:hover {{
-            background: rgba(255, 255, 255, 0.1);
-            transform: translateX(5px);
-        }}
-        
-        .file-item:active {{
-            transform: scale(0.98);
-        }}
-        
-        .file-icon {{
-            font-size: 2em;
-            margin-right: 15px;
-            min-width: 45px;
-            text-align: center;
-        }}
-        
-        .file-info {{
-            flex: 1;
-            min-width: 0;
-        }}
-        
-        .file-name {{
-            font-weight: 600;
-            font-size: 1.05em;
-            white-space: nowrap;
-            overflow: hidden;
-            text-overflow: ellipsis;
-            margin-bottom: 4px;
-        }}
-        
-        .file-meta {{
-            font-size: 0.85em;
-            color: var(--text-secondary);
-        }}
-        
-        .file-action {{
-            padding: 10px 18px;
-            background: linear-gradient(135deg, var(--accent), #ff6b6b);
-            color: white;
-            border-radius: 25px;
-            font-size: 0.85em;
-            font-weight: 600;
-            box-shadow: 0 4px 15px var(--accent-glow);
-            transition: all 0.3s;
-        }}
-        
-        .file-item:hover .file-action {{
-            transform: scale(1.05);
-            box-shadow: 0 6px 20px var(--accent-glow);
-        }}
-        
-        .folder-icon {{
-            color: var(--folder-color);
-        }}
-        
-        /* Upload Section */
-        .upload-section {{
-            margin-top: 30px;
-            padding: 30px;
-            background: var(--card-bg);
-            border-radius: 20px;
-            border: 2px dashed var(--card-border);
-            text-align: center;
-            transition: all 0.3s;
-        }}
-        
-        .upload-section:hover {{
-            border-color: var(--accent);
-            background: rgba(233, 69, 96, 0.05);
-        }}
-        
-        .upload-section h3 {{
-            margin-bottom: 15px;
-            font-size: 1.3em;
-        }}
-        
-        .upload-form {{
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            gap: 15px;
-        }}
-        
-        .file-input-wrapper {{
-            position: relative;
-            overflow: hidden;
-            display: inline-block;
-        }}
-        
-        .file-input-wrapper input[type=file] {{
-            font-size: 100px;
-            position: absolute;
-            left: 0;
-            top: 0;
-            opacity: 0;
-            cursor: pointer;
-        }}
-        
-        .file-input-btn {{
-            padding: 15px 30px;
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            color: white;
-            border-radius: 30px;
-            font-size: 1em;
-            font-weight: 600;
-            cursor: pointer;
-            box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-            transition: all 0.3s;
-        }}
-        
-        .file-input-btn:hover {{
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(102, 126, 234, 0.5);
-        }}
-        
-        .upload-btn {{
-            padding: 15px 40px;
-            background: linear-gradient(135deg, var(--success), #00b894);
-            color: white;
-            border: none;
-            border-radius: 30px;
-            font-size: 1em;
-            font-weight: 600;
-            cursor: pointer;
-            box-shadow: 0 4px 15px rgba(0, 217, 165, 0.4);
-            transition: all 0.3s;
-        }}
-        
-        .upload-btn:hover {{
-            transform: translateY(-2px);
-            box-shadow: 0 6px 20px rgba(0, 217, 165, 0.5);
-        }}
-        
-        #file-name-display {{
-            color: var(--text-secondary);
-            font-size: 0.9em;
-        }}
-        
-        /* Empty State */
-        .empty-state {{
-            text-align: center;
-            padding: 60px 20px;
-            color: var(--text-secondary);
-        }}
-        
-        .empty-state .icon {{
-            font-size: 4em;
-            margin-bottom: 20px;
-            opacity: 0.5;
-        }}
-        
-        /* Footer */
-        .footer {{
-            text-align: center;
-            margin-top: 40px;
-            padding: 20px;
-            color: var(--text-secondary);
-            font-size: 0.9em;
-        }}
-        
-        /* Animations */
-        @keyframes fadeIn {{
-            from {{ opacity: 0; transform: translateY(20px); }}
-            to {{ opacity: 1; transform: translateY(0); }}
-        }}
-        
-        .file-item {{
-            animation: fadeIn 0.4s ease forwards;
-        }}
-        
-        .file-item:nth-child(1) {{ animation-delay: 0.05s; }}
-        .file-item:nth-child(2) {{ animation-delay: 0.1s; }}
-        .file-item:nth-child(3) {{ animation-delay: 0.15s; }}
-        .file-item:nth-child(4) {{ animation-delay: 0.2s; }}
-        .file-item:nth-child(5) {{ animation-delay: 0.25s; }}
-        
-        /* Responsive */
-        @media (max-width: 600px) {{
-            body {{
-                padding: 15px;
-            }}
-            
-            .header h1 {{
-                font-size: 1.8em;
-            }}
-            
-            .file-action {{
-                padding: 8px 14px;
-                font-size: 0.8em;
-            }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <header class="header">
-            <h1>🍎 Mac File Share</h1>
-            <p>Chia sẻ file dễ dàng giữa các thiết bị qua WiFi</p>
-            
-            <div class="server-info">
-                <p>📡 Truy cập từ bất kỳ thiết bị:</p>
-                <code>{server_url}</code>
-            </div>
-        </header>
+        started = time.perf_counter()
+        rows = []
+        for entry in entries:
+            self.render_entry(rows, path, entry)
         
-        <nav class="breadcrumb">
-            <span>📍</span>
-            {self.generate_breadcrumb(path)}
-        </nav>
+        # Infinite scroll asks for just the rows of the next page
+        if params.get('partial'):
+            if next_page:
+                headers.append(('X-Next-Page', next_page))
+            body = ''.join(rows).encode()
+            self.add_phase('render', started)
+            self.send_content(body, 'text/html; charset=utf-8', headers)
+            return
         
-        <div class="file-list">
-'''
+        # Live updates start from the folder as it was when the page was made
+        events = ''
+        if EVENTS_ENABLED:
+            events_url = f"{INTERNAL_PREFIX}events{urllib.parse.quote(path)}?since={st.st_mtime_ns}"
+            events = f' data-events="{html.escape(events_url)}"'
         
-        # Nút quay lại
+        # Tạo HTML from the precompiled templates
+        chunks = []
         if path != '/':
+            # Nút quay lại
             parent = os.path.dirname(path.rstrip('/'))
             if not parent:
                 parent = '/'
-            html_content += f'''
-            <a href="{parent}" class="file-item">
-                <span class="file-icon">⬆️</span>
-                <div class="file-info">
-                    <div class="file-name">..</div>
-                    <div class="file-meta">Quay lại thư mục trước</div>
-                </div>
-            </a>
-'''
+            PARENT_ROW.render(chunks, parent=parent)
+        chunks.extend(rows)
+        if next_page:
+            # Trang tiếp theo (tự tải khi cuộn tới nếu có JavaScript)
+            MORE_ROW.render(chunks, next_page=html.escape(next_page), total=len(index))
+        if not len(index):
+            # Trường hợp thư mục rỗng
+            chunks.append(EMPTY_STATE)
         
-        # Liệt kê thư mục
-        for d in dirs:
-            dir_path = os.path.join(path, d)
-            html_content += f'''
-            <a href="{urllib.parse.quote(dir_path)}" class="file-item">
-                <span class="file-icon folder-icon">📁</span>
-                <div class="file-info">
-                    <div class="file-name">{html.escape(d)}</div>
-                    <div class="file-meta">Thư mục</div>
-                </div>
-                <span class="file-action">Mở</span>
-            </a>
-'''
+        page = PAGE_TEMPLATE.render(
+            [],
+            css_url=ASSET_URLS['style.css'],
+            js_url=ASSET_URLS['app.js'],
+            server_url=SERVER_ADDRESS.url,
+            breadcrumb=self.generate_breadcrumb(path),
+            zip_url=html.escape(urllib.parse.quote(path) + '?format=zip'),
+            search_box=SEARCH_BOX if SEARCH_ENABLED else '',
+            events=events,
+            rows=chunks,
+        )
         
-        # Liệt kê file
-        for f in files:
-            file_path = os.path.join(full_path, f)
-            file_size = os.path.getsize(file_path)
-            mod_time = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%d/%m/%Y %H:%M')
-            download_path = os.path.join(path, f)
-            icon = get_file_icon(f)
-            
-            html_content += f'''
-            <a href="{urllib.parse.quote(download_path)}" class="file-item" download>
-                <span class="file-icon">{icon}</span>
-                <div class="file-info">
-                    <div class="file-name">{html.escape(f)}</div>
-                    <div class="file-meta">{format_size(file_size)} • {mod_time}</div>
-                </div>
-                <span class="file-action">Tải ⬇️</span>
-            </a>
-'''
+        # Gửi response
+        body = ''.join(page).encode()
+        self.add_phase('render', started)
+        self.send_content(body, 'text/html; charset=utf-8', headers)
+    
+    def listing_etag(self, path, st):
+        """Strong ETag for a listing response, or None while the folder may still be changing.
+
+        Made from the folder's inode and mtime plus everything else the
+        response depends on (query, address, asset versions, features), so
+        it can be checked without reading the folder. Like DIR_CACHE it
+        misses edits to a file that leave the folder's mtime alone.
+        """
+        if time.time_ns() - st.st_mtime_ns < DIR_CACHE_SETTLE * 1_000_000_000:
+            return None
+        key = '\0'.join([path, urllib.parse.urlparse(self.path).query, SERVER_ADDRESS.url,
+                         ASSET_URLS['style.css'], ASSET_URLS['app.js'],
+                         str(SEARCH_ENABLED), str(THUMBNAILS_ENABLED), str(EVENTS_ENABLED)])
+        digest = hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+        etag = f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{digest}"'
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if COMPRESSION else None
+        # Each encoding is a different representation; an uncompressed small
+        # page still gets its own tag, which is merely redundant
+        return f'{etag[:-1]}-{encoding}"' if encoding else etag
+    
+    def send_thumbnail(self):
+        """Serve the thumbnail of the image at INTERNAL_PREFIX + 'thumbs/<path>'"""
+        url_path = urllib.parse.urlparse(self.path).path
+        full_path = self.translate_path(url_path[len(INTERNAL_PREFIX + 'thumbs'):])
+        if THUMBNAILS is None or not os.path.isfile(full_path):
+            self.send_error(404, "File not found")
+            return
+        st = os.stat(full_path)
+        if not has_thumbnail(os.path.basename(full_path), st.st_size):
+            self.send_error(404, "No thumbnail for this file")
+            return
+        etag = make_etag(st.st_ino, st.st_size, st.st_mtime_ns)[:-1] + '-thumb"'
+        if etag_in_list(etag, self.headers.get('If-None-Match', ''), weak=True):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            thumb = THUMBNAILS.get(full_path, st)
+        except concurrent.futures.TimeoutError:
+            # Still queued or decoding: the page asks again shortly
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if thumb is None:
+            self.send_error(404, "No thumbnail for this file")
+            return
+        try:
+            with open(thumb, 'rb') as f:
+                content = f.read()
+        except OSError:
+            self.send_error(404, "File not found")  # pruned in the meantime
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', len(content))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+    
+    def send_search(self):
+        """Find names below a folder: JSON results, or listing rows with format=html"""
+        params = self.query_params()
+        query = params.get('q', '').replace('\n', '')
+        glob = params.get('glob', '').replace('\n', '')
+        exts = [e for e in params.get('ext', '').split(',') if e.strip('. ')]
+        kind = params.get('type')
+        under = params.get('path', '/').strip('/')
+        try:
+            limit = max(1, min(MAX_PAGE_SIZE, int(params.get('limit', SEARCH_LIMIT))))
+        except ValueError:
+            limit = SEARCH_LIMIT
+        if (not (query or glob or exts) or (kind and kind not in LISTING_TYPES)
+                or any(part in ('', '.', '..') for part in under.split('/') if under)):
+            self.send_error(400, "Expected q, glob or ext")
+            return
         
-        # Trường hợp thư mục rỗng
-        if not dirs and not files:
-            html_content += '''
-            <div class="empty-state">
-                <div class="icon">📭</div>
-                <p>Thư mục này đang trống</p>
-            </div>
-'''
+        SEARCH_INDEX.start()
+        if not SEARCH_INDEX.ready.wait(SEARCH_WAIT):
+            # First walk of the share still running: the page asks again shortly
+            self.send_json(dict(SEARCH_INDEX.stats(), indexing=True), status=503,
+                           headers=[('Retry-After', '1'), ('Cache-Control', 'no-store')])
+            return
+        started = time.perf_counter()
+        matches, truncated = SEARCH_INDEX.search(query, glob, exts, kind, under, limit)
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
         
-        html_content += '''
-        </div>
+        # Sizes and times come from disk, not the index
+        entries = []
+        for folder, name, _ in matches:
+            rel = join_rel(folder, name)
+            try:
+                st = os.stat(os.path.join(SHARE_DIR, rel))
+            except OSError:
+                continue  # removed since the last rescan
+            is_dir = stat.S_ISDIR(st.st_mode)
+            entries.append(EntryInfo(rel, is_dir, 0 if is_dir else st.st_size,
+                                     st.st_mtime_ns, st.st_ino))
+        headers = [('Cache-Control', 'no-store'), ('X-Search-Time', f'{took_ms}ms')]
         
-        <div class="upload-section">
-            <h3>📤 Upload file từ thiết bị lên Mac</h3>
-            <form class="upload-form" method="POST" enctype="multipart/form-data">
-                <div class="file-input-wrapper">
-                    <span class="file-input-btn">📎 Chọn file</span>
-                    <input type="file" name="file" id="file-input" onchange="updateFileName(this)">
-                </div>
-                <p id="file-name-display">Chưa chọn file nào</p>
-                <button type="submit" class="upload-btn">🚀 Upload</button>
-            </form>
-        </div>
+        if params.get('format') == 'html':
+            rows = []
+            for entry in entries:
+                self.render_entry(rows, '/', entry)
+            if truncated:
+                SEARCH_MORE_ROW.render(rows, limit=limit)
+            if not entries:
+                rows.append(SEARCH_EMPTY)
+            self.send_content(''.join(rows).encode(), 'text/html; charset=utf-8', headers)
+            return
+        self.send_json({
+            'results': [entry_to_json('/', entry) for entry in entries],
+            'truncated': truncated,
+            'took_ms': took_ms,
+            'index': SEARCH_INDEX.stats(),
+        }, headers=headers)
+    
+    def send_digest_lookup(self):
+        """Upload preflight: is a file with this size and digest already shared?
+
+        GET digests?size=N[&sha256=hex|&blake2b=hex][&path=/folder/]
+        -> {"candidates": n, "match": {"name", "path", "url", "size"} | null,
+            "pending": bool}
+
+        Without a digest only the files of that size are counted, so a
+        client hashes its file only when ``candidates`` is not 0.
+        ``pending`` means large candidates are still being hashed in the
+        background: upload anyway, or ask again later.
+        """
+        params = self.query_params()
+        try:
+            size = int(params.get('size', ''))
+        except ValueError:
+            size = -1
+        algorithm = next((name for name in DIGEST_ALGORITHMS if name in params), None)
+        digest = params[algorithm].lower() if algorithm else None
+        directory = self.translate_path(params.get('path', '/'))
+        if size < 0 or (digest is not None and not all(c in string.hexdigits for c in digest)):
+            self.send_error(400, "Expected size and an optional sha256 or blake2b")
+            return
+        if not os.path.isdir(directory):
+            directory = SHARE_DIR
         
-        <footer class="footer">
-            <p>💡 Đảm bảo Mac và thiết bị khác cùng kết nối WiFi</p>
-            <p>Made with ❤️ by Phong Tran | <a href="mailto:mr.yutran@gmail.com" style="color: #00d9a5;">mr.yutran@gmail.com</a></p>
-        </footer>
-    </div>
+        candidates, path, pending = DIGESTS.find(directory, size, algorithm, digest)
+        match = None
+        if path is not None:
+            rel = os.path.relpath(path, SHARE_DIR).replace(os.sep, '/')
+            match = {'name': os.path.basename(path), 'path': '/' + rel,
+                     'url': '/' + urllib.parse.quote(rel), 'size': size}
+        self.send_json({'candidates': candidates, 'match': match, 'pending': pending},
+                       headers=[('Cache-Control', 'no-store')])
     
-    <script>
-        function updateFileName(input) {
-            const display = document.getElementById('file-name-display');
-            if (input.files.length > 0) {
-                display.textContent = '📄 ' + input.files[0].name;
-                display.style.color = '#00d9a5';
-            } else {
-                display.textContent = 'Chưa chọn file nào';
-                display.style.color = 'rgba(255, 255, 255, 0.7)';
-            }
-        }
+    def send_metrics(self):
+        """Request metrics, cache hit counts and gauges in the Prometheus text format"""
+        gauges = [('fileshare_listing_cache_bytes', (), DIR_CACHE.size),
+                  ('fileshare_hot_file_cache_bytes', (), HOT_FILES.size)]
+        caches = [('listing', DIR_CACHE), ('hot_files', HOT_FILES), ('compressed', COMPRESS_CACHE),
+                  ('digests', DIGESTS)]
+        if THUMBNAILS is not None:
+            caches.append(('thumbnails', THUMBNAILS))
+        for name, cache in caches:
+            gauges.append(('fileshare_cache_hits_total', (('cache', name),), cache.hits))
+            gauges.append(('fileshare_cache_misses_total', (('cache', name),), cache.misses))
+        connections = getattr(self.server, 'connection_count', None)
+        if connections is not None:
+            gauges.append(('fileshare_connections', (), connections))
+        if EVENTS_ENABLED:
+            gauges.append(('fileshare_event_streams', (), CHANGE_FEED.streams))
+        for direction, scheduler in (('download', DOWNLOAD_SCHEDULER), ('upload', UPLOAD_SCHEDULER)):
+            if scheduler.enabled:
+                gauges.append(('fileshare_shaped_transfers_waiting', (('direction', direction),),
+                               scheduler.waiting))
+        if SEARCH_ENABLED and SEARCH_INDEX.ready.is_set():
+            gauges.append(('fileshare_search_index_entries', (), SEARCH_INDEX.entries))
+        logs = [('console', CONSOLE)]
+        if ACCESS_LOG is not None and ACCESS_LOG is not CONSOLE:
+            logs.append(('access', ACCESS_LOG))
+        for name, log in logs:
+            gauges.append(('fileshare_log_queued_lines', (('log', name),), log.queued))
+            gauges.append(('fileshare_log_dropped_lines_total', (('log', name),), log.dropped))
+        self.send_content(METRICS.render(gauges).encode(), 'text/plain; version=0.0.4; charset=utf-8',
+                          [('Cache-Control', 'no-store')])
+    
+    def send_change_events(self):
+        """Stream changes to the folder at INTERNAL_PREFIX + 'events/<path>' as Server-Sent Events"""
+        url_path = urllib.parse.urlparse(self.path).path[len(INTERNAL_PREFIX + 'events'):]
+        full_path = self.translate_path(url_path)
+        if not os.path.isdir(full_path):
+            self.send_error(404, "Folder not found")
+            return
+        params = self.query_params()
+        last_id = self.headers.get('Last-Event-ID') or params.get('last_id')
+        subscription = CHANGE_FEED.subscribe(full_path, last_id, params.get('since'))
+        if subscription is None:
+            # Every stream holds a worker: past the cap pages go without live updates
+            self.send_response(503)
+            self.send_header('Retry-After', '30')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-store')
+            writer = self.stream_writer()
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.stream_events(writer, subscription, urllib.parse.unquote(url_path))
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+        finally:
+            CHANGE_FEED.unsubscribe(subscription)
+    
+    def stream_events(self, writer, subscription, path):
+        """Write events until the stream is old, the server needs the worker, or it stops"""
+        base = path if path.endswith('/') else path + '/'
+        busy = getattr(self.server, 'has_waiting_connections', None)
+        writer.write(b'retry: 3000\n\n')
+        writer.flush()
+        started = last_write = time.monotonic()
+        while True:
+            event = subscription.get(timeout=1)
+            while event is not None:
+                event_id, kind, entry = event
+                data = {}
+                if entry is not None:
+                    data = entry_to_json(base, entry)
+                    if kind != 'remove':
+                        rows = []
+                        self.render_entry(rows, path, entry)
+                        data['html'] = ''.join(rows).strip()
+                writer.write(f"id: {event_id}\nevent: {kind}\ndata: "
+                             f"{json.dumps(data, ensure_ascii=False)}\n\n".encode())
+                event = subscription.get(timeout=0)
+            now = time.monotonic()
+            if subscription.overflowed:
+                writer.write(b'event: reset\ndata: {}\n\n')
+                break
+            if (CHANGE_FEED.closed or now - started > EVENT_STREAM_MAX_AGE
+                    or (busy is not None and busy())):
+                break
+            if writer.buffer:
+                last_write = now
+            elif now - last_write >= EVENT_HEARTBEAT:
+                writer.write(b': ping\n\n')  # finds dead clients and keeps proxies from timing out
+                last_write = now
+            writer.flush()
+        writer.close()
+    
+    def send_asset(self, path):
+        """Serve a versioned static asset with long-lived caching"""
+        asset = STATIC_ASSETS.get(path)
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        content, ctype, etag, variants = asset
+        encoding = None
+        if COMPRESSION:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+            if encoding in variants:
+                content = variants[encoding]
+                etag = f'{etag[:-1]}-{encoding}"'
+            else:
+                encoding = None
+        not_modified = etag_in_list(etag, self.headers.get('If-None-Match', ''), weak=True)
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', len(content))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.end_headers()
+        if not not_modified and self.command != 'HEAD':
+            self.wfile.write(content)
+    
+    def send_directory_json(self, path, index, params, headers=()):
+        """Stream a directory as JSON or NDJSON for scripts.
+
+        Query parameters: sort=name|size|mtime, order=asc|desc,
+        type=dir|file, q=substring, ext=jpg,png, offset=N, limit=N.
+        """
+        entries = index.entries
         
-        function copyToClipboard(text) {
-            if (navigator.clipboard && window.isSecureContext) {
-                navigator.clipboard.writeText(text).then(function() {
-                    alert('✅ Đã sao chép URL vào clipboard!');
-                }, function(err) {
-                    fallbackCopyTextToClipboard(text);
-                });
-            } else {
-                fallbackCopyTextToClipboard(text);
-            }
-        }
+        # Filters
+        kind = params.get('type')
+        if kind in LISTING_TYPES:
+            want_dir = kind == 'dir'
+            entries = [e for e in entries if e.is_dir == want_dir]
+        query = params.get('q', '').lower()
+        if query:
+            entries = [e for e in entries if query in e.name.lower()]
+        exts = params.get('ext')
+        if exts:
+            suffixes = tuple('.' + x.strip().lower().lstrip('.') for x in exts.split(',') if x.strip())
+            entries = [e for e in entries if not e.is_dir and e.name.lower().endswith(suffixes)]
         
-        function fallbackCopyTextToClipboard(text) {
-            const textArea = document.createElement("textarea");
-            textArea.value = text;
-            textArea.style.position = "fixed";
-            textArea.style.left = "-999999px";
-            textArea.style.top = "-999999px";
-            document.body.appendChild(textArea);
-            textArea.focus();
-            textArea.select();
-            try {
-                document.execCommand('copy');
-                alert('✅ Đã sao chép URL vào clipboard!');
-            } catch (err) {
-                alert('❌ Không thể sao chép. Vui lòng chọn và copy thủ công: ' + text);
-            }
-            document.body.removeChild(textArea);
-        }
-    </script>
-</body>
-</html>
-'''
+        # Sort
+        sort = params.get('sort', 'name')
+        if sort not in LISTING_SORT_KEYS:
+            self.send_error(400, f"Unknown sort: {sort}")
+            return
+        reverse = params.get('order') == 'desc'
+        if LISTING_SORT_KEYS[sort] is not None:
+            entries = sorted(entries, key=LISTING_SORT_KEYS[sort], reverse=reverse)
+        elif reverse:
+            entries = entries[::-1]
         
-        # Gửi response
+        # Window
+        try:
+            offset = max(0, int(params.get('offset', 0)))
+            limit = int(params['limit']) if 'limit' in params else None
+        except ValueError:
+            self.send_error(400, "Invalid offset or limit")
+            return
+        total = len(entries)
+        entries = entries[offset:] if limit is None else entries[offset:offset + max(0, limit)]
+        
+        ndjson = params['format'] == 'ndjson'
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if COMPRESSION else None
+        compressor = COMPRESSORS[encoding]() if encoding else None
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson' if ndjson else 'application/json')
+        self.send_header('X-Total-Count', str(total))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if COMPRESSION:
+            self.send_header('Vary', 'Accept-Encoding')
+        for name, value in headers:
+            self.send_header(name, value)
+        writer = self.stream_writer()
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        
+        def emit(data):
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                writer.write(data)
+        
+        base = path.rstrip('/') + '/'
+        dumps = json.JSONEncoder(ensure_ascii=False).encode
+        try:
+            if not ndjson:
+                emit(f'{{"path": {dumps(path)}, "total": {total}, "entries": ['.encode())
+            for i in range(0, len(entries), JSON_BATCH):
+                items = [dumps(entry_to_json(base, e)) for e in entries[i:i + JSON_BATCH]]
+                if ndjson:
+                    chunk = '\n'.join(items) + '\n'
+                else:
+                    chunk = (',' if i else '') + ','.join(items)
+                emit(chunk.encode())
+            if not ndjson:
+                emit(b']}')
+            if compressor:
+                writer.write(compressor.flush())
+            writer.close()
+        except (ConnectionResetError, BrokenPipeError):
+            self.close_connection = True
+    
+    def stream_writer(self, transfer=None):
+        """Frame a body of unknown length: chunked for HTTP/1.1, close-delimited for 1.0.
+
+        Call between send_response() and end_headers().
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        return ResponseWriter(self.wfile, chunked, transfer=transfer)
+    
+    def send_directory_zip(self, path, full_path):
+        """Stream a folder and everything below it as a ZIP64 archive.
+
+        Nothing is buffered beyond one block or spooled to disk: the
+        archive is written straight to the socket with data descriptors
+        after each file. Media and archives are stored, the rest deflated.
+        """
+        name = os.path.basename(full_path.rstrip('/')) or 'files'
+        filename = name + '.zip'
+        ascii_name = filename.encode('ascii', 'replace').decode().replace('?', '_').replace('"', '_')
         self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Content-Length', len(html_content.encode()))
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{ascii_name}"; '
+                         f"filename*=UTF-8''{urllib.parse.quote(filename)}")
+        # Size unknown up front: an archive always counts as bulk
+        transfer = DOWNLOAD_SCHEDULER.transfer(self.client_address[0], SHAPING_MIN_SIZE)
+        writer = self.stream_writer(transfer if transfer.shaped else None)
         self.end_headers()
-        self.wfile.write(html_content.encode())
+        if self.command == 'HEAD':
+            return
+        
+        files = 0
+        try:
+            archive = zipfile.ZipFile(writer, 'w', allowZip64=True)
+            for source, arcname, is_dir in walk_share(full_path):
+                if is_dir:
+                    archive.writestr(zipfile.ZipInfo.from_file(source, arcname, strict_timestamps=False), b'')
+                    continue
+                try:
+                    f = open(source, 'rb')
+                except OSError as e:
+                    CONSOLE.write(f"⚠️  Skipped in ZIP: {arcname} ({e})")
+                    continue
+                with f:
+                    info = zipfile.ZipInfo.from_file(source, arcname, strict_timestamps=False)
+                    info.compress_type = zip_compress_type(arcname, info.file_size)
+                    remaining = info.file_size  # the size zip64 was decided on
+                    with archive.open(info, 'w') as dest:
+                        while remaining > 0:
+                            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            remaining -= len(chunk)
+                files += 1
+            archive.close()
+            writer.close()
+        except (ConnectionResetError, BrokenPipeError):
+            self.close_connection = True
+            return
+        except OSError as e:
+            # Too late for an error page: a cut-off body tells the client
+            CONSOLE.write(f"❌ Error sending ZIP of {path}: {e}")
+            self.close_connection = True
+            return
+        CONSOLE.write(f"📦 Sent {path} as ZIP ({files} files)")
+    
+    def render_entry(self, out, path, entry):
+        """Append the HTML row for one directory entry to ``out``"""
+        url = urllib.parse.quote(os.path.join(path, entry.name))
+        name = html.escape(entry.name)
+        if entry.is_dir:
+            DIR_ROW.render(out, url=url, name=name)
+            return
+        mod_time = datetime.fromtimestamp(entry.mtime_ns / 1e9).strftime('%d/%m/%Y %H:%M')
+        thumb = ''
+        if has_thumbnail(entry.name, entry.size):
+            thumb = f' data-thumb="{INTERNAL_PREFIX}thumbs{url}?v={entry.mtime_ns:x}"'
+        FILE_ROW.render(out, url=url, name=name, icon=get_file_icon(entry.name), thumb=thumb,
+                        meta=f"{format_size(entry.size)} • {mod_time}")
     
     def generate_breadcrumb(self, path):
         """Tạo breadcrumb navigation"""
@@ -769,13 +5563,9 @@ class FileShareHandler(http.server.SimpleHTTPRequestHandler):
         except UnicodeEncodeError:
             ascii_message = 'Error'  # Fallback to ASCII
         
-        # Send response line with ASCII message
-        self.send_response_only(code, ascii_message)
-        
-        # Send headers
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Connection', 'close')
-        self.end_headers()
+        # A request body we never read would be parsed as the next request
+        if self.request_has_body() and not getattr(self, 'body_consumed', False):
+            self.close_connection = True
         
         # Send HTML body with proper encoding
         content = f'''<!DOCTYPE html>
@@ -790,13 +5580,414 @@ class FileShareHandler(http.server.SimpleHTTPRequestHandler):
     <hr>
     <address>{self.version_string()}</address>
 </body>
-</html>'''
+</html>'''.encode('utf-8')
+        
+        # Send response line with ASCII message
+        self.send_response_only(code, ascii_message)
+        
+        # Send headers
+        if code < 200 or code in (204, 304):
+            content = b''
+        else:
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
         
-        self.wfile.write(content.encode('utf-8'))
+        if self.command != 'HEAD' and content:
+            self.wfile.write(content)
+    
+    def log_request(self, code='-', size='-'):
+        """Requests are logged by log_access once the response is complete"""
     
     def log_message(self, format, *args):
         """Custom log format"""
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] {args[0]}")
+        CONSOLE.write(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
+
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """TCP server that hands connections to a bounded pool of worker threads.
+
+    At most ``max_connections`` connections are accepted at once: ``workers``
+    of them are being served, the rest wait in the pool queue. Anything above
+    that gets a short 503 reply instead of an extra thread.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    BUSY_RESPONSE = (
+        b"HTTP/1.0 503 Service Unavailable\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"Content-Length: 12\r\n"
+        b"Retry-After: 1\r\n"
+        b"Connection: close\r\n"
+        b"\r\n"
+        b"Server busy\n"
+    )
+
+    def __init__(self, server_address, handler_class, workers=WORKERS,
+                 max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.max_connections = max(max_connections, workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fileshare')
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._lock = threading.Lock()
+        self._active = set()
+        self._idle = threading.Condition(self._lock)
+        self._draining = False
+
+    @property
+    def connection_count(self):
+        """Number of connections currently being served or queued"""
+        with self._lock:
+            return len(self._active)
+
+    def process_request(self, request, client_address):
+        """Queue the connection on the pool, or reject it when we are full"""
+        if self._draining or not self._slots.acquire(blocking=False):
+            METRICS.inc('fileshare_rejected_connections_total')
+            try:
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        with self._lock:
+            self._active.add(request)
+        self.pool.submit(self._serve_connection, request, client_address)
+
+    def _serve_connection(self, request, client_address):
+        try:
+            if not self._draining:
+                self.finish_request(request, client_address)
+        except Exception:
+            if not self._draining:
+                self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._active.discard(request)
+                if not self._active:
+                    self._idle.notify_all()
+            self._slots.release()
+
+    def handle_error(self, request, client_address):
+        log_request_error(client_address)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Stop accepting, let in-flight requests finish, then cut the rest"""
+        self._draining = True
+        self.socket.close()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            leftovers = list(self._active)
+        for request in leftovers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.pool.shutdown(wait=True)
+        return len(leftovers)
+
+    def has_waiting_connections(self):
+        """True when accepted connections are queued for a free worker"""
+        with self._lock:
+            return self._draining or len(self._active) > self.workers
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def parse_request_head(head):
+    """Parse a raw HTTP/1.x request head into (method, target, version, headers)"""
+    lines = head.rstrip(b'\r\n').split(b'\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith(b'HTTP/1.'):
+        raise ValueError("Bad request line")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep or not name.strip():
+            raise ValueError("Bad header line")
+        headers[name.strip().lower().decode('latin-1')] = value.strip().decode('latin-1')
+    method, target, version = (part.decode('latin-1') for part in parts)
+    return method, target, version, headers
+
+
+class _AsyncStream:
+    """Blocking file-like view of an asyncio connection for a worker thread.
+
+    FileShareHandler reads through ``rfile`` and writes through ``wfile``
+    as if it had a socket; every call is run on the event loop. The
+    request head, already read by the loop, is replayed first.
+    """
+
+    def __init__(self, loop, reader, writer, head, timeout, calls):
+        self._loop = loop
+        self._reader = reader
+        self._writer = writer
+        self._buffer = bytearray(head)
+        self._timeout = timeout
+        self._calls = calls  # pending loop calls, cancelled by drain()
+        self.bytes_read = 0
+
+    def _call(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        self._calls.add(future)
+        try:
+            return future.result(timeout or self._timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise socket.timeout("Connection idle for too long")
+        except concurrent.futures.CancelledError:
+            raise ConnectionResetError("Connection closed by server")
+        finally:
+            self._calls.discard(future)
+
+    def _take(self, n):
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    # rfile
+    def read(self, n=-1):
+        """``n`` bytes, fewer only at EOF, as from a buffered file; all until EOF without ``n``"""
+        if n is None or n < 0:
+            head = self._take(len(self._buffer))
+            data = self._call(self._reader.read())
+        else:
+            head = self._take(n)
+            if len(head) == n:
+                return head
+            try:
+                data = self._call(self._reader.readexactly(n - len(head)))
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+        self.bytes_read += len(data)
+        return head + data
+
+    def readline(self, limit=-1):
+        if self._buffer:
+            end = self._buffer.find(b'\n')
+            if end != -1:
+                return self._take(end + 1)
+            return self._take(len(self._buffer))
+        data = self._call(self._reader.readline())
+        self.bytes_read += len(data)
+        return data
+
+    # wfile
+    def write(self, data):
+        self._call(self._write(bytes(data)))
+        return len(data)
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def flush(self):
+        pass
+
+    # connection
+    def sendfile(self, f, offset=0, count=None):
+        """Zero-copy file send through loop.sendfile, a slice at a time"""
+        transport = self._writer.transport
+        sent = 0
+        while count is None or sent < count:
+            size = DOWNLOAD_CHUNK_SIZE * 32
+            if count is not None:
+                size = min(size, count - sent)
+            n = self._call(self._loop.sendfile(transport, f, offset + sent, size))
+            if not n:
+                break
+            sent += n
+        return sent
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+
+class AsyncioHTTPServer:
+    """HTTP/1.1 front end built on asyncio.start_server.
+
+    The event loop accepts connections, waits for request heads and parses
+    them, so idle keep-alive connections cost a coroutine instead of a
+    thread. Each complete request is handed to FileShareHandler on a
+    bounded thread pool, the same routing the threaded engine uses, with
+    reads and writes bridged back to the loop and downloads going through
+    loop.sendfile.
+    """
+
+    MAX_HEAD_SIZE = 64 * 1024
+
+    def __init__(self, server_address, handler_class, workers=WORKERS,
+                 max_connections=ASYNC_MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 keepalive_timeout=IDLE_TIMEOUT):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fileshare')
+        self.loop = asyncio.new_event_loop()
+        self._busy = set()   # writers with a request in progress
+        self._idle = set()   # writers waiting for the next request
+        self._tasks = set()  # connection coroutines
+        self._calls = set()  # loop calls made by worker threads
+        self._draining = False
+        self._server = self.loop.run_until_complete(asyncio.start_server(
+            self._serve_connection, host=server_address[0] or None, port=server_address[1],
+            reuse_address=True, limit=self.MAX_HEAD_SIZE, backlog=128))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server_close()
+
+    @property
+    def connection_count(self):
+        return len(self._busy) + len(self._idle)
+
+    def has_waiting_connections(self):
+        return False  # idle connections wait on the loop, not on a worker
+
+    def serve_forever(self):
+        # Ctrl+C stops the loop between callbacks instead of inside a request
+        interrupted = []
+        def on_sigint():
+            interrupted.append(True)
+            self.loop.stop()
+        try:
+            self.loop.add_signal_handler(signal.SIGINT, on_sigint)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # Windows or not the main thread: KeyboardInterrupt as usual
+        try:
+            self.loop.run_forever()
+        finally:
+            try:
+                self.loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+        if interrupted:
+            raise KeyboardInterrupt
+
+    async def _serve_connection(self, reader, writer):
+        if self._draining or self.connection_count >= self.max_connections:
+            METRICS.inc('fileshare_rejected_connections_total')
+            writer.write(ThreadPoolHTTPServer.BUSY_RESPONSE)
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        timeout = self.idle_timeout
+        try:
+            while not self._draining:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    self._idle.discard(writer)
+                try:
+                    _, _, _, headers = parse_request_head(head)
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n"
+                                 b"Connection: close\r\n\r\n")
+                    break
+                self._busy.add(writer)
+                try:
+                    keep_alive = await self.loop.run_in_executor(
+                        self.pool, self._handle_request, reader, writer, head, length)
+                finally:
+                    self._busy.discard(writer)
+                if not keep_alive:
+                    break
+                timeout = self.keepalive_timeout
+        finally:
+            writer.close()
+            self._tasks.discard(task)
+
+    def _handle_request(self, reader, writer, head, length):
+        """Run one request through the handler on a worker thread"""
+        stream = _AsyncStream(self.loop, reader, writer, head, self.idle_timeout, self._calls)
+        client_address = writer.get_extra_info('peername') or ('', 0)
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.request = handler.connection = stream
+        handler.client_address = client_address[:2]
+        handler.server = self
+        handler.directory = SHARE_DIR
+        handler.rfile = handler.wfile = stream
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except (ConnectionError, socket.timeout):
+            return False
+        except Exception:
+            if not self._draining:
+                log_request_error(client_address)
+            return False
+        # A body the handler did not read would be parsed as the next request
+        return not handler.close_connection and stream.bytes_read >= length
+
+    async def _drain(self, timeout):
+        self._server.close()
+        for writer in list(self._idle):
+            writer.close()
+        deadline = self.loop.time() + timeout
+        while self._busy and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        leftovers = list(self._busy)
+        if leftovers:
+            # Aborting mid-sendfile makes asyncio log spurious callback errors
+            self.loop.set_exception_handler(lambda loop, context: None)
+        for writer in leftovers:
+            writer.transport.abort()
+        # Workers blocked on the aborted connections get ConnectionResetError
+        while self._busy:
+            for future in list(self._calls):
+                future.cancel()
+            await asyncio.sleep(0.05)
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=1)
+        return len(leftovers)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Stop accepting, let in-flight requests finish, then cut the rest"""
+        self._draining = True
+        cut = self.loop.run_until_complete(self._drain(timeout))
+        self.pool.shutdown(wait=True)
+        return cut
+
+    def server_close(self):
+        if not self.loop.is_closed():
+            self._server.close()
+            self.pool.shutdown(wait=False)
+            self.loop.close()
+
+
+def create_server(engine, port):
+    """Build the server for the chosen engine"""
+    if engine == 'single':
+        return socketserver.TCPServer(("", port), FileShareHandler)
+    if engine == 'asyncio':
+        return AsyncioHTTPServer(("", port), FileShareHandler, workers=WORKERS,
+                                 max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                                 keepalive_timeout=KEEPALIVE_TIMEOUT)
+    return ThreadPoolHTTPServer(("", port), FileShareHandler,
+                                workers=WORKERS, max_connections=MAX_CONNECTIONS)
 
 
 def generate_simple_qr_ascii(url):
@@ -819,28 +6010,165 @@ def generate_simple_qr_ascii(url):
 """
     return qr_art
 
+def parse_args(argv=None):
+    """Command line: share directory, port and serving options"""
+    parser = argparse.ArgumentParser(
+        description="🍎 Mac File Share - Share files across devices")
+    parser.add_argument('directory', nargs='?', default=SHARE_DIR,
+                        help="directory to share (default: ~/Downloads)")
+    parser.add_argument('port', nargs='?', default=str(PORT),
+                        help=f"port to listen on (default: {PORT})")
+    parser.add_argument('--download-rate', type=float, default=DOWNLOAD_RATE / 1e6, metavar='MB/S',
+                        help="total bandwidth for large downloads, shared fairly (default: unlimited)")
+    parser.add_argument('--upload-rate', type=float, default=UPLOAD_RATE / 1e6, metavar='MB/S',
+                        help="total bandwidth for large uploads (default: unlimited)")
+    parser.add_argument('--client-download-rate', type=float, default=CLIENT_DOWNLOAD_RATE / 1e6,
+                        metavar='MB/S', help="download bandwidth per client address (default: unlimited)")
+    parser.add_argument('--client-upload-rate', type=float, default=CLIENT_UPLOAD_RATE / 1e6,
+                        metavar='MB/S', help="upload bandwidth per client address (default: unlimited)")
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE,
+                        help=f"serving engine (default: {ENGINE})")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f"threads serving requests (default: {WORKERS})")
+    parser.add_argument('--max-connections', type=int,
+                        help=f"open connections allowed at once (default: {MAX_CONNECTIONS}, "
+                             f"{ASYNC_MAX_CONNECTIONS} for asyncio)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds before an idle connection is dropped (default: {IDLE_TIMEOUT})")
+    parser.add_argument('--keepalive-timeout', type=float,
+                        help=f"seconds a kept-alive connection waits for its next request "
+                             f"(default: {KEEPALIVE_TIMEOUT}, the idle timeout for asyncio)")
+    parser.add_argument('--host', metavar='ADDRESS',
+                        help="advertise this address instead of detecting the local IP")
+    parser.add_argument('--ip-refresh', type=float, default=IP_REFRESH_INTERVAL, metavar='SECONDS',
+                        help=f"re-detect the local IP this often, 0 = only on SIGHUP (default: {IP_REFRESH_INTERVAL})")
+    parser.add_argument('--dir-cache-mb', type=float, default=DIR_CACHE_MAX_BYTES / 1024 / 1024,
+                        help=f"memory for cached directory listings in MB (default: {DIR_CACHE_MAX_BYTES // 1024 // 1024})")
+    parser.add_argument('--hot-cache-mb', type=float, default=HOT_CACHE_MAX_BYTES / 1024 / 1024,
+                        help=f"memory for small files served from RAM in MB, 0 = off "
+                             f"(default: {HOT_CACHE_MAX_BYTES // 1024 // 1024})")
+    parser.add_argument('--hot-file-kb', type=float, default=HOT_FILE_MAX_SIZE / 1024,
+                        help=f"largest file kept in that memory in KB (default: {HOT_FILE_MAX_SIZE // 1024})")
+    parser.add_argument('--on-conflict', choices=UPLOAD_CONFLICTS, default=UPLOAD_CONFLICT,
+                        help=f"when an upload's name is taken by a different file: save it as "
+                             f"'name (1).ext', skip it or overwrite (default: {UPLOAD_CONFLICT})")
+    parser.add_argument('--no-compress', action='store_true',
+                        help="never gzip/brotli/zstd-compress responses")
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f"directory for on-disk caches (default: {CACHE_DIR})")
+    parser.add_argument('--no-thumbnails', action='store_true',
+                        help="show emoji icons instead of image thumbnails")
+    parser.add_argument('--no-search', action='store_true',
+                        help="turn off recursive filename search (and its in-memory index)")
+    parser.add_argument('--search-rescan', type=float, default=SEARCH_RESCAN_INTERVAL, metavar='SECONDS',
+                        help=f"check indexed folders for changes this often, 0 = never "
+                             f"(default: {SEARCH_RESCAN_INTERVAL})")
+    parser.add_argument('--max-event-streams', type=int, metavar='N',
+                        help="live-update streams open at once, 0 = no live updates "
+                             "(default: half the workers)")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help=f"don't time requests or serve {INTERNAL_PREFIX}metrics")
+    parser.add_argument('--access-log', default='-', metavar='FILE',
+                        help="where to log requests: '-' for the console, a file (rotated), "
+                             "or 'off' (default: -)")
+    parser.add_argument('--access-log-format', choices=ACCESS_LOG_FORMATS,
+                        help="text lines or JSON lines (default: text on the console, json in a file)")
+    parser.add_argument('--access-log-sample', type=float, default=ACCESS_LOG_SAMPLE, metavar='FRACTION',
+                        help="share of successful requests to log; errors are always logged "
+                             f"(default: {ACCESS_LOG_SAMPLE:g})")
+    parser.add_argument('--access-log-max-mb', type=float, default=ACCESS_LOG_MAX_BYTES / 1024 / 1024,
+                        help=f"rotate the log file at this size in MB, 0 = never "
+                             f"(default: {ACCESS_LOG_MAX_BYTES // 1024 // 1024})")
+    parser.add_argument('--access-log-backups', type=int, default=ACCESS_LOG_BACKUPS, metavar='N',
+                        help=f"rotated log files to keep (default: {ACCESS_LOG_BACKUPS})")
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help="copy downloads through Python instead of sendfile()")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help=f"seconds to let requests finish on Ctrl+C (default: {DRAIN_TIMEOUT})")
+    return parser.parse_args(argv)
+
 def main():
-    global SHARE_DIR, PORT
+    global SHARE_DIR, PORT, ENGINE, WORKERS, MAX_CONNECTIONS, IDLE_TIMEOUT, DRAIN_TIMEOUT, KEEPALIVE_TIMEOUT
+    global USE_SENDFILE, SERVER_ADDRESS, COMPRESSION, CACHE_DIR, COMPRESS_CACHE, UPLOADS, DIGESTS
+    global THUMBNAILS_ENABLED, THUMBNAILS, SEARCH_ENABLED, SEARCH_INDEX
+    global EVENTS_ENABLED, CHANGE_FEED, METRICS_ENABLED, DOWNLOAD_SCHEDULER, UPLOAD_SCHEDULER
+    global UPLOAD_CONFLICT, ACCESS_LOG, ACCESS_LOG_SAMPLE
     
     # Process arguments
-    if len(sys.argv) > 1:
-        custom_dir = os.path.expanduser(sys.argv[1])
-        if os.path.isdir(custom_dir):
-            SHARE_DIR = custom_dir
-        else:
-            print(f"❌ Directory does not exist: {sys.argv[1]}")
-            sys.exit(1)
+    args = parse_args()
+    custom_dir = os.path.expanduser(args.directory)
+    if os.path.isdir(custom_dir):
+        SHARE_DIR = custom_dir
+    else:
+        print(f"❌ Directory does not exist: {args.directory}")
+        sys.exit(1)
+    
+    try:
+        PORT = int(args.port)
+    except ValueError:
+        print("❌ Invalid port")
+        sys.exit(1)
     
-    if len(sys.argv) > 2:
+    ENGINE = args.engine
+    WORKERS = max(1, args.workers)
+    if args.max_connections is None:
+        args.max_connections = ASYNC_MAX_CONNECTIONS if ENGINE == 'asyncio' else MAX_CONNECTIONS
+    MAX_CONNECTIONS = max(WORKERS, args.max_connections)
+    IDLE_TIMEOUT = args.idle_timeout if args.idle_timeout > 0 else None
+    DRAIN_TIMEOUT = max(0, args.drain_timeout)
+    if args.keepalive_timeout is not None:
+        KEEPALIVE_TIMEOUT = max(0, args.keepalive_timeout)
+    elif ENGINE == 'asyncio':
+        KEEPALIVE_TIMEOUT = IDLE_TIMEOUT
+    FileShareHandler.timeout = IDLE_TIMEOUT
+    if args.no_sendfile:
+        USE_SENDFILE = False
+    DIR_CACHE.max_bytes = int(args.dir_cache_mb * 1024 * 1024)
+    HOT_FILES.max_bytes = int(args.hot_cache_mb * 1024 * 1024)
+    HOT_FILES.max_file_size = int(args.hot_file_kb * 1024)
+    COMPRESSION = not args.no_compress
+    UPLOAD_CONFLICT = args.on_conflict
+    CACHE_DIR = os.path.abspath(os.path.expanduser(args.cache_dir))
+    COMPRESS_CACHE = CompressionCache(os.path.join(CACHE_DIR, 'compressed'))
+    UPLOADS = UploadManager(os.path.join(CACHE_DIR, 'uploads'))
+    DIGESTS = DigestCache(os.path.join(CACHE_DIR, 'digests.log'))
+    THUMBNAILS_ENABLED = THUMBNAILS_ENABLED and not args.no_thumbnails
+    THUMBNAILS = ThumbnailService(os.path.join(CACHE_DIR, 'thumbnails')) if THUMBNAILS_ENABLED else None
+    SEARCH_ENABLED = not args.no_search
+    METRICS_ENABLED = not args.no_metrics
+    DOWNLOAD_SCHEDULER = TransferScheduler(int(max(0, args.download_rate) * 1e6),
+                                           int(max(0, args.client_download_rate) * 1e6))
+    UPLOAD_SCHEDULER = TransferScheduler(int(max(0, args.upload_rate) * 1e6),
+                                         int(max(0, args.client_upload_rate) * 1e6))
+    SEARCH_INDEX = SearchIndex(SHARE_DIR, interval=max(0, args.search_rescan))
+    ACCESS_LOG_SAMPLE = min(1.0, max(0.0, args.access_log_sample))
+    if args.access_log == 'off':
+        ACCESS_LOG = None
+    elif args.access_log == '-':
+        CONSOLE.format = args.access_log_format or 'text'
+        ACCESS_LOG = CONSOLE
+    else:
+        log_path = os.path.abspath(os.path.expanduser(args.access_log))
         try:
-            PORT = int(sys.argv[2])
-        except ValueError:
-            print("❌ Invalid port")
+            open(log_path, 'ab').close()
+        except OSError as e:
+            print(f"❌ Cannot open access log {args.access_log}: {e}")
             sys.exit(1)
+        ACCESS_LOG = LogWriter(log_path, args.access_log_format or 'json',
+                               int(max(0, args.access_log_max_mb) * 1024 * 1024),
+                               max(0, args.access_log_backups))
+    if args.max_event_streams is None:
+        args.max_event_streams = WORKERS // 2
+    # The single engine would spend its only thread on one stream
+    EVENTS_ENABLED = ENGINE != 'single' and args.max_event_streams > 0
+    CHANGE_FEED = ChangeFeed(max(0, args.max_event_streams))
     
-    # Get IP
-    local_ip = get_local_ip()
-    server_url = f"http://{local_ip}:{PORT}"
+    # Get IP once; listings read the cached value
+    SERVER_ADDRESS = ServerAddress(pinned=args.host, interval=max(0, args.ip_refresh))
+    SERVER_ADDRESS.start()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, SERVER_ADDRESS.request_refresh)
+    server_url = SERVER_ADDRESS.url
     
     # Banner
     print("\n" + "="*70)
@@ -848,6 +6176,26 @@ def main():
     print("="*70)
     print(f"\n  📁 Share directory: {SHARE_DIR}")
     print(f"\n  🌐 Access URL: {server_url}")
+    if ENGINE in ('threads', 'asyncio'):
+        print(f"\n  🧵 Engine: {ENGINE} ({WORKERS} workers, max {MAX_CONNECTIONS} connections)")
+    else:
+        print(f"\n  🧵 Engine: {ENGINE}")
+    if Image is None and not args.no_thumbnails:
+        print("\n  🖼️  Thumbnails: off (pip3 install Pillow to show photo previews)")
+    for direction, scheduler in (('Downloads', DOWNLOAD_SCHEDULER), ('Uploads', UPLOAD_SCHEDULER)):
+        limits = []
+        if scheduler.rate:
+            limits.append(f"{scheduler.rate / 1e6:g} MB/s total")
+        if scheduler.client_rate:
+            limits.append(f"{scheduler.client_rate / 1e6:g} MB/s per client")
+        if limits:
+            print(f"\n  🚦 {direction} over {SHAPING_MIN_SIZE // 1024 // 1024} MB: {', '.join(limits)}")
+    
+    if ACCESS_LOG is not None and (ACCESS_LOG is not CONSOLE or ACCESS_LOG.format != 'text'
+                                   or ACCESS_LOG_SAMPLE < 1):
+        where = 'console' if ACCESS_LOG is CONSOLE else ACCESS_LOG.path
+        sampled = f", {ACCESS_LOG_SAMPLE:.0%} of successful requests" if ACCESS_LOG_SAMPLE < 1 else ''
+        print(f"\n  📝 Access log: {where} ({ACCESS_LOG.format}{sampled})")
     
     # Display QR code ASCII
     print(f"\n{generate_simple_qr_ascii(server_url)}")
@@ -857,14 +6205,24 @@ def main():
     print("\n" + "="*70 + "\n")
     
     # Start server
-    with socketserver.TCPServer(("", PORT), FileShareHandler) as httpd:
+    with create_server(ENGINE, PORT) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
+            CHANGE_FEED.close()
+            if isinstance(httpd, (ThreadPoolHTTPServer, AsyncioHTTPServer)):
+                pending = httpd.connection_count
+                if pending:
+                    print(f"\n\n⏳ Waiting for {pending} connection(s) to finish...")
+                cut = httpd.drain(DRAIN_TIMEOUT)
+                if cut:
+                    print(f"⚠️  Closed {cut} unfinished connection(s)")
+            if ACCESS_LOG is not None:
+                ACCESS_LOG.close()
+            CONSOLE.close()
             print("\n\n👋 Server stopped. Goodbye!")
             sys.exit(0)
 
-
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,108 @@
+"""Shared fixtures: server.py running in a subprocess on a loopback port."""
+
+import http.client
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    """A server.py process sharing ``share``; stopped by ``stop()`` or the fixture.
+
+    ``memory_limit`` caps the address space (RLIMIT_AS) of the server
+    process, so a test can prove an upload is streamed rather than held
+    in memory.
+    """
+
+    def __init__(self, share, cache, args=(), memory_limit=None):
+        self.share = str(share)
+        self.port = free_port()
+        env = dict(os.environ)
+        if memory_limit is not None:
+            # glibc reserves 64 MB of address space per thread arena; keep the
+            # baseline small so the limit measures buffers, not arenas
+            env['MALLOC_ARENA_MAX'] = '2'
+
+        def limit():
+            if memory_limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+        self.log = open(os.path.join(str(cache), 'server.log'), 'w+')
+        self.proc = subprocess.Popen(
+            [sys.executable, SERVER, self.share, str(self.port), '--cache-dir', str(cache),
+             '--host', '127.0.0.1', '--no-thumbnails', '--no-search', '--access-log', 'off', *args],
+            stdout=self.log, stderr=subprocess.STDOUT, env=env, preexec_fn=limit)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"server did not start:\n{self.output()}")
+                time.sleep(0.1)
+
+    def connect(self, timeout=60):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+
+    def output(self):
+        self.log.flush()
+        self.log.seek(0)
+        return self.log.read()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.log.close()
+
+
+@pytest.fixture
+def share(tmp_path):
+    path = tmp_path / 'share'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture(params=['threads', 'asyncio'])
+def engine(request):
+    """Every server test runs once per serving engine"""
+    return request.param
+
+
+@pytest.fixture
+def start_server(share, tmp_path, engine):
+    """Start a server on ``share``: ``start_server(*args, memory_limit=None)``"""
+    servers = []
+
+    def start(*args, memory_limit=None):
+        cache = tmp_path / f'cache{len(servers)}'
+        cache.mkdir()
+        server = Server(share, cache, ('--engine', engine) + args, memory_limit)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
@@ -0,0 +1,59 @@
+"""Request bodies that arrive in several TCP segments are read in full."""
+
+import hashlib
+import json
+import socket
+import time
+
+
+def send_split(server, head, body, pieces=3, pause=0.3):
+    """Send ``head`` and ``body`` in ``pieces`` segments with a pause between them"""
+    sock = socket.create_connection(('127.0.0.1', server.port), timeout=10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(head)
+    step = -(-len(body) // pieces)
+    for start in range(0, len(body), step):
+        time.sleep(pause)
+        sock.sendall(body[start:start + step])
+    response = b''
+    while b'\r\n\r\n' not in response:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        response += chunk
+    sock.close()
+    head, _, rest = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), rest
+
+
+def test_json_body_in_segments(server):
+    body = json.dumps({'name': 'split.bin', 'size': 10}).encode()
+    head = (b'POST /.fileshare/uploads HTTP/1.1\r\nHost: test\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n')
+    status, _ = send_split(server, head, body)
+    assert status == 201
+
+
+def test_resumable_upload_in_segments(server, share):
+    data = bytes(range(256)) * 1171 + b'abcd'  # 300000 bytes
+    conn = server.connect(timeout=10)
+    conn.request('POST', '/.fileshare/uploads', json.dumps({'name': 'part.bin', 'size': len(data)}),
+                 {'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    assert resp.status == 201
+    upload = json.loads(resp.read())
+    conn.close()
+
+    head = (f'PUT /.fileshare/uploads/{upload["id"]}?offset=0 HTTP/1.1\r\nHost: test\r\n'
+            f'Content-Type: application/octet-stream\r\n'
+            f'Content-Length: {len(data)}\r\n\r\n').encode()
+    status, _ = send_split(server, head, data, pieces=4, pause=0.2)
+    assert status in (200, 204)
+
+    body = json.dumps({'sha256': hashlib.sha256(data).hexdigest()}).encode()
+    head = (f'POST /.fileshare/uploads/{upload["id"]} HTTP/1.1\r\nHost: test\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode()
+    status, _ = send_split(server, head, body)
+    assert status == 201
+    assert (share / 'part.bin').read_bytes() == data
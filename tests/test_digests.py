@@ -0,0 +1,86 @@
+"""Upload preflight: /.fileshare/digests never hashes big files while the client waits."""
+
+import hashlib
+import json
+import os
+import time
+
+
+def lookup(server, query):
+    conn = server.connect(timeout=10)
+    conn.request('GET', '/.fileshare/digests?' + query)
+    resp = conn.getresponse()
+    assert resp.status == 200
+    return json.loads(resp.read())
+
+
+def test_small_file_is_matched_at_once(server, share):
+    data = os.urandom(64 * 1024)
+    (share / 'small.bin').write_bytes(data)
+    digest = hashlib.sha256(data).hexdigest()
+    assert lookup(server, f'size={len(data)}') == {'candidates': 1, 'match': None, 'pending': False}
+    answer = lookup(server, f'size={len(data)}&sha256={digest}')
+    assert answer['match']['path'] == '/small.bin'
+    assert answer['pending'] is False
+
+
+def test_big_file_is_hashed_in_the_background(server, share):
+    data = os.urandom(1024 * 1024) * 20  # over DIGEST_INLINE_MAX
+    (share / 'big.bin').write_bytes(data)
+    query = f'size={len(data)}&sha256={hashlib.sha256(data).hexdigest()}'
+    answer = lookup(server, query)
+    assert answer == {'candidates': 1, 'match': None, 'pending': True}
+
+    deadline = time.monotonic() + 30
+    while answer['match'] is None and time.monotonic() < deadline:
+        time.sleep(0.2)
+        answer = lookup(server, query)
+    assert answer['match']['path'] == '/big.bin'
+    assert answer['pending'] is False
+
+
+def test_different_big_file_is_not_matched(server, share):
+    data = os.urandom(1024 * 1024) * 20
+    (share / 'big.bin').write_bytes(data)
+    query = f'size={len(data)}&sha256={"0" * 64}'
+    assert lookup(server, query)['pending'] is True
+    deadline = time.monotonic() + 30
+    answer = lookup(server, query)
+    while answer['pending'] and time.monotonic() < deadline:
+        time.sleep(0.2)
+        answer = lookup(server, query)
+    assert answer == {'candidates': 1, 'match': None, 'pending': False}
+
+
+def upload(server, name, data):
+    boundary = 'digesttestboundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + \
+        f'\r\n--{boundary}--\r\n'.encode()
+    conn = server.connect(timeout=60)
+    conn.request('POST', '/?format=json', body,
+                 {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    return json.loads(resp.read())['files'][0]
+
+
+def test_same_upload_is_a_duplicate(server, share):
+    data = os.urandom(1024 * 1024) * 20
+    assert upload(server, 'big.bin', data)['result'] == 'saved'
+    # Its digest was remembered when it was saved, so no hashing is needed
+    assert upload(server, 'big.bin', data)['result'] == 'duplicate'
+    assert sorted(os.listdir(share)) == ['big.bin']
+
+
+def test_unhashed_big_file_is_not_read_to_compare(server, share):
+    data = os.urandom(1024 * 1024) * 20
+    (share / 'big.bin').write_bytes(data)
+    answer = upload(server, 'big.bin', data)
+    assert (answer['name'], answer['result']) == ('big (1).bin', 'saved')
+
+
+def test_unhashed_small_file_is_compared(server, share):
+    data = os.urandom(64 * 1024)
+    (share / 'small.bin').write_bytes(data)
+    assert upload(server, 'small.bin', data)['result'] == 'duplicate'
@@ -0,0 +1,70 @@
+"""Many requests, one connection: HTTP/1.1 keep-alive."""
+
+import json
+
+from test_upload import BOUNDARY, body, body_length
+
+
+def test_sequential_requests_on_one_connection(server, share):
+    (share / 'a.txt').write_bytes(b'0123456789' * 100)
+    (share / 'docs').mkdir()
+    conn = server.connect(timeout=10)
+
+    def request(method, path, body=None, headers={}):
+        conn.request(method, path, body, headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        if sock is not None:
+            assert conn.sock is sock, f"connection closed after {method} {path}"
+        return resp, data
+
+    sock = None
+    resp, data = request('GET', '/')
+    sock = conn.sock
+    assert resp.status == 200
+    assert b'a.txt' in data and b'docs' in data
+
+    resp, data = request('GET', '/a.txt')
+    assert resp.status == 200
+    assert data == b'0123456789' * 100
+
+    resp, data = request('GET', '/a.txt', headers={'Range': 'bytes=5-14'})
+    assert resp.status == 206
+    assert resp.getheader('Content-Range') == 'bytes 5-14/1000'
+    assert data == b'5678901234'
+
+    # An error page must not cost the connection
+    resp, data = request('GET', '/missing.txt')
+    assert resp.status == 404
+    assert resp.getheader('Connection', '').lower() != 'close'
+
+    resp, data = request('HEAD', '/a.txt')
+    assert resp.status == 200
+    assert resp.getheader('Content-Length') == '1000'
+    assert data == b''
+
+    resp, data = request('GET', '/docs/?format=json')
+    assert resp.status == 200
+    assert json.loads(data)['entries'] == []
+
+    files = [('up.bin', 300 * 1024 + 5, 7)]
+    conn.putrequest('POST', '/docs/')
+    conn.putheader('Content-Type', f'multipart/form-data; boundary={BOUNDARY}')
+    conn.putheader('Content-Length', str(body_length(files)))
+    conn.endheaders()
+    for chunk in body(files):
+        conn.send(chunk)
+    resp = conn.getresponse()
+    resp.read()
+    assert conn.sock is sock
+    assert resp.status == 303
+    assert resp.getheader('Location') == '/docs/'
+
+    resp, data = request('GET', resp.getheader('Location'))
+    assert resp.status == 200
+    assert b'up.bin' in data
+    assert (share / 'docs' / 'up.bin').stat().st_size == 300 * 1024 + 5
+
+    resp, data = request('GET', '/docs/up.bin', headers={'Range': 'bytes=0-0'})
+    assert resp.status == 206 and len(data) == 1
+    conn.close()
@@ -0,0 +1,42 @@
+"""Requests never reach files outside the shared folder."""
+
+import pytest
+
+
+@pytest.fixture
+def secret(share):
+    folder = share.parent / 'secret'
+    folder.mkdir()
+    (folder / 'key.txt').write_text('TOPSECRET')
+    return folder
+
+
+@pytest.mark.parametrize('path', [
+    '/..%2fsecret?format=zip',
+    '/..%2fsecret/?format=zip',
+    '/..%2fsecret',
+    '/..%2fsecret/?format=json',
+    '/..%2Fsecret/key.txt',
+    '/docs/..%2f..%2fsecret?format=zip',
+    '/../secret?format=zip',
+])
+def test_encoded_dotdot_stays_inside_share(server, share, secret, path):
+    (share / 'docs').mkdir()
+    conn = server.connect(timeout=10)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    data = resp.read()
+    assert resp.status == 404
+    assert b'TOPSECRET' not in data and b'key.txt' not in data
+
+
+def test_dotdot_inside_share_still_works(server, share):
+    (share / 'docs').mkdir()
+    (share / 'docs' / 'a.txt').write_text('hello')
+    conn = server.connect(timeout=10)
+    conn.request('GET', '/docs/..%2fdocs/a.txt')
+    resp = conn.getresponse()
+    assert resp.status == 200 and resp.read() == b'hello'
+    conn.request('GET', '/docs/..%2fdocs?format=zip')
+    resp = conn.getresponse()
+    assert resp.status == 200 and resp.read().startswith(b'PK')
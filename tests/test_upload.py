@@ -0,0 +1,102 @@
+"""Multipart uploads are streamed to disk, never held in memory."""
+
+import json
+import os
+import random
+import time
+
+CHUNK = 1024 * 1024
+MEMORY_LIMIT = 384 * 1024 * 1024
+BOUNDARY = 'testboundary7MA4YWxkTrZu0gW'
+
+
+def pattern(seed, size):
+    """Deterministic content: a random block with the chunk number in front"""
+    block = random.Random(seed).randbytes(CHUNK)
+    for i, offset in enumerate(range(0, size, CHUNK)):
+        yield (i.to_bytes(8, 'big') + block[8:])[:size - offset]
+
+
+def part_head(name):
+    return (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+
+
+def body_length(files):
+    tail = len(f'--{BOUNDARY}--\r\n')
+    return sum(len(part_head(name)) + size + 2 for name, size, _ in files) + tail
+
+
+def body(files):
+    for name, size, seed in files:
+        yield part_head(name)
+        yield from pattern(seed, size)
+        yield b'\r\n'
+    yield f'--{BOUNDARY}--\r\n'.encode()
+
+
+def start_upload(conn, path, length):
+    conn.putrequest('POST', path)
+    conn.putheader('Content-Type', f'multipart/form-data; boundary={BOUNDARY}')
+    conn.putheader('Content-Length', str(length))
+    conn.endheaders()
+
+
+def post_files(server, path, files):
+    """Stream ``(name, size, seed)`` files as one multipart request"""
+    conn = server.connect(timeout=300)
+    start_upload(conn, path, body_length(files))
+    for chunk in body(files):
+        conn.send(chunk)
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp.status, data
+
+
+def assert_same(path, size, seed):
+    assert os.path.getsize(path) == size
+    with open(path, 'rb') as f:
+        for expected in pattern(seed, size):
+            assert f.read(len(expected)) == expected
+
+
+def test_upload_larger_than_memory_limit(start_server, share):
+    server = start_server(memory_limit=MEMORY_LIMIT)
+    size = MEMORY_LIMIT + 128 * 1024 * 1024
+    status, data = post_files(server, '/?format=json', [('big.bin', size, 1)])
+    assert status == 200, server.output()
+    assert [f['result'] for f in json.loads(data)['files']] == ['saved']
+    assert_same(share / 'big.bin', size, 1)
+    assert server.alive()
+
+
+def test_two_files_in_one_request(server, share):
+    files = [('a.bin', 5 * CHUNK + 123, 2), ('b.bin', 3 * CHUNK - 7, 3)]
+    status, data = post_files(server, '/?format=json', files)
+    assert status == 200
+    assert sorted(f['name'] for f in json.loads(data)['files']) == ['a.bin', 'b.bin']
+    for name, size, seed in files:
+        assert_same(share / name, size, seed)
+
+
+def test_truncated_upload_leaves_no_file(server, share):
+    files = [('partial.bin', 8 * CHUNK, 4)]
+    conn = server.connect()
+    start_upload(conn, '/', body_length(files))
+    sent = 0
+    for chunk in body(files):
+        conn.send(chunk)
+        sent += len(chunk)
+        if sent > 3 * CHUNK:
+            break
+    conn.close()
+
+    # The server notices the closed connection and removes its temp file
+    deadline = time.monotonic() + 10
+    while os.listdir(share) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert os.listdir(share) == []
+    conn = server.connect()
+    conn.request('GET', '/')
+    assert conn.getresponse().status == 200